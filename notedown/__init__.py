@@ -7,7 +7,9 @@ from .main import convert, markdown_template, __version__
 try:
     from .contentsmanager import NotedownContentsManager
     from .contentsmanager import NotedownContentsManagerStripped
+    from .checkpoints import NotedownCheckpoints
 except ImportError:
     err = 'You need to install the jupyter notebook.'
     NotedownContentsManager = err
     NotedownContentsManagerStripped = err
+    NotedownCheckpoints = err
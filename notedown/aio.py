@@ -0,0 +1,210 @@
+"""asyncio versions of the conversion functions, for services that
+embed notedown in an event loop (python 3.6+).
+
+    from notedown.aio import aconvert, aiter_cells, arun
+
+    markdown = await aconvert(notebook_json, 'notebook', 'markdown')
+
+    async for cell in aiter_cells(request.content):
+        ...
+
+    await arun(notebook)
+
+Parsing and writing are cpu bound, so they are run in an executor by a
+BlockingRunner, which also limits how many may be waiting or running
+at once. Pass your own, e.g. one using a process pool, as runner to
+share the work between cpus:
+
+    runner = BlockingRunner(ProcessPoolExecutor(4), max_pending=16)
+    markdown = await aconvert(content, 'notebook', 'markdown',
+                              runner=runner)
+"""
+import asyncio
+import functools
+import inspect
+import weakref
+
+from nbconvert.preprocessors.execute import (CellExecutionComplete,
+                                             CellExecutionError,
+                                             ExecutePreprocessor)
+
+from .main import convert
+from .notedown import MarkdownReader, NotebookFormat
+
+
+class BlockingRunner(object):
+    """Run blocking functions from coroutines, in executor (default
+    the event loop's), with at most max_pending of them waiting or
+    running at once. Callers beyond that wait for a free slot, which
+    gives back-pressure to a busy service rather than an unbounded
+    queue of work.
+    """
+    def __init__(self, executor=None, max_pending=32):
+        self.executor = executor
+        self.max_pending = max_pending
+        # a semaphore belongs to one loop, so each loop gets its own
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def semaphore(self, loop):
+        """The semaphore limiting the functions run from loop."""
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_pending)
+        return self._semaphores[loop]
+
+    async def __call__(self, function, *args, **kwargs):
+        loop = running_loop()
+        async with self.semaphore(loop):
+            return await loop.run_in_executor(
+                self.executor, functools.partial(function, *args, **kwargs))
+
+
+def running_loop():
+    """The event loop running the current coroutine."""
+    # asyncio.get_running_loop is new in python 3.7
+    get_running_loop = getattr(asyncio, 'get_running_loop', None)
+    if get_running_loop is None:
+        return asyncio.get_event_loop()
+    return get_running_loop()
+
+
+default_runner = BlockingRunner()
+
+
+async def aconvert(content, informat, outformat, strip_outputs=False,
+                   validate=True, runner=None, **reader_options):
+    """convert, run by runner (default default_runner)."""
+    runner = runner or default_runner
+    return await runner(convert, content, informat, outformat,
+                        strip_outputs=strip_outputs, validate=validate,
+                        **reader_options)
+
+
+async def aread(stream):
+    """Read all of stream, which may be a string, an object with a
+    read method (e.g. an asyncio or aiohttp StreamReader) or an
+    asynchronous iterable of chunks, as unicode."""
+    if isinstance(stream, (bytes, str)):
+        data = stream
+    elif hasattr(stream, 'read'):
+        data = stream.read()
+        if inspect.isawaitable(data):
+            data = await data
+    else:
+        chunks = [chunk async for chunk in stream]
+        data = chunks[0][:0].join(chunks) if chunks else ''
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return data
+
+
+async def aiter_cells(stream, informat='markdown', validate=True,
+                      runner=None, **reader_options):
+    """Yield the cells of the notebook read from stream (see aread),
+    parsing it with runner. The reader options are as for convert."""
+    runner = runner or default_runner
+    if informat == 'markdown':
+        reader = MarkdownReader(precode='', magic=False, match='fenced',
+                                validate=validate, **reader_options)
+    else:
+        reader = NotebookFormat(validate)
+    text = await aread(stream)
+    notebook = await runner(reader.reads, text, as_version=4)
+    for cell in notebook.cells:
+        yield cell
+
+
+async def arun(notebook, timeout=30, select=None, kernel_name=None,
+               startup_timeout=60):
+    """Execute the notebook in place, as run does, using an
+    asynchronous kernel client so that the event loop isn't blocked
+    while the cells run.
+
+    timeout   - seconds each cell may take to run
+    select    - function select(cell, index) choosing the cells to run
+                (see CellSelector), default all
+    kernel_name - default from the notebook metadata, as for run
+
+    Records the kernel's language_info in the notebook metadata, as
+    run does.
+
+    Raises CellExecutionError if a cell raises an error and
+    asyncio.TimeoutError, after interrupting the kernel, if one takes
+    longer than timeout.
+    """
+    # needs jupyter_client 6.1 or later
+    from jupyter_client.manager import AsyncKernelManager
+
+    if kernel_name is None:
+        kernelspec = notebook.metadata.get('kernelspec', {})
+        kernel_name = kernelspec.get('name', 'python')
+
+    # handles the messages from the kernel as run does
+    processor = ExecutePreprocessor()
+    processor.nb = notebook
+    processor._display_id_map = {}
+
+    manager = AsyncKernelManager(kernel_name=kernel_name)
+    await manager.start_kernel()
+    client = manager.client()
+    client.start_channels()
+    try:
+        await client.wait_for_ready(timeout=startup_timeout)
+        notebook.metadata['language_info'] = await asyncio.wait_for(
+            kernel_language_info(client), timeout)
+        for index, cell in enumerate(notebook.cells):
+            if cell.cell_type != 'code' or not cell.source.strip():
+                continue
+            if select is not None and not select(cell, index):
+                continue
+            try:
+                await asyncio.wait_for(
+                    run_cell(client, processor, cell, index), timeout)
+            except asyncio.TimeoutError:
+                await manager.interrupt_kernel()
+                raise
+    finally:
+        client.stop_channels()
+        await manager.shutdown_kernel(now=True)
+
+
+async def kernel_language_info(client):
+    """Ask the kernel of the asynchronous client for its
+    language_info."""
+    msg_id = client.kernel_info()
+    while True:
+        msg = await client.get_shell_msg()
+        if msg['parent_header'].get('msg_id') == msg_id:
+            return msg['content']['language_info']
+
+
+async def run_cell(client, processor, cell, index):
+    """Execute cell with the kernel client, putting the outputs in
+    it."""
+    msg_id = client.execute(cell.source, stop_on_error=True)
+    cell.outputs = []
+    processor.clear_before_next_output = False
+
+    async def outputs():
+        while True:
+            msg = await client.get_iopub_msg()
+            if msg['parent_header'].get('msg_id') != msg_id:
+                continue
+            try:
+                processor.process_message(msg, cell, index)
+            except CellExecutionComplete:
+                return
+
+    async def reply():
+        while True:
+            msg = await client.get_shell_msg()
+            if msg['parent_header'].get('msg_id') == msg_id:
+                return msg
+
+    _, msg = await asyncio.gather(outputs(), reply())
+    if msg['content']['status'] == 'error':
+        raise CellExecutionError.from_cell_and_msg(cell, msg['content'])
+    return cell
+
+
+__all__ = ['BlockingRunner', 'aconvert', 'aiter_cells', 'aread', 'arun',
+           'default_runner']
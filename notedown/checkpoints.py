@@ -0,0 +1,231 @@
+import hashlib
+import io
+import json
+import os
+import re
+
+try:
+    import notebook.transutils
+    from notebook.services.contents.filecheckpoints import FileCheckpoints
+except ImportError:
+    from IPython.html.services.contents.filecheckpoints import FileCheckpoints
+
+from .main import ftdetect
+from .notedown import MarkdownReader
+
+
+# section n of doc.md (see NotedownContentsManager.section_size)
+section_path = re.compile(r'^(?P<path>.*)@(?P<section>[0-9]+)$')
+
+
+def section_file(path):
+    """The path of the markdown file that path is a section of, or
+    path if it isn't a section."""
+    match = section_path.match(path)
+    if ftdetect(path) is None and match is not None \
+            and ftdetect(match.group('path')) == 'markdown':
+        return match.group('path')
+    return path
+
+
+def split_source(text, reader=None):
+    """Split markdown text into chunks at the edges of the code
+    blocks, such that ''.join(chunks) == text.
+
+    Each code block (input or output) is a chunk of its own, as is
+    the text between code blocks.
+    """
+    reader = reader or MarkdownReader()
+    chunks = []
+    last = 0
+    for match in reader.code_pattern.finditer(text):
+        if match.start() > last:
+            chunks.append(text[last:match.start()])
+        chunks.append(text[match.start():match.end()])
+        last = match.end()
+    if last < len(text):
+        chunks.append(text[last:])
+    return chunks
+
+
+class NotedownCheckpoints(FileCheckpoints):
+    """Checkpoints that store markdown notebooks as deltas.
+
+    A markdown checkpoint is a manifest listing the hashes of the
+    chunks (code blocks, output blocks and the text in between) that
+    make up the file. The chunks themselves live in a content
+    addressed store shared by all of the checkpoints in the
+    directory, so creating a checkpoint only writes the chunks that
+    changed since the last one.
+
+    Notebook (.ipynb) files are checkpointed by copying, as in
+    FileCheckpoints.
+
+    The checkpoints of a section of a markdown notebook (doc.md@n)
+    are those of the whole file.
+    """
+    format = 'notedown-delta'
+    objects_dir = 'objects'
+
+    def create_checkpoint(self, contents_mgr, path):
+        """Create a checkpoint."""
+        path = section_file(path)
+        if ftdetect(path) != 'markdown':
+            return super(NotedownCheckpoints, self).create_checkpoint(
+                contents_mgr, path)
+
+        checkpoint_id = 'checkpoint'
+        src_path = contents_mgr._get_os_path(path)
+        dest_path = self.checkpoint_path(checkpoint_id, path)
+
+        with io.open(src_path, 'rb') as f:
+            source = f.read()
+
+        self._write_checkpoint(dest_path, path, source)
+
+        return self.checkpoint_model(checkpoint_id, dest_path)
+
+    def restore_checkpoint(self, contents_mgr, checkpoint_id, path):
+        """Restore a checkpoint."""
+        path = section_file(path)
+        if ftdetect(path) != 'markdown':
+            return super(NotedownCheckpoints, self).restore_checkpoint(
+                contents_mgr, checkpoint_id, path)
+
+        src_path = self.checkpoint_path(checkpoint_id, path)
+        if not os.path.isfile(src_path):
+            self.no_such_checkpoint(path, checkpoint_id)
+        dest_path = contents_mgr._get_os_path(path)
+
+        source = self._read_checkpoint(src_path, path)
+
+        with self.atomic_writing(dest_path, text=False) as f:
+            f.write(source)
+
+    def rename_checkpoint(self, checkpoint_id, old_path, new_path):
+        """Rename a checkpoint from old_path to new_path.
+
+        The chunks of a markdown checkpoint are stored again next to
+        the new checkpoint, as the store is per directory.
+        """
+        old_path = section_file(old_path)
+        new_path = section_file(new_path)
+        if 'markdown' not in (ftdetect(old_path), ftdetect(new_path)):
+            return super(NotedownCheckpoints, self).rename_checkpoint(
+                checkpoint_id, old_path, new_path)
+
+        old_cp_path = self.checkpoint_path(checkpoint_id, old_path)
+        new_cp_path = self.checkpoint_path(checkpoint_id, new_path)
+        if not os.path.isfile(old_cp_path):
+            return
+        self.log.debug("Renaming checkpoint %s -> %s",
+                       old_cp_path, new_cp_path)
+        source = self._read_checkpoint(old_cp_path, old_path)
+        self._write_checkpoint(new_cp_path, new_path, source)
+        self.delete_checkpoint(checkpoint_id, old_path)
+
+    def delete_checkpoint(self, checkpoint_id, path):
+        """delete a file's checkpoint"""
+        path = section_file(path.strip('/'))
+        cp_path = self.checkpoint_path(checkpoint_id, path)
+        hashes = set(self._read_manifest(cp_path))
+        super(NotedownCheckpoints, self).delete_checkpoint(checkpoint_id, path)
+        self._collect_garbage(cp_path, hashes)
+
+    def checkpoint_path(self, checkpoint_id, path):
+        """find the path to a checkpoint"""
+        path = section_file(path)
+        cp_path = super(NotedownCheckpoints, self).checkpoint_path(
+            checkpoint_id, path)
+        if ftdetect(path) == 'markdown':
+            # the checkpoint is a json manifest, not markdown
+            cp_path += '.json'
+        return cp_path
+
+    def _read_checkpoint(self, cp_path, path):
+        """The contents of the checkpoint of path at cp_path."""
+        if ftdetect(path) != 'markdown':
+            with io.open(cp_path, 'rb') as f:
+                return f.read()
+        return b''.join(self._load_chunk(cp_path, h)
+                        for h in self._read_manifest(cp_path))
+
+    def _write_checkpoint(self, cp_path, path, source):
+        """Write source (bytes) as the checkpoint of path at cp_path,
+        as a manifest of chunks if path is markdown."""
+        if ftdetect(path) != 'markdown':
+            with self.perm_to_403():
+                with self.atomic_writing(cp_path, text=False) as f:
+                    f.write(source)
+            return
+
+        try:
+            chunks = [chunk.encode('utf-8')
+                      for chunk in split_source(source.decode('utf-8'))]
+        except UnicodeDecodeError:
+            # not utf-8, so can't be split into code blocks
+            chunks = [source]
+
+        old_hashes = set(self._read_manifest(cp_path))
+        hashes = [self._store_chunk(cp_path, chunk) for chunk in chunks]
+
+        manifest = {'format': self.format, 'chunks': hashes}
+        with self.atomic_writing(cp_path, text=False) as f:
+            f.write(json.dumps(manifest).encode('utf-8'))
+
+        self._collect_garbage(cp_path, old_hashes.difference(hashes))
+
+    # --- content addressed chunk store --- #
+    def _object_path(self, cp_path, chunk_hash):
+        return os.path.join(os.path.dirname(cp_path), self.objects_dir,
+                            chunk_hash[:2], chunk_hash[2:])
+
+    def _store_chunk(self, cp_path, data):
+        """Write chunk (bytes) to the store, unless it is already
+        there. Returns the hash of the chunk."""
+        chunk_hash = hashlib.sha1(data).hexdigest()
+        object_path = self._object_path(cp_path, chunk_hash)
+        if not os.path.isfile(object_path):
+            object_dir = os.path.dirname(object_path)
+            with self.perm_to_403():
+                if not os.path.isdir(object_dir):
+                    os.makedirs(object_dir)
+                with self.atomic_writing(object_path, text=False) as f:
+                    f.write(data)
+        return chunk_hash
+
+    def _load_chunk(self, cp_path, chunk_hash):
+        with io.open(self._object_path(cp_path, chunk_hash), 'rb') as f:
+            return f.read()
+
+    def _read_manifest(self, cp_path):
+        """Return the list of chunk hashes in the manifest at
+        cp_path, or an empty list if there isn't one."""
+        if not os.path.isfile(cp_path):
+            return []
+        with io.open(cp_path, 'r', encoding='utf-8') as f:
+            try:
+                manifest = json.load(f)
+            except ValueError:
+                return []
+        if not isinstance(manifest, dict) \
+                or manifest.get('format') != self.format:
+            return []
+        return manifest['chunks']
+
+    def _collect_garbage(self, cp_path, candidates):
+        """Remove the chunks in candidates that are no longer
+        referenced by any manifest in the checkpoint directory."""
+        if not candidates:
+            return
+        cp_dir = os.path.dirname(cp_path)
+        referenced = set()
+        for name in os.listdir(cp_dir):
+            if name.endswith('.json'):
+                path = os.path.join(cp_dir, name)
+                referenced.update(self._read_manifest(path))
+        for chunk_hash in set(candidates).difference(referenced):
+            object_path = self._object_path(cp_path, chunk_hash)
+            if os.path.isfile(object_path):
+                with self.perm_to_403():
+                    os.unlink(object_path)
@@ -1,8 +1,13 @@
+import copy
+import hashlib
+import io
+import json
 import os
 
 import nbformat
 
 from tornado import web
+from traitlets import default, Bool, Enum, Float, Integer
 
 try:
     import notebook.transutils
@@ -10,7 +15,18 @@ try:
 except ImportError:
     from IPython.html.services.contents.filemanager import FileContentsManager
 
-from .main import ftdetect, convert
+from . import notedown
+from .main import ftdetect, markdown_template
+from .checkpoints import NotedownCheckpoints, section_path
+
+
+def file_stat(os_path):
+    """Modification time and size of a file, to tell if it changed."""
+    try:
+        info = os.stat(os_path)
+    except OSError:
+        return None
+    return (getattr(info, 'st_mtime_ns', info.st_mtime), info.st_size)
 
 
 class NotedownContentsManager(FileContentsManager):
@@ -29,9 +45,78 @@ class NotedownContentsManager(FileContentsManager):
       c.NotebookApp.contents_manager_class = 'notedown.NotedownContentsManager'
 
     Now markdown notebooks can be opened and edited in the browser!
+
+    Checkpoints of markdown notebooks are stored as deltas by
+    NotedownCheckpoints.
     """
     strip_outputs = False
 
+    max_size = Integer(None, allow_none=True, config=True,
+                       help="Maximum size (characters) of a markdown notebook")
+    max_blocks = Integer(None, allow_none=True, config=True,
+                         help="Maximum number of code blocks in a "
+                              "markdown notebook")
+    time_budget = Float(None, allow_none=True, config=True,
+                        help="Maximum time (seconds) to spend reading a "
+                             "markdown notebook. Off by default")
+    on_limit = Enum(['raise', 'text'], default_value='raise', config=True,
+                    help="When a parse limit is exceeded, either 'raise' an "
+                         "error or open the file as a single markdown cell")
+    validate = Enum([True, False, 'lazy'], default_value=True, config=True,
+                    help="Validate markdown notebooks against the notebook "
+                         "format schema: True, False or 'lazy' (validate in "
+                         "the background and log any errors)")
+
+    skip_unchanged = Bool(True, config=True,
+                          help="Leave notebook files that already hold what "
+                               "is saved untouched, keeping their "
+                               "modification time")
+
+    outputs_file = Bool(False, config=True,
+                        help="Keep the outputs of markdown notebooks in a "
+                             ".outputs.json file beside them, rather than "
+                             "in the markdown")
+
+    section_size = Integer(None, allow_none=True, config=True,
+                           help="Open markdown notebooks larger than this "
+                                "(characters) a section at a time, "
+                                "splitting them at their top level "
+                                "headings. Section n of doc.md is "
+                                "doc.md@n")
+
+    section_path = section_path
+
+    def __init__(self, **kwargs):
+        super(NotedownContentsManager, self).__init__(**kwargs)
+        # (notebook digest, file_stat) of the last save of each path
+        self._saved = {}
+        # MarkdownWriters by strip_outputs
+        self._markdown_writers = {}
+
+    @default('checkpoints_class')
+    def _checkpoints_class_default(self):
+        return NotedownCheckpoints
+
+    def _markdown_reader(self):
+        # the model is validated by validate_notebook_model
+        return notedown.MarkdownReader(precode='',
+                                       magic=False,
+                                       match='fenced',
+                                       max_size=self.max_size,
+                                       max_blocks=self.max_blocks,
+                                       time_budget=self.time_budget,
+                                       on_limit=self.on_limit,
+                                       validate=False)
+
+    def _markdown_writer(self):
+        # writers keep no state between writes, so one is shared by
+        # all saves
+        if self.strip_outputs not in self._markdown_writers:
+            self._markdown_writers[self.strip_outputs] \
+                = notedown.MarkdownWriter(markdown_template,
+                                          strip_outputs=self.strip_outputs)
+        return self._markdown_writers[self.strip_outputs]
+
     def _read_notebook(self, os_path, as_version=4):
         """Read a notebook from an os path."""
         with self.open(os_path, 'r', encoding='utf-8') as f:
@@ -39,28 +124,220 @@ class NotedownContentsManager(FileContentsManager):
                 if ftdetect(os_path) == 'notebook':
                     return nbformat.read(f, as_version=as_version)
                 elif ftdetect(os_path) == 'markdown':
-                    nbjson = convert(os_path,
-                                     informat='markdown',
-                                     outformat='notebook')
-                    return nbformat.reads(nbjson, as_version=as_version)
+                    reader = self._markdown_reader()
+                    nb = reader.read(
+                        f, outputs_file=notedown.OutputsFile.path(os_path))
+                    return nbformat.convert(nb, as_version)
             except Exception as e:
                 raise web.HTTPError(
                     400,
                     u"Unreadable Notebook: %s %r" % (os_path, e),
                 )
 
+    def _split_section(self, path):
+        """Split path into the path of the file and the number of the
+        section of it (from 1), or None."""
+        match = self.section_path.match(path)
+        if self.section_size is None or match is None \
+                or ftdetect(match.group('path')) != 'markdown':
+            return path, None
+        return match.group('path'), int(match.group('section'))
+
+    def _get_os_path(self, path):
+        """Given an API path, return its file system path. Sections
+        are in the file they come from."""
+        path, _ = self._split_section(path)
+        return super(NotedownContentsManager, self)._get_os_path(path)
+
+    def _check_not_section(self, path, action):
+        """Sections can only be read and saved as notebooks."""
+        if self._split_section(path.strip('/'))[1] is not None:
+            raise web.HTTPError(400, u"Can't %s %s, a section of a "
+                                     u"notebook" % (action, path))
+
+    def _notebook_model(self, path, content=True):
+        """Build a notebook model, of a section of a large markdown
+        notebook (see section_size)."""
+        file_path, section = self._split_section(path)
+        os_path = self._get_os_path(path)
+        if section is None:
+            if self.section_size is None \
+                    or ftdetect(os_path) != 'markdown' \
+                    or os.path.getsize(os_path) <= self.section_size:
+                return super(NotedownContentsManager,
+                             self)._notebook_model(path, content)
+            section = 1
+
+        model = self._base_model(path)
+        model['type'] = 'notebook'
+        if content:
+            nb = self._read_section(os_path, file_path, section)
+            self.mark_trusted_cells(nb, path)
+            model['content'] = nb
+            model['format'] = 'json'
+            self.validate_notebook_model(model)
+        return model
+
+    def _read_section(self, os_path, path, section):
+        """Read section of the markdown notebook at os_path as a
+        notebook, starting with an outline of the sections."""
+        with io.open(os_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        reader = self._markdown_reader()
+        try:
+            index = notedown.SectionIndex(text, reader)
+        except Exception as e:
+            raise web.HTTPError(400, u"Unreadable Notebook: %s %r"
+                                % (os_path, e))
+        if not 1 <= section <= len(index):
+            raise web.HTTPError(404, u'No section %d of %s' % (section, path))
+
+        nb = reader.reads(index.text(section - 1),
+                          outputs_file=notedown.OutputsFile.path(os_path))
+
+        name = path.rsplit('/', 1)[-1]
+        lines = [u'Sections of **%s** (this cell is not saved):\n' % name]
+        for i, title in enumerate(index.titles, 1):
+            title = title or u'(start)'
+            if i == section:
+                lines.append(u'%d. **%s**' % (i, title))
+            else:
+                lines.append(u'%d. [%s](%s@%d)' % (i, title, name, i))
+        outline = nbformat.v4.new_markdown_cell(u'\n'.join(lines))
+        outline.metadata['notedown'] = {'outline': True}
+        nb.cells.insert(0, outline)
+        nb.metadata['notedown'] = {'section': section,
+                                   'sections': len(index)}
+        return nb
+
+    def _merge_section(self, os_path, nb, writer):
+        """The markdown notebook at os_path with the section that nb
+        was read from replaced by nb, and the resources of writing the
+        section (see MarkdownWriter.export)."""
+        info = nb.metadata['notedown']
+        with io.open(os_path, 'r', encoding='utf-8') as f:
+            index = notedown.SectionIndex(f.read(), self._markdown_reader())
+        if len(index) != info['sections']:
+            raise web.HTTPError(409, u"The sections of %s have changed "
+                                     u"since it was opened" % os_path)
+        section = info['section'] - 1
+
+        nb = copy.deepcopy(nb)
+        nb.cells = [cell for cell in nb.cells
+                    if not cell.metadata.get('notedown', {}).get('outline')]
+        del nb.metadata['notedown']
+        if self.outputs_file:
+            text, resources = writer.export(
+                nb, outputs_file=notedown.OutputsFile.path(os_path))
+        else:
+            text, resources = writer.export(nb)
+
+        new_index = notedown.SectionIndex(text, self._markdown_reader(),
+                                          level=index.level)
+        if len(new_index) != 1 or \
+                (new_index.titles[0] is None) != \
+                (index.titles[section] is None):
+            raise web.HTTPError(400, u"Sections can't add or remove top "
+                                     u"level headings; open %s without "
+                                     u"sections to do that" % os_path)
+        return index.replace(section, text), resources
+
     def _save_notebook(self, os_path, nb):
-        """Save a notebook to an os_path."""
+        """Save a notebook to an os_path. A notebook that is the same
+        as the one last saved to an unchanged file isn't rendered
+        again."""
+        digest = hashlib.sha1(json.dumps(nb, sort_keys=True)
+                              .encode('utf-8')).hexdigest()
+        if self._saved.get(os_path) == (digest, file_stat(os_path)):
+            self.log.debug("Not saving unchanged notebook %s", os_path)
+            return
+
+        text, resources = self._render_notebook(os_path, nb)
+        self._write_outputs_file(os_path, nb, resources)
+        self._write_text(os_path, text)
+        self._saved[os_path] = (digest, file_stat(os_path))
+
+    def _write_outputs_file(self, os_path, nb, resources):
+        """Write the outputs that the markdown rendered for nb refers
+        to (see outputs_file) to the file beside os_path. A section
+        adds its outputs to those of the rest of the file."""
+        if resources.get('file_outputs') is None:
+            return
+        section = 'section' in nb.metadata.get('notedown', {})
+        self._markdown_writer().write_outputs_file(
+            notedown.OutputsFile.path(os_path), resources, merge=section)
+
+    def _write_text(self, os_path, text):
+        if self.skip_unchanged and notedown.same_contents(os_path, text):
+            self.log.debug("Not rewriting unchanged %s", os_path)
+            return
         with self.atomic_writing(os_path, encoding='utf-8') as f:
-            if ftdetect(os_path) == 'notebook':
-                nbformat.write(nb, f, version=nbformat.NO_CONVERT)
-            elif ftdetect(os_path) == 'markdown':
-                nbjson = nbformat.writes(nb, version=nbformat.NO_CONVERT)
-                markdown = convert(nbjson,
-                                   informat='notebook',
-                                   outformat='markdown',
-                                   strip_outputs=self.strip_outputs)
-                f.write(markdown)
+            f.write(text)
+
+    def _render_notebook(self, os_path, nb):
+        """The contents of the file at os_path for the notebook nb, and
+        the resources of writing it (see MarkdownWriter.export)."""
+        resources = {}
+        if ftdetect(os_path) == 'markdown' and \
+                'section' in nb.metadata.get('notedown', {}):
+            nbformat.v4.rwbase.rejoin_lines(nb)
+            nbformat.v4.rwbase.strip_transient(nb)
+            writer = self._markdown_writer()
+            text, resources = self._merge_section(os_path, nb, writer)
+        elif ftdetect(os_path) == 'notebook':
+            text = nbformat.writes(nb, version=nbformat.NO_CONVERT)
+            # as nbformat.write
+            if not text.endswith(u'\n'):
+                text += u'\n'
+        elif ftdetect(os_path) == 'markdown':
+            # normalise the notebook as reading it from json would
+            nbformat.v4.rwbase.rejoin_lines(nb)
+            nbformat.v4.rwbase.strip_transient(nb)
+            writer = self._markdown_writer()
+            if self.outputs_file:
+                text, resources = writer.export(
+                    nb, outputs_file=notedown.OutputsFile.path(os_path))
+            else:
+                text, resources = writer.export(nb)
+        else:
+            text = u''
+        return text, resources
+
+    def validate_notebook_model(self, model):
+        """Add failed-validation message to model.
+
+        Markdown notebooks are validated as configured by validate.
+        """
+        if ftdetect(model.get('path', '')) != 'markdown' \
+                or self.validate is True:
+            return super(NotedownContentsManager,
+                         self).validate_notebook_model(model)
+        notedown.validate_notebook(model['content'], self.validate)
+        return model
+
+    def save(self, model, path=''):
+        """Save the file model and return the model with no content."""
+        if model.get('type') != 'notebook':
+            self._check_not_section(path, 'save a %s as' % model.get('type'))
+        return super(NotedownContentsManager, self).save(model, path)
+
+    def new(self, model=None, path=''):
+        """Create a new file or directory and return its model with no
+        content."""
+        self._check_not_section(path, 'create')
+        return super(NotedownContentsManager, self).new(model, path)
+
+    def delete_file(self, path):
+        """Delete file at path."""
+        self._check_not_section(path, 'delete')
+        return super(NotedownContentsManager, self).delete_file(path)
+
+    def rename_file(self, old_path, new_path):
+        """Rename a file."""
+        self._check_not_section(old_path, 'rename')
+        self._check_not_section(new_path, 'rename to')
+        return super(NotedownContentsManager, self).rename_file(old_path,
+                                                                new_path)
 
     def get(self, path, content=True, type=None, format=None):
         """ Takes a path for an entity and returns its model
@@ -100,7 +377,9 @@ class NotedownContentsManager(FileContentsManager):
                                     reason='bad type')
             model = self._dir_model(path, content=content)
 
-        elif type == 'notebook' or (type is None and path.endswith(extension)):
+        elif (type == 'notebook'
+              or (type is None and path.endswith(extension))
+              or self._split_section(path)[1] is not None):
             model = self._notebook_model(path, content=content)
         else:
             if type == 'directory':
@@ -4,18 +4,39 @@ from __future__ import print_function
 import os
 import sys
 import argparse
+import functools
 import pkg_resources
 import io
+import json
 import logging
+import multiprocessing
+import threading
+
+import six
 
-import nbformat as nbformat
 from nbconvert.utils.io import unicode_std_stream
 
-from .notedown import (MarkdownReader,
+from .notedown import (cast_unicode,
+                       CellSelector,
+                       default_template_cache,
+                       ExecutionProgress,
+                       MarkdownReader,
                        MarkdownWriter,
                        Knitr,
+                       NotebookFormat,
+                       OutputsFile,
+                       open_text,
+                       read_stripped,
                        run,
-                       strip)
+                       same_contents,
+                       split_compression,
+                       stats_summary,
+                       strip,
+                       strip_markdown,
+                       notebook_stats,
+                       timing_report,
+                       timing_summary,
+                       user_cache_dir)
 
 
 try:
@@ -62,6 +83,11 @@ Convert from markdown and execute:
     notedown input.md --run > executed_notebook.ipynb
 
 
+Execute, resuming from where the last run died if it did:
+
+    notedown input.md --run --resume > executed_notebook.ipynb
+
+
 Convert r-markdown into markdown:
 
     notedown input.Rmd --to markdown --knit > output.md
@@ -76,23 +102,50 @@ Convert r-markdown into a notebook with the outputs computed, using
 the rmagic extension to execute the code blocks:
 
     notedown input.Rmd --knit --rmagic --run > executed_output.ipynb
+
+
+Serve conversions to editors and build tools, without starting
+notedown for each one (see notedown serve --help):
+
+    notedown serve --port 8765
+
+    curl --data-binary @input.md 'http://localhost:8765/convert?to=notebook'
+
+
+Convert many documents given as json lines, writing json lines:
+
+    generate_docs | notedown --batch-jsonl --to markdown > results.jsonl
+
+
+Find the cells that make the notebooks in a directory slow to open:
+
+    notedown notebooks/ --stats
 """
 
 
-def convert(content, informat, outformat, strip_outputs=False):
+def convert(content, informat, outformat, strip_outputs=False,
+            validate=True, **reader_options):
+    """Convert content (a filename or string) from informat to
+    outformat. Additional keyword arguments are passed to the
+    MarkdownReader, e.g. the parse limits max_size and time_budget.
+
+    validate is True, False or 'lazy' (see validate_notebook).
+    """
     if os.path.exists(content):
-        with io.open(content, 'r', encoding='utf-8') as f:
+        with open_text(content) as f:
             contents = f.read()
     else:
         contents = content
 
-    readers = {'notebook': nbformat,
+    readers = {'notebook': NotebookFormat(validate),
                'markdown': MarkdownReader(precode='',
                                           magic=False,
-                                          match='fenced')
+                                          match='fenced',
+                                          validate=validate,
+                                          **reader_options)
                }
 
-    writers = {'notebook': nbformat,
+    writers = {'notebook': NotebookFormat(validate),
                'markdown': MarkdownWriter(markdown_template,
                                           strip_outputs=strip_outputs)
                }
@@ -104,10 +157,94 @@ def convert(content, informat, outformat, strip_outputs=False):
     return writer.writes(notebook)
 
 
-def ftdetect(filename):
+class Converter(object):
+    """Convert documents with the same options as the command line,
+    keeping the readers and writers to use again for the next
+    conversion with the same options.
+
+    Readers and writers keep no state between conversions, so one
+    Converter can be shared by many threads.
+    """
+    # most clients use a few combinations of options
+    max_instances = 32
+
+    def __init__(self, validate=True):
+        self.validate = validate
+        self.readers = {}
+        self.writers = {}
+        self.lock = threading.Lock()
+
+    def reader(self, informat, precode='', magic=True, match='all',
+               render=False):
+        if informat == 'notebook':
+            key = (informat,)
+        elif informat == 'markdown':
+            key = (informat, precode, magic, match, render)
+        else:
+            raise ValueError("Unknown format {!r}".format(informat))
+        with self.lock:
+            if key not in self.readers:
+                if len(self.readers) >= self.max_instances:
+                    self.readers.clear()
+                if informat == 'notebook':
+                    reader = NotebookFormat(self.validate)
+                else:
+                    reader = MarkdownReader(precode=precode,
+                                            magic=magic,
+                                            match=match,
+                                            caption_comments=render,
+                                            validate=self.validate)
+                self.readers[key] = reader
+            return self.readers[key]
+
+    def writer(self, outformat, template=None, strip_outputs=False):
+        if outformat == 'notebook':
+            key = (outformat,)
+        elif outformat == 'markdown':
+            key = (outformat, template, strip_outputs)
+        else:
+            raise ValueError("Unknown format {!r}".format(outformat))
+        with self.lock:
+            if key not in self.writers:
+                if len(self.writers) >= self.max_instances:
+                    self.writers.clear()
+                if outformat == 'notebook':
+                    writer = NotebookFormat(self.validate)
+                else:
+                    writer = MarkdownWriter(template,
+                                            strip_outputs=strip_outputs)
+                self.writers[key] = writer
+            return self.writers[key]
+
+    def convert(self, content, informat='markdown', outformat='notebook',
+                strip_outputs=False, precode=(), magic=True, match='all',
+                render=False, template=None):
+        """Convert the string content from informat to outformat."""
+        if render:
+            outformat = 'markdown'
+            template = template or markdown_figure_template
+        template = template or markdown_template
+
+        reader = self.reader(informat, precode='\n'.join(precode),
+                             magic=magic, match=match, render=render)
+        writer = self.writer(outformat, template=template,
+                             strip_outputs=strip_outputs)
+
+        notebook = reader.reads(content, as_version=4)
+        if strip_outputs:
+            strip(notebook)
+        return writer.writes(notebook)
+
+
+def ftdetect(filename, compressed=False):
     """Determine if filename is markdown or notebook,
-    based on the file extension.
+    based on the file extension. If compressed, a compression
+    extension is ignored (e.g. notebook.ipynb.gz is a notebook),
+    otherwise compressed files are neither.
     """
+    filename, compression = split_compression(filename)
+    if compression and not compressed:
+        return None
     _, extension = os.path.splitext(filename)
     md_exts = ['.md', '.markdown', '.mkd', '.mdown', '.mkdn', '.Rmd']
     nb_exts = ['.ipynb']
@@ -119,6 +256,50 @@ def ftdetect(filename):
         return None
 
 
+def split_list(string):
+    """Split a comma separated string into a list."""
+    if not string:
+        return []
+    return [item.strip() for item in string.split(',') if item.strip()]
+
+
+def batch_convert(lines, converter, **defaults):
+    """Convert the json requests in lines, one per line, yielding a
+    json result for each in the same order.
+
+    Each request is an object holding the document as 'content' and
+    optionally an 'id' and the options 'from', 'to', 'strip', 'match',
+    'precode', 'magic', 'render' and 'template', which take the values
+    in defaults if they aren't given (see Converter.convert). The
+    result holds the id of the request and either the converted
+    document as 'output' or the reason it couldn't be converted as
+    'error'.
+    """
+    names = {'from': 'informat', 'to': 'outformat', 'strip': 'strip_outputs',
+             'match': 'match', 'precode': 'precode', 'magic': 'magic',
+             'render': 'render', 'template': 'template'}
+    for line in lines:
+        if not line.strip():
+            continue
+        result = {'id': None}
+        try:
+            request = json.loads(line)
+            result['id'] = request.get('id')
+            options = dict(defaults)
+            for name, value in request.items():
+                if name in names:
+                    options[names[name]] = value
+                elif name not in ('id', 'content'):
+                    raise ValueError("Unknown option {!r}".format(name))
+            if isinstance(options.get('precode'), six.string_types):
+                options['precode'] = [options['precode']]
+            result['output'] = converter.convert(request['content'],
+                                                 **options)
+        except Exception as e:
+            result['error'] = u'{!r}'.format(e)
+        yield json.dumps(result, sort_keys=True)
+
+
 def command_line_parser():
     """Create parser for command line usage."""
     description = "Create an IPython notebook from markdown."
@@ -158,10 +339,88 @@ def command_line_parser():
                         default=30,
                         type=int,
                         help=("set the cell execution timeout (in seconds)"))
+    parser.add_argument('--only',
+                        metavar='CLASSES',
+                        help=("only run the cells with one of these "
+                              "comma separated classes or languages, "
+                              "e.g. --only setup,bash (with --run)"))
+    parser.add_argument('--skip',
+                        metavar='CLASSES',
+                        help=("don't run the cells with any of these "
+                              "comma separated classes or languages, "
+                              "e.g. --skip slow (with --run)"))
+    parser.add_argument('--cells',
+                        metavar='RANGES',
+                        help=("only run the cells in these ranges, "
+                              "e.g. --cells 3:10,12 (with --run). Cells "
+                              "are counted from 0, including markdown. "
+                              "Cells that aren't run keep their outputs"))
+    parser.add_argument('--timing',
+                        action='store_true',
+                        help=("record how long each cell takes to run in "
+                              "the cell metadata and print the slowest "
+                              "cells (with --run)"))
+    parser.add_argument('--timing-report',
+                        metavar='FILE',
+                        help=("write a json report of the time each cell "
+                              "takes to run to FILE (with --run)"))
+    parser.add_argument('--progress',
+                        metavar='FILE',
+                        help=("record each cell in FILE as soon as it has "
+                              "run, so that the run can be resumed with "
+                              "--resume if it dies (with --run). "
+                              "Removed when the run finishes"))
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help=("resume a run that died, giving the cells "
+                              "recorded in the --progress file (default "
+                              "INPUT_FILE.progress) their outputs and "
+                              "running the rest (with --run)"))
+    parser.add_argument('--replay',
+                        metavar='CLASSES',
+                        help=("when resuming, only run again the cells "
+                              "that have already run with one of these "
+                              "comma separated classes or languages, "
+                              "e.g. --replay setup, to rebuild the state "
+                              "of the kernel (default all of them)"))
+    parser.add_argument('--kernel-memory',
+                        action='store_true',
+                        help=("record the peak memory use of the kernel "
+                              "while each cell runs (with --run, "
+                              "Linux only)"))
+    parser.add_argument('--compress-level',
+                        type=int,
+                        metavar='N',
+                        help=("compression level of .gz (1-9, default 6) "
+                              "or .zst (1-22, default 3) outputs"))
+    unchanged = parser.add_mutually_exclusive_group()
+    unchanged.add_argument('--skip-unchanged',
+                           action='store_const',
+                           dest='skip_unchanged',
+                           const=True,
+                           help=("don't rewrite the output file if it "
+                                 "already holds the output, keeping its "
+                                 "modification time. The default when "
+                                 "overwriting with -o and no filename"))
+    unchanged.add_argument('--always-write',
+                           action='store_const',
+                           dest='skip_unchanged',
+                           const=False,
+                           help=("always rewrite the output file"))
     parser.add_argument('--strip',
                         action='store_true',
                         dest='strip_outputs',
                         help=("strip output cells"))
+    parser.add_argument('--outputs-file',
+                        nargs='?',
+                        metavar='FILE',
+                        const='',
+                        help=("when writing markdown, put the cell outputs "
+                              "in a json file, FILE or the output name "
+                              "with .outputs.json, leaving references to "
+                              "them in the markdown. Markdown with "
+                              "references reads the outputs from the "
+                              "file beside it"))
     parser.add_argument('--precode',
                         nargs='+',
                         default=[],
@@ -175,6 +434,20 @@ def command_line_parser():
                               "but you can change this by passing a string. "
                               "Requires R in your path and knitr installed."),
                         const='eval=FALSE')
+    parser.add_argument('--knit-cache',
+                        nargs='?',
+                        metavar='DIR',
+                        const=user_cache_dir('knitr'),
+                        help=("reuse knitr output if the input, chunk options "
+                              "and R and knitr versions haven't changed, "
+                              "caching it in DIR (default {})"
+                              .format(user_cache_dir('knitr'))))
+    parser.add_argument('--knit-cache-size',
+                        default=256,
+                        type=int,
+                        metavar='MB',
+                        help=("size of the knitr cache, evicting the least "
+                              "recently used output beyond it (default 256)"))
     parser.add_argument('--rmagic',
                         action='store_true',
                         help=("autoload the rmagic extension. Synonym for "
@@ -194,6 +467,46 @@ def command_line_parser():
                               "converted into code cells. "
                               "choose from 'all' (default), 'fenced', "
                               "'strict' or a specific language to match on"))
+    parser.add_argument('--batch-jsonl',
+                        action='store_true',
+                        help=("convert many documents in one process: read "
+                              "json requests, one per line, from STDIN and "
+                              "write a json result for each to STDOUT. "
+                              "Each request holds the document as 'content', "
+                              "an optional 'id' and options that override "
+                              "--from, --to, --strip, --match, --precode, "
+                              "--nomagic, --render and --template"))
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help=("instead of converting, report the size of "
+                              "the sources, outputs and images of the "
+                              "cells of the input, which may be a "
+                              "directory, and the cells that are slowest "
+                              "to parse and render"))
+    parser.add_argument('--stats-report',
+                        metavar='FILE',
+                        help=("write a json report of the size of each "
+                              "cell to FILE, or - for STDOUT (see --stats)"))
+    parser.add_argument('--jobs', '-j',
+                        default=1,
+                        type=int,
+                        help=("number of processes to parse large markdown "
+                              "inputs (or the files of a directory with "
+                              "--stats) with, or 0 for one per cpu"))
+    validation = parser.add_mutually_exclusive_group()
+    validation.add_argument('--no-validate',
+                            action='store_const',
+                            dest='validate',
+                            const=False,
+                            default=True,
+                            help=("don't validate notebooks against the "
+                                  "notebook format schema"))
+    validation.add_argument('--lazy-validate',
+                            action='store_const',
+                            dest='validate',
+                            const='lazy',
+                            help=("validate notebooks in the background, "
+                                  "logging any errors"))
     parser.add_argument('--examples',
                         help=('show example usage'),
                         action='store_true')
@@ -219,6 +532,12 @@ def main(args, help=''):
         print(examples)
         sys.exit()
 
+    if args.batch_jsonl:
+        return batch_main(args)
+
+    if args.stats or args.stats_report:
+        return stats_main(args)
+
     # if no stdin and no input file
     if args.input_file == '-' and sys.stdin.isatty():
         sys.stdout.write(help)
@@ -228,14 +547,15 @@ def main(args, help=''):
         input_file = sys.stdin
 
     elif args.input_file != '-':
-        input_file = io.open(args.input_file, 'r', encoding='utf-8')
+        input_file = open_text(args.input_file)
 
     else:
         sys.exit('malformed input')
 
     # pre-process markdown by using knitr on it
     if args.knit:
-        knitr = Knitr()
+        knitr = Knitr(cache_dir=args.knit_cache,
+                      max_cache_size=args.knit_cache_size * 2 ** 20)
         input_file = knitr.knit(input_file, opts_chunk=args.knit)
 
     if args.rmagic:
@@ -250,20 +570,28 @@ def main(args, help=''):
 
     # reader and writer classes with args and kwargs to
     # instantiate with
-    readers = {'notebook': nbformat,
+    readers = {'notebook': NotebookFormat(args.validate),
                'markdown': MarkdownReader(precode='\n'.join(args.precode),
                                           magic=args.magic,
                                           match=args.match,
-                                          caption_comments=args.render)
+                                          caption_comments=args.render,
+                                          validate=args.validate,
+                                          jobs=args.jobs)
                }
 
-    writers = {'notebook': nbformat,
+    writers = {'notebook': NotebookFormat(args.validate),
                'markdown': MarkdownWriter(template_file,
-                                          strip_outputs=args.strip_outputs)
+                                          strip_outputs=args.strip_outputs,
+                                          template_cache=(
+                                              default_template_cache()))
                }
 
-    informat = args.informat or ftdetect(input_file.name) or 'markdown'
-    outformat = args.outformat or ftdetect(args.output) or 'notebook'
+    informat = (args.informat
+                or ftdetect(getattr(input_file, 'name', args.input_file),
+                            compressed=True)
+                or 'markdown')
+    outformat = (args.outformat or ftdetect(args.output, compressed=True)
+                 or 'notebook')
 
     if args.render:
         outformat = 'markdown'
@@ -271,26 +599,91 @@ def main(args, help=''):
     reader = readers[informat]
     writer = writers[outformat]
 
+    # the converted document, if it is made without a notebook
+    output = None
+
     with input_file as ip:
-        notebook = reader.read(ip, as_version=4)
+        if args.strip_outputs and informat == 'notebook' and not args.run:
+            # fast path that doesn't load the outputs
+            notebook = read_stripped(ip, as_version=4,
+                                     validate=args.validate)
+        elif (args.strip_outputs and informat == outformat == 'markdown'
+              and not args.run and template_file == markdown_template
+              and args.outputs_file is None):
+            # fast path that removes the outputs from the text
+            notebook = None
+            output = strip_markdown(ip.read(), reader)
+        else:
+            notebook = reader.read(ip, as_version=4)
 
     if args.run:
-        run(notebook, timeout=args.timeout)
-
-    if args.strip_outputs:
+        timing = args.timing or args.timing_report or args.kernel_memory
+        if args.only or args.skip or args.cells:
+            select = CellSelector(include=split_list(args.only),
+                                  exclude=split_list(args.skip),
+                                  cells=args.cells)
+        else:
+            select = None
+        progress_file = args.progress
+        if args.resume and not progress_file:
+            if args.input_file == '-':
+                sys.exit('Give --progress a filename to resume from stdin.')
+            progress_file = args.input_file + '.progress'
+        replay = CellSelector(include=split_list(args.replay)) \
+            if args.replay else None
+        run(notebook, timeout=args.timeout, timing=timing,
+            kernel_memory=args.kernel_memory, select=select,
+            progress=(ExecutionProgress(progress_file) if progress_file
+                      else None),
+            resume=args.resume, replay=replay)
+        if timing:
+            sys.stderr.write(timing_summary(notebook))
+        if args.timing_report:
+            report = timing_report(notebook,
+                                   input_file=args.input_file,
+                                   version=__version__)
+            with io.open(args.timing_report, 'w', encoding='utf-8') as f:
+                f.write(cast_unicode(json.dumps(report, indent=1,
+                                                sort_keys=True)))
+
+    if args.strip_outputs and notebook is not None:
         strip(notebook)
 
     output_ext = {'markdown': '.md',
                   'notebook': '.ipynb'}
 
+    # by default, leave the file alone when syncing it with the input
+    skip_unchanged = args.skip_unchanged
+    if skip_unchanged is None:
+        skip_unchanged = not args.output
+    written = []
+
+    if not args.output and args.input_file != '-':
+        # compressed like the input
+        name, compression = split_compression(args.input_file)
+        destination = (os.path.splitext(name)[0] + output_ext[outformat]
+                       + compression)
+    else:
+        destination = args.output
+
+    write_options = {}
+    if args.outputs_file is not None and outformat == 'markdown':
+        if args.outputs_file:
+            write_options['outputs_file'] = args.outputs_file
+        elif destination and destination != '-':
+            write_options['outputs_file'] = OutputsFile.path(destination)
+        else:
+            sys.exit('Give --outputs-file a filename when writing to stdout.')
+
     if not args.output and args.input_file != '-':
         # overwrite
-        fout = os.path.splitext(args.input_file)[0] + output_ext[outformat]
+        fout = destination
         # grab the output here so we don't obliterate the file if
         # there is an error
-        output = writer.writes(notebook)
-        with io.open(fout, 'w', encoding='utf-8') as op:
-            op.write(output)
+        if output is None:
+            output = render_output(writer, notebook, **write_options)
+        written.append(write_output(fout, output, skip_unchanged,
+                                    args.compress_level))
 
     elif not args.output and args.input_file == '-':
         # overwrite error (input is stdin)
@@ -298,15 +691,159 @@ def main(args, help=''):
 
     elif args.output == '-':
         # write stdout
-        writer.write(notebook, unicode_std_stream('stdout'))
+        stdout = unicode_std_stream('stdout')
+        if output is None:
+            writer.write(notebook, stdout, **write_options)
+        else:
+            stdout.write(output)
+
+    elif args.output != '-' and skip_unchanged:
+        if output is None:
+            output = render_output(writer, notebook, **write_options)
+        written.append(write_output(args.output, output, skip_unchanged,
+                                    args.compress_level))
 
     elif args.output != '-':
         # write to filename
-        with io.open(args.output, 'w', encoding='utf-8') as op:
-            writer.write(notebook, op)
+        with open_text(args.output, 'w', args.compress_level) as op:
+            if output is None:
+                writer.write(notebook, op, **write_options)
+            else:
+                op.write(output)
+
+    if skip_unchanged and written:
+        sys.stderr.write("notedown: {} written, {} unchanged\n"
+                         .format(written.count(True), written.count(False)))
+
+
+def render_output(writer, notebook, outputs_file=None):
+    """The notebook written to a string by writer. With outputs_file
+    (markdown writers only), the outputs are written there and the
+    markdown refers to them."""
+    if outputs_file is None:
+        return writer.writes(notebook)
+    output, resources = writer.export(notebook, outputs_file)
+    writer.write_outputs_file(outputs_file, resources)
+    return output
+
+
+def write_output(filename, output, skip_unchanged=False, level=None):
+    """Write the string output to filename, compressed with level if
+    it has a compression extension, unless skip_unchanged and the file
+    already holds it. Returns whether the file was written."""
+    if skip_unchanged and same_contents(filename, output):
+        logging.debug("%s is unchanged", filename)
+        return False
+    with open_text(filename, 'w', level) as op:
+        op.write(output)
+    return True
+
+
+def batch_main(args):
+    """Convert json requests from stdin (see batch_convert)."""
+    precode = list(args.precode)
+    if args.rmagic:
+        precode.append(r"%load_ext rpy2.ipython")
+    converter = Converter(validate=args.validate)
+    results = batch_convert(io.open(sys.stdin.fileno(), 'r',
+                                    encoding='utf-8', closefd=False),
+                            converter,
+                            informat=args.informat or 'markdown',
+                            outformat=args.outformat or 'notebook',
+                            strip_outputs=args.strip_outputs,
+                            match=args.match,
+                            precode=precode,
+                            magic=args.magic,
+                            render=args.render,
+                            template=args.template)
+    stdout = unicode_std_stream('stdout')
+    for result in results:
+        stdout.write(cast_unicode(result) + u'\n')
+        # the caller may be waiting for this result to send the next
+        stdout.flush()
+
+
+def notebook_files(directory):
+    """The markdown and notebook files in directory and its
+    subdirectories, leaving out hidden ones (e.g. checkpoints)."""
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if not name.startswith('.') and ftdetect(name, compressed=True):
+                yield os.path.join(root, name)
+
+
+def file_stats(filename, informat=None, **reader_options):
+    """notebook_stats of the notebook in filename (or - for STDIN),
+    or the error that stopped it being read."""
+    try:
+        if filename == '-':
+            text = sys.stdin.read()
+        else:
+            with open_text(filename) as fp:
+                text = fp.read()
+        informat = informat or ftdetect(filename, compressed=True) or \
+            ('notebook' if text.lstrip().startswith('{') else 'markdown')
+        if informat == 'notebook':
+            notebook = NotebookFormat(validate=False).reads(text)
+        else:
+            reader = MarkdownReader(validate=False, **reader_options)
+            outputs_file = None
+            if filename != '-':
+                outputs_file = OutputsFile.path(filename)
+            notebook = reader.reads(text, outputs_file=outputs_file)
+    except Exception as e:
+        return {'filename': filename, 'error': u'{!r}'.format(e)}
+    return notebook_stats(notebook, filename=filename, format=informat)
+
+
+def stats_main(args):
+    """Report the stats of the input file, or of the files in the
+    input directory, in parallel with args.jobs processes."""
+    if os.path.isdir(args.input_file):
+        filenames = list(notebook_files(args.input_file))
+    else:
+        filenames = [args.input_file]
+    stats = functools.partial(file_stats,
+                              informat=args.informat,
+                              match=args.match,
+                              magic=args.magic)
+
+    if args.jobs != 1 and len(filenames) > 1:
+        pool = multiprocessing.Pool(args.jobs or None)
+        try:
+            reports = pool.map(stats, filenames)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        reports = [stats(filename) for filename in filenames]
+
+    reports.sort(key=lambda r: -(r['totals']['parse_cost']
+                                 + r['totals']['render_cost'])
+                 if 'totals' in r else 0)
+
+    stdout = unicode_std_stream('stdout')
+    if args.stats:
+        for report in reports:
+            if 'error' in report:
+                stdout.write(u'{}: {}\n'.format(report['filename'],
+                                                report['error']))
+            else:
+                stdout.write(cast_unicode(stats_summary(report)))
+    if args.stats_report == '-':
+        stdout.write(cast_unicode(json.dumps(reports, indent=1,
+                                             sort_keys=True)) + u'\n')
+    elif args.stats_report:
+        with io.open(args.stats_report, 'w', encoding='utf-8') as f:
+            f.write(cast_unicode(json.dumps(reports, indent=1,
+                                            sort_keys=True)))
 
 
 def app():
+    if sys.argv[1:2] == ['serve']:
+        from .server import app as serve
+        return serve(sys.argv[2:])
     parser = command_line_parser()
     args = parser.parse_args()
     main(args, help=parser.format_help())
@@ -1,17 +1,33 @@
 from __future__ import absolute_import
 
+import array
+import bisect
+import contextlib
+import datetime
+import gc
+import gzip
+import hashlib
+import io
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import re
+import signal
 import subprocess
 import tempfile
+import threading
+import time
 
 from six import PY3
-from six.moves import map
+from six import string_types
 from six.moves import range
 from six.moves import zip
 
+from multiprocessing.reduction import ForkingPickler
+
+import nbformat
 import nbformat.v4.nbbase as nbbase
 import nbformat.v4 as v4
 
@@ -19,14 +35,22 @@ from nbformat.v4.rwbase import NotebookReader
 from nbformat.v4.rwbase import NotebookWriter
 from nbformat.v4.nbjson import BytesEncoder
 
+import jinja2
+import nbconvert
+
 from nbconvert.preprocessors.execute import ExecutePreprocessor
 
 from nbconvert import TemplateExporter
 
 from pandocattributes import PandocAttributes
 
+from traitlets import Bool
+
 languages = ['python', 'r', 'ruby', 'bash']
 
+# jinja2 3 renamed contextfilter to pass_context
+pass_context = getattr(jinja2, 'pass_context', None) or jinja2.contextfilter
+
 
 def cast_unicode(s, encoding='utf-8'):
     """Python 2/3 compatibility function derived from IPython py3compat."""
@@ -43,14 +67,1157 @@ def strip(notebook):
             cell.execution_count = None
 
 
-def run(notebook, timeout=30):
-    executor = ExecutePreprocessor(timeout=timeout)
-    notebook, resources = executor.preprocess(notebook, resources={})
+def validate_notebook(notebook, validate=True):
+    """Validate notebook against the nbformat schema.
+
+    validate is one of
+
+        True   - validate now, raising a ValidationError if the
+                 notebook is invalid
+        False  - don't validate
+        'lazy' - validate a snapshot of the notebook in a background
+                 thread and log any error. Returns the thread.
+    """
+    if validate == 'lazy':
+        # snapshot, as the notebook may change while we validate
+        snapshot = json.dumps(notebook, cls=BytesEncoder)
+        thread = threading.Thread(target=_validate_json, args=(snapshot,),
+                                  name='notedown-validate')
+        thread.start()
+        return thread
+    elif validate:
+        nbformat.validate(notebook)
+
+
+def _validate_json(snapshot):
+    notebook = nbformat.from_dict(json.loads(snapshot))
+    try:
+        nbformat.validate(notebook)
+    except nbformat.ValidationError as e:
+        logging.error("Notebook JSON is invalid: %s", e)
+
+
+class NotebookFormat(object):
+    """Reader and writer for the notebook (.ipynb) format, as the
+    nbformat module, with a choice of validation.
+
+    validate is True (validate as nbformat does), False or 'lazy'
+    (see validate_notebook). Unless it is True, notebooks are not
+    validated when written.
+    """
+    def __init__(self, validate=True):
+        self.validate = validate
+
+    def reads(self, s, as_version=4):
+        """Read string s to notebook. Returns a notebook."""
+        if self.validate is True:
+            return nbformat.reads(s, as_version=as_version)
+        notebook = nbformat.reader.reads(s)
+        if as_version is not nbformat.NO_CONVERT:
+            notebook = nbformat.convert(notebook, as_version)
+        validate_notebook(notebook, self.validate)
+        return notebook
+
+    def read(self, fp, as_version=4):
+        return self.reads(fp.read(), as_version=as_version)
+
+    def writes(self, notebook, version=nbformat.NO_CONVERT):
+        """Write notebook to a JSON string."""
+        if self.validate is True:
+            return nbformat.writes(notebook, version=version)
+        if version is not nbformat.NO_CONVERT:
+            notebook = nbformat.convert(notebook, version)
+        else:
+            version, _ = nbformat.reader.get_version(notebook)
+        return nbformat.versions[version].writes_json(notebook)
+
+    def write(self, notebook, fp, version=nbformat.NO_CONVERT):
+        s = cast_unicode(self.writes(notebook, version=version), 'utf-8')
+        fp.write(s)
+        if not s.endswith(u'\n'):
+            fp.write(u'\n')
+
+
+def read_stripped(fp, as_version=4, validate=True):
+    """Read a notebook from the file object fp with the outputs
+    removed, skipping over the outputs in the JSON rather than loading
+    them, so that memory use doesn't depend on the size of the outputs.
+
+    Gives the same notebook as
+
+        notebook = nbformat.read(fp, as_version=as_version)
+        strip(notebook)
+
+    validate is as for NotebookFormat.
+    """
+    def policy(path):
+        if not path or path[-1] in ('cells', 'worksheets'):
+            return 'descend'
+        elif len(path) >= 2 and path[-2] in ('cells', 'worksheets'):
+            return 'descend'
+        elif len(path) >= 3 and path[-3] == 'cells' \
+                and path[-1] == 'outputs':
+            return 'skip'
+
+    stream = JSONStream(fp)
+    nb_dict = stream.load(policy)
+    for path, _ in stream.skipped:
+        parent = nb_dict
+        for key in path[:-1]:
+            parent = parent[key]
+        parent[path[-1]] = []
+
+    reader = NotebookFormat(validate=validate)
+    notebook = reader.reads(json.dumps(nb_dict), as_version=as_version)
+    strip(notebook)
+    return notebook
+
+
+# wraps markdown cells as the markdown template does
+_wordwrap_environment = jinja2.Environment()
+
+
+def wordwrap(text, width=80):
+    """text wrapped as by the jinja filter wordwrap(width, False)."""
+    def wrap(text):
+        return jinja2.filters.do_wordwrap(_wordwrap_environment, text,
+                                          width, False)
+
+    if int(jinja2.__version__.split('.')[0]) < 3:
+        return wrap(text)
+    # jinja 3 wraps each line on its own, and a line that fits without
+    # trailing whitespace is left as it is
+    return '\n'.join(line if len(line) <= width and not line[-1:].isspace()
+                     else wrap(line) for line in text.splitlines())
+
+
+def strip_markdown(text, reader=None):
+    """Remove the outputs from the markdown text, working on the text
+    rather than creating a notebook and never decoding the outputs.
+
+    Gives the same markdown as
+
+        notebook = reader.reads(text)
+        strip(notebook)
+        text = MarkdownWriter(markdown_template).writes(notebook)
+
+    with reader a MarkdownReader (default MarkdownReader()), except
+    that outputs that aren't valid JSON, or that refer to an outputs
+    file, are removed without being read.
+    """
+    reader = reader or MarkdownReader()
+    blocks = reader.parse_blocks(text)
+    pre_code_block = reader.pre_code_block
+    if pre_code_block['content']:
+        blocks.insert(0, pre_code_block)
+
+    cells = []
+    last = None
+    for block in blocks:
+        block = reader.process_code_block(block)
+        if block['type'] == reader.code and block['IO'] == 'input':
+            cells.append('```python\n{}\n```\n'.format(block['content']))
+
+        elif (block['type'] == reader.code and
+              block['IO'] == 'output' and
+              last == reader.code):
+            # the outputs of the code cell before
+            continue
+
+        elif block['type'] == reader.markdown:
+            cells.append(wordwrap(block['content']) + '\n')
+
+        else:
+            raise NotImplementedError("{} is not supported as a cell"
+                                      "type".format(block['type']))
+        last = block['type']
+
+    # as MarkdownWriter.export
+    return re.sub(r'\A\s*\n|^\s*\Z', '', '\n'.join(cells))
+
+
+class JSONStream(object):
+    """Incremental reader of a JSON document from a file object.
+
+    load(policy) reads the document. policy is called with the path
+    (a tuple of object keys and array indices) of each value that is
+    found while descending the document and returns one of
+
+        'descend' - read an object or array item by item
+        'skip'    - skip over the value without decoding it
+        None      - decode the value
+
+    Skipped values are left out of their parent and recorded, with
+    their size in characters, in self.skipped as (path, size).
+
+    Only the values that are decoded and a chunk of the input are
+    held in memory at any time.
+    """
+    whitespace = re.compile(r'[ \t\n\r]*')
+    # characters outside of a string that don't change the nesting
+    plain_chars = re.compile(r'[^"\[\]{}]*')
+    # characters inside a string that don't end it
+    string_chars = re.compile(r'[^"\\]*')
+    # a number or true, false, null
+    scalar_chars = re.compile(r'[^,\]}\s]*')
+
+    def __init__(self, fp, chunk_size=2 ** 16, buffer=''):
+        """buffer - input already read from fp"""
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buffer = buffer
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self.skipped = []
+
+    def fill(self, size=None):
+        """Read more of the input into the buffer, discarding what
+        has already been read. Returns False at the end of input."""
+        if self.eof:
+            return False
+        chunk = self.fp.read(size or self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def peek(self):
+        """Skip whitespace and return the next character ('' at the
+        end of the input)."""
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of {!r} at {!r}"
+                             .format(chars, self.buffer[self.pos:][:20]))
+        self.pos += 1
+        return char
+
+    def load(self, policy=None, path=()):
+        """Read the next value in the input."""
+        action = policy(path) if policy else None
+        char = self.peek()
+        if action == 'descend' and char == '{':
+            self.pos += 1
+            value = {}
+            if self.peek() == '}':
+                self.pos += 1
+                return value
+            while True:
+                key = self.decode()
+                self.expect(':')
+                self._load_item(value, key, policy, path + (key,))
+                if self.expect(',}') == '}':
+                    return value
+
+        elif action == 'descend' and char == '[':
+            self.pos += 1
+            value = []
+            if self.peek() == ']':
+                self.pos += 1
+                return value
+            for index in itertools.count():
+                self._load_item(value, None, policy, path + (index,))
+                if self.expect(',]') == ']':
+                    return value
+
+        else:
+            return self.decode()
+
+    def _load_item(self, container, key, policy, path):
+        if policy(path) == 'skip':
+            self.skipped.append((path, self.skip()))
+        elif key is None:
+            container.append(self.load(policy, path))
+        else:
+            container[key] = self.load(policy, path)
+
+    def decode(self):
+        """Decode the next value in the input."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                end = None
+            # a value that runs to the end of the buffer (e.g. a number)
+            # might continue in the input
+            if end is not None and (end < len(self.buffer) or self.eof):
+                self.pos = end
+                return value
+            if not self.fill(max(self.chunk_size, len(self.buffer))):
+                if end is None:
+                    # raise the decoding error
+                    self.decoder.raw_decode(self.buffer, self.pos)
+                self.pos = end
+                return value
+
+    def skip(self):
+        """Skip over the next value in the input without decoding it.
+        Returns the size of the value in characters."""
+        char = self.peek()
+        size = 0
+        depth = 0
+        in_string = False
+        pattern = self.scalar_chars
+        if char in '[{"':
+            pattern = self.plain_chars
+
+        while True:
+            start = self.pos
+            self.pos = pattern.match(self.buffer, self.pos).end()
+            size += self.pos - start
+            if self.pos == len(self.buffer):
+                if self.fill():
+                    continue
+                elif pattern is self.scalar_chars:
+                    return size
+                raise ValueError("Unexpected end of JSON input")
+
+            if pattern is self.scalar_chars:
+                return size
+
+            char = self.buffer[self.pos]
+            if in_string and char == '\\':
+                # skip the escaped character as well
+                if self.pos + 1 == len(self.buffer) and not self.fill():
+                    raise ValueError("Unexpected end of JSON input")
+                self.pos += 2
+                size += 2
+                continue
+
+            self.pos += 1
+            size += 1
+            if char == '"':
+                in_string = not in_string
+                pattern = self.string_chars if in_string else self.plain_chars
+            elif char in '[{':
+                depth += 1
+            elif char in ']}':
+                depth -= 1
+
+            if depth == 0 and not in_string:
+                return size
+
+
+@contextlib.contextmanager
+def time_limit(seconds, exception):
+    """Raise exception if the body of the with statement takes longer
+    than seconds to run.
+
+    An interval timer is used, which also interrupts long running
+    regular expression searches. This only works in the main thread
+    on platforms that have SIGALRM; elsewhere nothing is enforced.
+    """
+    def handler(signum, frame):
+        raise exception
+
+    if not seconds:
+        yield
+        return
+
+    try:
+        previous_handler = signal.signal(signal.SIGALRM, handler)
+    except (AttributeError, ValueError):
+        # no SIGALRM or not in the main thread
+        yield
+        return
+
+    start = time.time()
+    previous_timer, _ = signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if previous_timer:
+            # restart anybody else's timer
+            remaining = previous_timer - (time.time() - start)
+            signal.setitimer(signal.ITIMER_REAL, max(remaining, 1e-3))
+
+
+def run(notebook, timeout=30, timing=False, kernel_memory=False,
+        select=None, progress=None, resume=False, replay=None):
+    """Execute the notebook in place.
+
+    With timing, record how long each code cell took to run in its
+    metadata (see TimedExecutePreprocessor), with the peak memory use
+    of the kernel if kernel_memory.
+
+    select is a function select(cell, index) (e.g. a CellSelector)
+    that chooses the cells to run. The other cells are left as they
+    are, keeping any outputs they have.
+
+    progress is an ExecutionProgress to record each cell in as soon
+    as it has run, so that a run that dies part way through can be
+    resumed. It is removed when the run finishes. With resume, the
+    cells recorded in it by an earlier run are given their recorded
+    outputs rather than being run, except that the kernel is brought
+    back to the state the earlier run left it in by running them
+    again, or just those chosen by replay(cell, index), without
+    keeping their outputs.
+    """
+    if timing or kernel_memory:
+        executor = TimedExecutePreprocessor(timeout=timeout,
+                                            kernel_memory=kernel_memory)
+    else:
+        executor = ExecutePreprocessor(timeout=timeout)
+
+    if progress is None:
+        if select is not None:
+            # run a notebook of just the selected cells, which are the
+            # same cell objects, so they are updated in place
+            notebook = nbbase.NotebookNode(notebook)
+            notebook.cells = [cell for index, cell
+                              in enumerate(notebook.cells)
+                              if select(cell, index)]
+        executor.preprocess(notebook, resources={})
+        return
+
+    # recording each cell as it runs means stepping through the cells
+    # with the nbconvert 5 preprocessor api
+    if not hasattr(executor, 'setup_preprocessor'):
+        raise NotImplementedError("recording progress needs nbconvert<6")
+
+    done = progress.load(notebook) if resume else {}
+    if done:
+        logging.info("Resuming after %d cells that have run", len(done))
+
+    resources = {}
+    with executor.setup_preprocessor(notebook, resources), \
+            progress.recording(append=bool(done)) as record:
+        for index, cell in enumerate(notebook.cells):
+            if select is not None and not select(cell, index):
+                continue
+            if index in done:
+                if replay is None or replay(cell, index):
+                    executor.preprocess_cell(nbformat.from_dict(cell),
+                                             resources, index)
+                progress.restore(cell, done[index])
+                continue
+            executor.preprocess_cell(cell, resources, index)
+            record(index, cell)
+
+        notebook.metadata['language_info'] \
+            = kernel_language_info(executor.kc, timeout)
+        executor.set_widgets_metadata()
+
+    progress.remove()
+
+
+def kernel_language_info(client, timeout=30):
+    """Ask the kernel of the blocking client for its language_info."""
+    msg_id = client.kernel_info()
+    while True:
+        msg = client.get_shell_msg(timeout=timeout)
+        if msg['parent_header'].get('msg_id') == msg_id:
+            return msg['content']['language_info']
+
+
+class ExecutionProgress(object):
+    """The code cells of a notebook that have been run, recorded in a
+    file, one json line per cell as each finishes, so that a run that
+    dies part way through (a timeout, a kernel crash, a killed job)
+    can be resumed without losing the cells that had run.
+
+    Each line holds the index of the cell, the sha1 of its source and
+    its execution_count, outputs and any timing.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    @staticmethod
+    def source_sha1(cell):
+        return hashlib.sha1(cell.source.encode('utf-8')).hexdigest()
+
+    def load(self, notebook):
+        """The records of the cells of notebook that have run, by
+        index. Cells whose source has changed since aren't included,
+        nor is a line that was being written when the run died."""
+        done = {}
+        try:
+            f = io.open(self.filename, encoding='utf-8')
+        except IOError:
+            return done
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    cell = notebook.cells[record['index']]
+                except (ValueError, KeyError, IndexError, TypeError):
+                    logging.warning("Ignoring unreadable progress in %s",
+                                    self.filename)
+                    break
+                if cell.cell_type == 'code' and \
+                        record.get('source_sha1') == self.source_sha1(cell):
+                    done[record['index']] = record
+        return done
+
+    @contextlib.contextmanager
+    def recording(self, append=False):
+        """Context giving a function record(index, cell) that records
+        a cell that has run, starting a new file unless append."""
+        with io.open(self.filename, 'a' if append else 'w',
+                     encoding='utf-8') as f:
+            def record(index, cell):
+                if cell.cell_type != 'code':
+                    return
+                entry = {'index': index,
+                         'source_sha1': self.source_sha1(cell),
+                         'execution_count': cell.get('execution_count'),
+                         'outputs': cell.get('outputs', [])}
+                if 'timing' in cell.metadata:
+                    entry['timing'] = cell.metadata['timing']
+                f.write(cast_unicode(json.dumps(entry, cls=BytesEncoder,
+                                                sort_keys=True)) + u'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            yield record
+
+    @staticmethod
+    def restore(cell, record):
+        """Give cell the outputs recorded for it."""
+        cell.execution_count = record['execution_count']
+        cell.outputs = [nbformat.from_dict(output)
+                        for output in record['outputs']]
+        if 'timing' in record:
+            cell.metadata['timing'] = record['timing']
+
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+class CellSelector(object):
+    """Choose the code cells of a notebook to run.
+
+    include - classes; select the cells that have any of them
+    exclude - classes; never select the cells that have any of them
+    cells   - indices of the cells to select, as a string of comma
+              separated ranges like slices, e.g. '3:10,12,20:'. Cells
+              are counted from 0, including markdown cells.
+
+    The classes of a cell are those in its attributes (e.g. slow for
+    a block with {.python .slow}) and its language (python, or the
+    name of the cell magic at the start of the cell, e.g. bash).
+
+    A cell is selected if it matches include or cells (or if neither
+    is given) and doesn't match exclude.
+    """
+    def __init__(self, include=(), exclude=(), cells=None):
+        self.include = set(include)
+        self.exclude = set(exclude)
+        self.ranges = self.parse_ranges(cells) if cells else []
+
+    @staticmethod
+    def parse_ranges(cells):
+        """Parse '3:10,12,20:' into [(3, 10), (12, 13), (20, None)]."""
+        ranges = []
+        for part in cells.split(','):
+            if ':' in part:
+                start, stop = part.split(':')
+                ranges.append((int(start or 0),
+                               int(stop) if stop.strip() else None))
+            else:
+                ranges.append((int(part), int(part) + 1))
+        return ranges
+
+    @staticmethod
+    def cell_classes(cell):
+        """The classes of a cell, including its language."""
+        attributes = cell.metadata.get('attributes', {})
+        classes = set(attributes.get('classes', []))
+        source = cell.source.lstrip()
+        if source.startswith('%%'):
+            language = source[2:].split(None, 1)[0] if source[2:] else ''
+        else:
+            language = 'python'
+        classes.update([language, language.lower()])
+        return classes
+
+    def __call__(self, cell, index):
+        if cell.cell_type != 'code':
+            return False
+
+        classes = self.cell_classes(cell)
+        if classes & self.exclude:
+            return False
+        if not self.include and not self.ranges:
+            return True
+        return bool(classes & self.include) or any(
+            start <= index and (stop is None or index < stop)
+            for start, stop in self.ranges)
+
+
+def utcnow():
+    return datetime.datetime.utcnow().isoformat() + 'Z'
+
+
+def peak_rss(pid):
+    """Peak resident set size (bytes) of process pid, or None if it
+    can't be read (only Linux is supported)."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def reset_peak_rss(pid):
+    """Reset the peak resident set size of process pid to its current
+    size, if possible (Linux only)."""
+    try:
+        with open('/proc/{}/clear_refs'.format(pid), 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+class TimedExecutePreprocessor(ExecutePreprocessor):
+    """ExecutePreprocessor that records how long each code cell takes
+    to run in the cell metadata, e.g.
+
+        "timing": {"start": "2016-03-01T12:00:00.000000Z",
+                   "end": "2016-03-01T12:00:01.500000Z",
+                   "wall_time": 1.5,
+                   "kernel_peak_rss": 104857600}
+
+    kernel_peak_rss (bytes) is only recorded with kernel_memory.
+    """
+    kernel_memory = Bool(False, config=True,
+                         help="Record the peak memory use of the kernel "
+                              "while each cell runs")
+
+    def preprocess_cell(self, cell, resources, cell_index, **kwargs):
+        if cell.cell_type != 'code' or not cell.source.strip():
+            return super(TimedExecutePreprocessor, self).preprocess_cell(
+                cell, resources, cell_index, **kwargs)
+
+        pid = getattr(getattr(self.km, 'kernel', None), 'pid', None)
+        if self.kernel_memory and pid:
+            reset_peak_rss(pid)
+
+        timing = {'start': utcnow()}
+        start = time.time()
+        try:
+            return super(TimedExecutePreprocessor, self).preprocess_cell(
+                cell, resources, cell_index, **kwargs)
+        finally:
+            timing['wall_time'] = round(time.time() - start, 6)
+            timing['end'] = utcnow()
+            if self.kernel_memory and pid:
+                timing['kernel_peak_rss'] = peak_rss(pid)
+            cell.metadata['timing'] = timing
+
+
+def timing_report(notebook, **info):
+    """Machine readable report of the timing recorded in the cells of
+    an executed notebook, as a dict with the items in info and
+
+        total_wall_time - seconds spent running cells
+        cells - the timing of each cell, with its index, its
+                execution_count, the sha1 of its source (to follow
+                it between runs) and the first line of its source
+    """
+    cells = []
+    for index, cell in enumerate(notebook.cells):
+        if 'timing' not in cell.get('metadata', {}):
+            continue
+        entry = dict(cell.metadata.timing)
+        source = cell.source
+        entry.update(index=index,
+                     execution_count=cell.get('execution_count'),
+                     source_sha1=hashlib.sha1(
+                         source.encode('utf-8')).hexdigest(),
+                     summary=source.strip().split('\n')[0])
+        cells.append(entry)
+
+    report = dict(info)
+    report['total_wall_time'] = sum(c['wall_time'] for c in cells)
+    report['cells'] = cells
+    return report
+
+
+def timing_summary(notebook, n=10):
+    """Summary of the n slowest cells of an executed notebook."""
+    report = timing_report(notebook)
+    cells = sorted(report['cells'], key=lambda c: -c['wall_time'])[:n]
+
+    lines = ['{} slowest of {} cells ({:.2f}s in total):'
+             .format(len(cells), len(report['cells']),
+                     report['total_wall_time'])]
+    for cell in cells:
+        rss = cell.get('kernel_peak_rss')
+        lines.append('{:>9.2f}s {:>10} cell {:<4} {}'.format(
+            cell['wall_time'],
+            '{:.1f}MB'.format(rss / 2. ** 20) if rss else '',
+            cell['index'],
+            cell['summary'][:50]))
+    return '\n'.join(lines) + '\n'
+
+
+# rough seconds it takes to read a cell of a markdown notebook (parse)
+# and to write it again (render), for the cell and for each character
+# of its source and of its output JSON
+stats_costs = {'parse': {'cell': 4e-4, 'source': 5e-9, 'output': 4e-8},
+               'render': {'cell': 4.5e-3, 'source': 5e-8, 'output': 2.5e-7}}
+
+
+def base64_size(data):
+    """Number of bytes encoded in the base64 string data."""
+    data = ''.join(data.split())
+    return len(data) * 3 // 4 - (len(data) - len(data.rstrip('=')))
+
+
+def format_size(size):
+    """Human readable number of bytes or characters."""
+    if size < 1000:
+        return '{}B'.format(size)
+    elif size < 1000 ** 2:
+        return '{:.1f}kB'.format(size / 1000.)
+    return '{:.1f}MB'.format(size / 1000. ** 2)
+
+
+def cell_stats(cell):
+    """The size of a cell and what it is made of (see notebook_stats)."""
+    source = cell.get('source', '')
+    metadata = cell.get('metadata', {})
+    outputs = cell.get('outputs', [])
+    mime_sizes = {}
+    image_bytes = 0
+    for output in outputs:
+        if output.get('output_type') == 'stream':
+            items = {'stream': output.get('text', '')}
+        elif output.get('output_type') == 'error':
+            items = {'error': '\n'.join(output.get('traceback', []))}
+        else:
+            items = output.get('data', {})
+        for mimetype, data in items.items():
+            if not isinstance(data, string_types):
+                data = json.dumps(data)
+            mime_sizes[mimetype] = mime_sizes.get(mimetype, 0) + len(data)
+            if mimetype.startswith('image/') and \
+                    mimetype != 'image/svg+xml':
+                image_bytes += base64_size(data)
+
+    stats = dict(cell_type=cell.get('cell_type'),
+                 summary=source.strip().split('\n')[0],
+                 source_size=len(source),
+                 metadata_size=len(json.dumps(metadata)) if metadata else 0,
+                 output_size=len(json.dumps(outputs, indent=1,
+                                            sort_keys=True))
+                 if outputs else 0,
+                 mime_sizes=mime_sizes,
+                 image_bytes=image_bytes)
+    for stage, costs in stats_costs.items():
+        stats[stage + '_cost'] = (
+            costs['cell']
+            + costs['source'] * (stats['source_size']
+                                 + stats['metadata_size'])
+            + costs['output'] * stats['output_size'])
+    return stats
+
+
+def notebook_stats(notebook, **info):
+    """Machine readable report of what makes a notebook big and slow
+    to open, as a dict with the items in info and
+
+        cells  - the stats of each cell, with its index, cell_type,
+                 the first line of its source (summary), the
+                 characters of its source, of its metadata JSON and of
+                 its output JSON, the characters of its outputs of
+                 each MIME type (or 'stream' or 'error'), the bytes of
+                 its base64 encoded images and the estimated seconds
+                 to parse and render it (see stats_costs)
+        totals - the sums of these over the notebook, and its number
+                 of cells
+    """
+    cells = []
+    for index, cell in enumerate(notebook.get('cells', [])):
+        stats = cell_stats(cell)
+        stats['index'] = index
+        cells.append(stats)
+
+    totals = {'cells': len(cells), 'mime_sizes': {}}
+    for name in ('source_size', 'metadata_size', 'output_size',
+                 'image_bytes', 'parse_cost', 'render_cost'):
+        totals[name] = sum(cell[name] for cell in cells)
+    for cell in cells:
+        for mimetype, size in cell['mime_sizes'].items():
+            totals['mime_sizes'][mimetype] = \
+                totals['mime_sizes'].get(mimetype, 0) + size
+
+    report = dict(info)
+    report['totals'] = totals
+    report['cells'] = cells
+    return report
+
+
+def stats_summary(report, n=10):
+    """Summary of the totals and the n costliest cells of a
+    notebook_stats report."""
+    totals = report['totals']
+    cells = sorted(report['cells'],
+                   key=lambda c: -(c['parse_cost'] + c['render_cost']))[:n]
+
+    lines = ['{}: {} cells, source {}, metadata {}, outputs {} '
+             '(images {})'.format(report.get('filename', 'notebook'),
+                                  totals['cells'],
+                                  format_size(totals['source_size']),
+                                  format_size(totals['metadata_size']),
+                                  format_size(totals['output_size']),
+                                  format_size(totals['image_bytes']))]
+    mime_sizes = sorted(totals['mime_sizes'].items(),
+                        key=lambda item: (-item[1], item[0]))
+    if mime_sizes:
+        lines.append('  ' + ', '.join('{} {}'.format(mimetype,
+                                                     format_size(size))
+                                      for mimetype, size in mime_sizes))
+    lines.append('  estimated {:.2f}s to parse, {:.2f}s to render'
+                 .format(totals['parse_cost'], totals['render_cost']))
+    if cells:
+        lines.append('  {} costliest of {} cells:'.format(len(cells),
+                                                          totals['cells']))
+        lines.append('  {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}  {}'
+                     .format('cell', 'type', 'source', 'outputs',
+                             'images', 'parse', 'render', 'summary'))
+    for cell in cells:
+        lines.append('  {:>6} {:>8} {:>8} {:>8} {:>8} {:>6.1f}ms {:>6.1f}ms'
+                     '  {}'.format(cell['index'],
+                                   cell['cell_type'],
+                                   format_size(cell['source_size']
+                                               + cell['metadata_size']),
+                                   format_size(cell['output_size']),
+                                   format_size(cell['image_bytes']),
+                                   cell['parse_cost'] * 1000,
+                                   cell['render_cost'] * 1000,
+                                   cell['summary'][:40]))
+    return '\n'.join(lines) + '\n'
+
+
+# marks a Block field that hasn't been set
+_unset = object()
+
+
+class Block(object):
+    """A block of markdown source, either code or text.
+
+    A block records where it is in the source text (and the regular
+    expression match that found it, for code blocks) rather than
+    copies of its contents, which are only sliced out of the source
+    when they are first read.
+
+    Blocks support the mapping interface of the block dictionaries
+    used by earlier versions, e.g. block['content'], 'indent' in block,
+    block.get('language'), dict(block).
+    """
+    __slots__ = ('type', 'text', 'start', 'end', 'line', 'end_line',
+                 'match', 'content', 'IO', 'attributes', 'language',
+                 'extra')
+
+    # fields that are stored on the block (the rest are read from the
+    # match or live in extra)
+    fields = ('type', 'start', 'end', 'line', 'end_line', 'content', 'IO',
+              'attributes', 'language')
+    # for the lookups in __getitem__ and __setitem__, which are run
+    # for every block as it is read
+    field_set = frozenset(fields)
+
+    # default values of fields when they haven't been set
+    code_defaults = {'content': '', 'IO': '', 'attributes': ''}
+    text_defaults = {'content': ''}
+
+    def __init__(self, type, text=None, match=None, **fields):
+        self.type = type
+        self.text = text
+        self.match = match
+        for key, value in fields.items():
+            if key in self.field_set:
+                setattr(self, key, value)
+            else:
+                self[key] = value
+
+    def __getitem__(self, key):
+        if key in self.field_set:
+            value = getattr(self, key, _unset)
+            if value is not _unset:
+                return value
+        else:
+            extra = getattr(self, 'extra', None)
+            if extra is not None and key in extra:
+                return extra[key]
+
+        match = self.match
+        if match is not None and key in match.re.groupindex:
+            return match.group(key)
+        elif key == 'content' and self.text is not None:
+            return self.text[self.start:self.end]
+        elif self.type == MarkdownReader.code:
+            return self.code_defaults[key]
+        else:
+            return self.text_defaults[key]
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            setattr(self, key, value)
+        else:
+            try:
+                self.extra[key] = value
+            except AttributeError:
+                self.extra = {key: value}
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key in self.fields if key in self]
+        if self.match is not None:
+            keys.extend(key for key in self.match.re.groupindex
+                        if key not in keys)
+        keys.extend(getattr(self, 'extra', ()))
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def copy(self):
+        """Shallow copy of the block."""
+        block = Block(self.type, self.text, self.match)
+        for key in self.__slots__:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                continue
+            setattr(block, key, dict(value) if key == 'extra' else value)
+        return block
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Block({!r})'.format(dict(self.items()))
 
 
 # you can think of notedown as a document converter that uses the
 # ipython notebook as its internal format
 
+class SpanMatch(object):
+    """Stand-in for a regular expression match object, rebuilt from
+    the spans of its groups, e.g. as found by a worker process in a
+    parallel parse.
+
+    The spans are read from a flat array of the start and end of each
+    group (see flat_spans), beginning at offset.
+    """
+    __slots__ = ('re', 'string', 'spans', 'offset')
+
+    def __init__(self, pattern, string, spans, offset=0):
+        self.re = pattern
+        self.string = string
+        self.spans = spans
+        self.offset = offset
+
+    @property
+    def regs(self):
+        return tuple(self.span(g) for g in range(self.re.groups + 1))
+
+    def span(self, group=0):
+        if not isinstance(group, int):
+            group = self.re.groupindex[group]
+        i = self.offset + 2 * group
+        return self.spans[i], self.spans[i + 1]
+
+    def start(self, group=0):
+        return self.span(group)[0]
+
+    def end(self, group=0):
+        return self.span(group)[1]
+
+    def group(self, group=0):
+        start, end = self.span(group)
+        if start == -1:
+            return None
+        return self.string[start:end]
+
+
+def flat_spans(matches):
+    """The spans of the groups of matches as a flat array of
+    integers, which is much quicker to send between processes than
+    the matches' regs."""
+    spans = array.array('l')
+    for match in matches:
+        if isinstance(match, SpanMatch):
+            width = 2 * (match.re.groups + 1)
+            spans.extend(match.spans[match.offset:match.offset + width])
+        else:
+            for span in match.regs:
+                spans.extend(span)
+    return spans
+
+
+def iter_span_matches(pattern, string, spans):
+    """Generate the SpanMatches in a flat array of spans."""
+    width = 2 * (pattern.groups + 1)
+    for offset in range(0, len(spans), width):
+        yield SpanMatch(pattern, string, spans, offset)
+
+
+# the reader and text of a parallel parse, in a worker process
+_worker = {}
+
+
+def _init_worker(reader, text, outputs_file):
+    _worker['reader'] = reader
+    _worker['text'] = text
+    _worker['outputs_file'] = outputs_file
+    # send notebook nodes back as dicts, which is much quicker to
+    # unpickle than setting their items one by one
+    ForkingPickler.register(nbbase.NotebookNode, _reduce_node)
+
+
+def _reduce_node(node):
+    return nbbase.NotebookNode, (dict(node),)
+
+
+def _scan_chunk(bounds):
+    """Find the code blocks that start in text[start:stop], searching
+    from start. Returns the flat spans of their groups."""
+    reader, text = _worker['reader'], _worker['text']
+    start, stop = bounds
+    matches = reader.code_pattern.finditer(text, start)
+    return flat_spans(itertools.takewhile(lambda m: m.start() < stop,
+                                          matches))
+
+
+def _region_cells(region):
+    """Create the notebook cells of a region of the text."""
+    reader, text = _worker['reader'], _worker['text']
+    start, stop, line, spans, precode = region
+    code_matches = iter_span_matches(reader.code_pattern, text, spans)
+    blocks = reader.iter_blocks(text, code_matches, start, stop, line)
+    with gc_paused():
+        return reader.blocks_to_cells(blocks, precode=precode,
+                                      outputs_file=_worker['outputs_file'])
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector, which otherwise runs over
+    and over while many containers are created in bulk, e.g. when
+    unpickling the results of a worker_pool."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+@contextlib.contextmanager
+def worker_pool(processes, reader, text, outputs_file=None):
+    """Pool of processes for a parallel parse of text by reader,
+    reading outputs from outputs_file."""
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (reader, text, outputs_file))
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class OutputsFile(object):
+    """Outputs of code cells, kept in a json file beside a markdown
+    notebook rather than in it.
+
+    The markdown holds a reference to the outputs of each cell, which
+    is a hash of them, so that references stay correct as cells are
+    edited and moved. The file is only read when an output is first
+    looked up.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.outputs = None
+
+    @staticmethod
+    def path(markdown_file):
+        """The default outputs file for markdown_file."""
+        markdown_file, _ = split_compression(markdown_file)
+        return os.path.splitext(markdown_file)[0] + '.outputs.json'
+
+    @staticmethod
+    def key(outputs):
+        """The reference to outputs (a list of outputs)."""
+        data = json.dumps(outputs, cls=BytesEncoder, sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+    def get(self, key):
+        """The outputs referred to by key, or None."""
+        if self.outputs is None:
+            try:
+                with io.open(self.filename, encoding='utf-8') as f:
+                    self.outputs = json.load(f)['outputs']
+            except (IOError, OSError, ValueError, KeyError) as e:
+                logging.warning("Couldn't read outputs from %s: %s",
+                                self.filename, e)
+                self.outputs = {}
+        return self.outputs.get(key)
+
+    def write(self, outputs, merge=False):
+        """Write the file holding outputs, a dict of lists of outputs
+        by key, unless it already does. With merge, keep the outputs
+        already in the file as well, e.g. when writing part of a
+        notebook."""
+        if merge and os.path.exists(self.filename):
+            self.get(None)
+            outputs = dict(self.outputs, **outputs)
+        text = json.dumps({'outputs': outputs}, cls=BytesEncoder, indent=1,
+                          sort_keys=True, separators=(',', ': ')) + '\n'
+        if not same_contents(self.filename, text):
+            try:
+                mode = os.stat(self.filename).st_mode & 0o777
+            except OSError:
+                mode = 0o644
+            with atomic_file(self.filename, mode) as f:
+                f.write(cast_unicode(text).encode('utf-8'))
+
+
 class MarkdownReader(NotebookReader):
     """Import markdown to IPython Notebook.
 
@@ -59,12 +1226,37 @@ class MarkdownReader(NotebookReader):
     blocks become code cells; not-code blocks become markdown cells.
 
     Only supports two kinds of notebook cell: code and markdown.
+
+    A reader keeps no state between calls, so one reader can be
+    shared by many threads.
     """
+    class ParseLimitError(Exception):
+        pass
+
     # type identifiers
     code = u'code'
     markdown = u'markdown'
     python = u'python'
 
+    # keys that record the position of a block in the source
+    position_keys = ('start', 'end', 'line', 'end_line')
+
+    # anything that isn't whitespace
+    nonspace = re.compile(r'\S')
+
+    # a line that could open or close a fenced code block, and the
+    # same after a newline, which is quicker to search for
+    fence_line = re.compile(r'^(`{3,}|~{3,})', re.MULTILINE)
+    fence_start = re.compile(r'\n(`{3,}|~{3,})')
+
+    # the end of a blank line followed by an unindented line
+    blank_line = re.compile(r'\n[ \t]*\n(?=[^ \t\n])')
+
+    # inputs smaller than this (characters) are always parsed in one
+    # process, and the text is split into this many chunks per process
+    parallel_size = 2 ** 20
+    chunks_per_job = 4
+
     # regular expressions to match a code block, splitting into groups
     # N.B you can't share group names between these patterns.
     # this is necessary for format agnostic code block detection.
@@ -78,7 +1270,8 @@ class MarkdownReader(NotebookReader):
     ^(?P<raw>
     (?P<fence>`{3,}|~{3,})  # a line starting with a fence of 3 or more ` or ~
     [ \t]*                  # followed by any amount of whitespace,
-    (?P<attributes>.*)      # the group 'attributes',
+    (?P<attributes>         # the group 'attributes', which starts
+    (?:[^ \t\n].*)?)        # after the whitespace (so can't backtrack),
     \n                      # a newline,
     (?P<content>            # the 'content' group,
     [\s\S]*?)               # that includes anything
@@ -99,7 +1292,9 @@ class MarkdownReader(NotebookReader):
     """
 
     def __init__(self, code_regex=None, precode='', magic=True,
-                 match='all', caption_comments=False):
+                 match='all', caption_comments=False, max_size=None,
+                 max_blocks=None, time_budget=None, on_limit='raise',
+                 validate=True, jobs=1):
         """
             code_regex - Either 'fenced' or 'indented' or
                          a regular expression that matches code blocks in
@@ -122,6 +1317,27 @@ class MarkdownReader(NotebookReader):
 
             caption_comments - whether to derive a caption and id from the
                                cell contents
+
+            max_size   - maximum length of the input text (characters)
+
+            max_blocks - maximum number of code blocks in the input
+
+            time_budget - maximum time (seconds) to spend reading a
+                          notebook, finding code blocks and creating
+                          the cells
+
+            on_limit   - what to do when one of the above limits is
+                         exceeded: 'raise' a ParseLimitError or treat
+                         the whole input as 'text'
+
+            validate   - whether to validate the notebook against the
+                         nbformat schema: True, False or 'lazy' (see
+                         validate_notebook)
+
+            jobs       - number of processes to parse large inputs
+                         (of at least parallel_size characters) with,
+                         or 0 for one per cpu. The result is the same
+                         as parsing with one.
         """
         if not code_regex:
             self.code_regex = r"({}|{})".format(self.fenced_regex,
@@ -144,20 +1360,21 @@ class MarkdownReader(NotebookReader):
 
         self.caption_comments = caption_comments
 
+        self.max_size = max_size
+        self.max_blocks = max_blocks
+        self.time_budget = time_budget
+        self.on_limit = on_limit
+
+        self.validate = validate
+        self.jobs = jobs
+
     def new_code_block(self, **kwargs):
         """Create a new code block."""
-        proto = {'content': '',
-                 'type': self.code,
-                 'IO': '',
-                 'attributes': ''}
-        proto.update(**kwargs)
-        return proto
+        return Block(self.code, **kwargs)
 
     def new_text_block(self, **kwargs):
         """Create a new text block."""
-        proto = {'content': '', 'type': self.markdown}
-        proto.update(**kwargs)
-        return proto
+        return Block(self.markdown, **kwargs)
 
     @property
     def pre_code_block(self):
@@ -172,8 +1389,9 @@ class MarkdownReader(NotebookReader):
 
         Just dedents indented code.
         """
-        if 'indent' in block and block['indent']:
-            indent = r'^' + block['indent']
+        indent = block.get('indent')
+        if indent:
+            indent = r'^' + indent
             block['content'] = re.sub(indent, '', block['icontent'],
                                       flags=re.MULTILINE)
 
@@ -187,11 +1405,20 @@ class MarkdownReader(NotebookReader):
         block['content'] = block['content'].strip()
 
     def process_code_block(self, block):
-        """Parse block attributes"""
+        """Parse block attributes.
+
+        Returns a copy of the code block with its attributes parsed,
+        or a new text block if the code block shouldn't become a code
+        cell. The given block isn't changed.
+        """
         if block['type'] != self.code:
             return block
 
-        attr = PandocAttributes(block['attributes'], 'markdown')
+        block = block.copy()
+        attr = (knitr_attributes(block['attributes'])
+                or PandocAttributes(block['attributes'], 'markdown'))
+
+        position = {k: block[k] for k in self.position_keys if k in block}
 
         if self.match == 'all':
             pass
@@ -199,13 +1426,14 @@ class MarkdownReader(NotebookReader):
         elif self.match == 'fenced' and block.get('indent'):
             return self.new_text_block(content=('\n' +
                                                 block['icontent'] +
-                                                '\n'))
+                                                '\n'),
+                                       **position)
 
         elif self.match == 'strict' and 'input' not in attr.classes:
-            return self.new_text_block(content=block['raw'])
+            return self.new_text_block(content=block['raw'], **position)
 
         elif self.match not in list(attr.classes) + ['fenced', 'strict']:
-            return self.new_text_block(content=block['raw'])
+            return self.new_text_block(content=block['raw'], **position)
 
         # set input / output status of cell
         if 'output' in attr.classes and 'json' in attr.classes:
@@ -245,7 +1473,7 @@ class MarkdownReader(NotebookReader):
             block['content'] = CodeMagician.magic(language) + block['content']
             block['language'] = language
 
-        return self.new_code_block(**block)
+        return block
 
     def parse_blocks(self, text):
         """Extract the code and non-code blocks from given markdown text.
@@ -260,27 +1488,107 @@ class MarkdownReader(NotebookReader):
 
         We should switch to an external markdown library if this
         gets much more complicated!
-        """
-        code_matches = [m for m in self.code_pattern.finditer(text)]
 
-        # determine where the limits of the non code bits are
-        # based on the code block edges
-        text_starts = [0] + [m.end() for m in code_matches]
-        text_stops = [m.start() for m in code_matches] + [len(text)]
-        text_limits = list(zip(text_starts, text_stops))
+        If the text exceeds the parse limits and on_limit is 'text'
+        then the whole text is returned as a single markdown block.
+        """
+        jobs = self.parallel_jobs(text)
+        if jobs == 1:
+            return list(self.iter_blocks(text))
 
-        # list of the groups from the code blocks
-        code_blocks = [self.new_code_block(**m.groupdict())
-                       for m in code_matches]
+        with worker_pool(jobs, self, text) as pool:
+            code_matches = self.parse_code_matches(text, pool)
+        return list(self.iter_blocks(text, code_matches))
 
-        text_blocks = [self.new_text_block(content=text[i:j])
-                       for i, j in text_limits]
+    def iter_blocks(self, text, code_matches=None, start=0, stop=None,
+                    line=1):
+        """Generate the blocks of text in document order, as returned
+        by parse_blocks.
 
-        # remove indents
-        list(map(self.pre_process_code_block, code_blocks))
-        # remove blank line at start and end of markdown
-        list(map(self.pre_process_text_block, text_blocks))
+        Given code_matches that have already been found, generates
+        the blocks of the region text[start:stop] (see block_pairs).
+        """
+        if code_matches is None:
+            code_matches = self.parse_code_matches(text)
+
+        pairs = self.block_pairs(text, code_matches, start, stop, line)
+        for text_block, code_block in pairs:
+            # skip empty text blocks without slicing them out
+            if self.nonspace.search(text, text_block.start, text_block.end):
+                # remove blank line at start and end of markdown
+                self.pre_process_text_block(text_block)
+                yield text_block
+
+            if code_block is not None:
+                # remove indents
+                self.pre_process_code_block(code_block)
+                if code_block['content']:
+                    yield code_block
+
+    def block_pairs(self, text, code_matches, start=0, stop=None, line=1):
+        """Generate the blocks of the region text[start:stop] from the
+        code_matches found in it, as pairs (text_block, code_block)
+        where text_block is the text before code_block. The last
+        code_block is None.
+
+        Every block records its position in the source: the offsets
+        'start' and 'end' and the line numbers 'line' and 'end_line'
+        of its first and last characters. line is the line number
+        (counting from 1) at the start of the region.
+        """
+        if stop is None:
+            stop = len(text)
+
+        # the text between code blocks starts at the end of the last
+        # code block and stops at the start of the next one
+        i = start
+        for match in itertools.chain(code_matches, [None]):
+            j = stop if match is None else match.start()
+            end_line = line + text.count('\n', i, max(i, j - 1))
+            text_block = self.new_text_block(text=text, start=i, end=j,
+                                             line=line, end_line=end_line)
+            if match is None:
+                yield text_block, None
+                return
+
+            line += text.count('\n', i, j)
+            i = match.end()
+            end_line = line + text.count('\n', j, i - 1)
+            code_block = self.new_code_block(text=text, match=match,
+                                             start=j, end=i,
+                                             line=line, end_line=end_line)
+            yield text_block, code_block
+
+            line += text.count('\n', j, i)
+
+    def make_blocks(self, text, code_matches, start=0, stop=None, line=1):
+        """Create the text and code blocks of the region
+        text[start:stop] from the code_matches found in it.
+
+        Returns (text_blocks, code_blocks), where text_blocks[i] is the
+        text before code_blocks[i] (so there is one more text block
+        than there are code blocks).
+
+        The arguments are as for block_pairs.
+        """
+        text_blocks = []
+        code_blocks = []
+        for text_block, code_block in self.block_pairs(text, code_matches,
+                                                       start, stop, line):
+            # remove blank line at start and end of markdown
+            self.pre_process_text_block(text_block)
+            text_blocks.append(text_block)
+            if code_block is not None:
+                # remove indents
+                self.pre_process_code_block(code_block)
+                code_blocks.append(code_block)
+
+        return text_blocks, code_blocks
 
+    @staticmethod
+    def interleave_blocks(text_blocks, code_blocks):
+        """Merge text and code blocks (as returned by make_blocks)
+        into a single list in document order."""
         # create a list of the right length
         all_blocks = list(range(len(text_blocks) + len(code_blocks)))
 
@@ -301,15 +1609,216 @@ class MarkdownReader(NotebookReader):
 
         return all_blocks
 
+    def parse_code_matches(self, text, pool=None):
+        """Find the code blocks in text, as find_code_matches, but
+        find none (so the whole text is markdown) if the parse limits
+        are exceeded and on_limit is 'text'.
+        """
+        try:
+            return self.find_code_matches(text, pool)
+        except self.ParseLimitError:
+            if self.on_limit != 'text':
+                raise
+            logging.warning("Parse limit exceeded, reading as plain text")
+            return []
+
+    def find_code_matches(self, text, pool=None):
+        """Find the code blocks in text, enforcing the parse limits.
+
+        Returns a list of match objects. Raises ParseLimitError if any
+        of the limits are exceeded.
+
+        Given a worker_pool, the text is searched in parallel chunks.
+        """
+        if self.max_size is not None and len(text) > self.max_size:
+            message = "input of {} characters exceeds max_size of {}"
+            raise self.ParseLimitError(message.format(len(text),
+                                                      self.max_size))
+
+        time_error = self.time_budget_error()
+        start = time.time()
+
+        if pool is None:
+            matches = self.code_pattern.finditer(text)
+        else:
+            matches = self.parallel_code_matches(text, pool)
+
+        code_matches = []
+        with time_limit(self.time_budget, time_error):
+            for match in matches:
+                code_matches.append(match)
+
+                if (self.max_blocks is not None and
+                        len(code_matches) > self.max_blocks):
+                    message = "input has more than max_blocks={} code blocks"
+                    raise self.ParseLimitError(
+                        message.format(self.max_blocks))
+
+                if (self.time_budget is not None and
+                        time.time() - start > self.time_budget):
+                    raise time_error
+
+        return code_matches
+
+    def time_budget_error(self):
+        message = "parsing exceeded time_budget of {}s"
+        return self.ParseLimitError(message.format(self.time_budget))
+
+    def check_deadline(self, deadline):
+        """Raise ParseLimitError if the time is past deadline (as
+        time.time()). Off the main thread, where time_limit can't
+        interrupt, this is how time_budget is kept."""
+        if deadline is not None and time.time() > deadline:
+            raise self.time_budget_error()
+
+    def parallel_jobs(self, text):
+        """Number of processes to parse text with."""
+        jobs = self.jobs
+        if jobs == 0:
+            jobs = multiprocessing.cpu_count()
+        if len(text) < self.parallel_size:
+            return 1
+        return max(jobs, 1)
+
+    def split_points(self, text, n):
+        """Choose up to n - 1 offsets to split text at for a parallel
+        search, spread through the text.
+
+        A cheap pre-scan pairs up the fence lines in the text to find
+        the opening fences of fenced code blocks, where the search in
+        a chunk is likely to start in step with a search of the whole
+        text. Where there aren't any, the start of a line after a
+        blank line is used.
+        """
+        fences = self.fence_start.finditer(text)
+        first = self.fence_line.match(text)
+        if first:
+            fences = itertools.chain([first], fences)
+
+        openings = []
+        fence = None
+        for match in fences:
+            if fence is None:
+                fence = match.group(1)
+                openings.append(match.start(1))
+            elif (match.group(1) == fence and
+                  text.startswith('\n', match.end())):
+                fence = None
+
+        points = []
+        size = len(text) // n
+        for k in range(1, n):
+            target = k * size
+            i = bisect.bisect_left(openings, target)
+            if i < len(openings) and openings[i] < target + size:
+                point = openings[i]
+            else:
+                blank = self.blank_line.search(text, target, target + size)
+                if blank is None:
+                    continue
+                point = blank.end()
+            if not points or point > points[-1]:
+                points.append(point)
+
+        return points
+
+    def parallel_code_matches(self, text, pool):
+        """Generate the code blocks in text, searching chunks of it in
+        parallel.
+
+        The matches are exactly those of code_pattern.finditer(text).
+        A chunk is searched from its start, which may be part way
+        through a code block that started in the chunk before. Where
+        that happens the matches are repeated in this process from the
+        end of the last match, until they fall in step with the matches
+        found in the chunk.
+        """
+        n = self.parallel_jobs(text) * self.chunks_per_job
+        points = self.split_points(text, n)
+        bounds = list(zip([0] + points, points + [len(text)]))
+
+        width = 2 * (self.code_pattern.groups + 1)
+
+        # end of the last match; any match that starts after it and
+        # before the start of the chunk has been found already
+        pos = 0
+        for (start, stop), spans in zip(bounds,
+                                        pool.imap(_scan_chunk, bounds)):
+            starts = spans[0::width]
+            ends = spans[1::width]
+            while pos < stop:
+                # the first match in the chunk that starts after pos
+                i = bisect.bisect_left(starts, pos)
+                if i == 0 or ends[i - 1] <= pos:
+                    # in step: the chunk found the matches that
+                    # continue from pos
+                    for match in iter_span_matches(self.code_pattern, text,
+                                                   spans[i * width:]):
+                        yield match
+                    if i < len(ends):
+                        pos = ends[-1]
+                    break
+
+                match = self.code_pattern.search(text, pos)
+                if match is None or match.start() >= stop:
+                    break
+                yield match
+                pos = match.end()
+
+    def split_regions(self, text, code_matches, n):
+        """Split text into about n regions that can be made into
+        cells independently, at the ends of code blocks.
+
+        A region only starts before a code block that has content and
+        isn't an output block, so that outputs are attached to the
+        same cells as when the text is read as a whole.
+
+        Returns a list of (start, stop, line, spans, precode), where
+        spans are the flat_spans of the code_matches in the region and
+        precode is whether the region starts the document.
+        """
+        size = len(text) // n
+        regions = []
+        start, line, first = 0, 1, 0
+        for i, match in enumerate(code_matches):
+            if (i > first and match.start() >= start + size and
+                    self.can_start_region(match)):
+                stop = code_matches[i - 1].end()
+                spans = flat_spans(code_matches[first:i])
+                regions.append((start, stop, line, spans, not regions))
+                line += text.count('\n', start, stop)
+                start, first = stop, i
+
+        spans = flat_spans(code_matches[first:])
+        regions.append((start, len(text), line, spans, not regions))
+        return regions
+
+    def can_start_region(self, match):
+        """Whether a region of the text can start before match."""
+        groups = match.re.groupindex
+        if 'attributes' in groups and \
+                'output' in (match.group('attributes') or ''):
+            return False
+        return any(self.nonspace.search(match.group(name) or '')
+                   for name in ('content', 'icontent') if name in groups)
+
     @staticmethod
-    def create_code_cell(block):
+    def create_code_cell(block, validate=True):
         """Create a notebook code cell from a block."""
-        code_cell = nbbase.new_code_cell(source=block['content'])
+        if validate:
+            code_cell = nbbase.new_code_cell(source=block['content'])
+        else:
+            # as new_code_cell, without the schema validation
+            code_cell = nbbase.NotebookNode(cell_type='code',
+                                            metadata=nbbase.NotebookNode(),
+                                            execution_count=None,
+                                            source=block['content'],
+                                            outputs=[])
 
         attr = block['attributes']
         if not attr.is_empty:
             code_cell.metadata \
-                = nbbase.NotebookNode({'attributes': attr.to_dict()})
+                = nbformat.from_dict({'attributes': attr.to_dict()})
             execution_count = attr.kvs.get('n')
             if not execution_count:
                 code_cell.execution_count = None
@@ -319,36 +1828,57 @@ class MarkdownReader(NotebookReader):
         return code_cell
 
     @staticmethod
-    def create_markdown_cell(block):
+    def create_markdown_cell(block, validate=True):
         """Create a markdown cell from a block."""
         kwargs = {'cell_type': block['type'],
                   'source': block['content']}
-        markdown_cell = nbbase.new_markdown_cell(**kwargs)
+        if validate:
+            markdown_cell = nbbase.new_markdown_cell(**kwargs)
+        else:
+            markdown_cell = nbbase.NotebookNode(metadata=nbbase.NotebookNode(),
+                                                **kwargs)
         return markdown_cell
 
     @staticmethod
-    def create_outputs(block):
+    def create_outputs(block, outputs_file=None):
         """Create a set of outputs from the contents of a json code
-        block.
+        block, which are either the outputs or a reference to them in
+        the OutputsFile outputs_file.
         """
-        return [nbbase.NotebookNode(output)
-                for output in json.loads(block['content'])]
+        outputs = json.loads(block['content'])
+        if isinstance(outputs, dict):
+            key = outputs['outputs']
+            if outputs_file is None:
+                logging.warning("No outputs file to find outputs %s in", key)
+                outputs = None
+            else:
+                outputs = outputs_file.get(key)
+                if outputs is None:
+                    logging.warning("Outputs %s not found in %s", key,
+                                    outputs_file.filename)
+        return [nbformat.from_dict(output) for output in outputs or []]
 
-    def create_cells(self, blocks):
-        """Turn the list of blocks into a list of notebook cells."""
+    def create_cells(self, blocks, outputs_file=None, deadline=None):
+        """Turn the list of blocks into a list of notebook cells,
+        reading any outputs they refer to from outputs_file.
+
+        Raises ParseLimitError if this is still going at deadline.
+        """
+        validate = self.validate is True
         cells = []
         for block in blocks:
+            self.check_deadline(deadline)
             if (block['type'] == self.code) and (block['IO'] == 'input'):
-                code_cell = self.create_code_cell(block)
+                code_cell = self.create_code_cell(block, validate)
                 cells.append(code_cell)
 
             elif (block['type'] == self.code and
                   block['IO'] == 'output' and
                   cells[-1].cell_type == 'code'):
-                cells[-1].outputs = self.create_outputs(block)
+                cells[-1].outputs = self.create_outputs(block, outputs_file)
 
             elif block['type'] == self.markdown:
-                markdown_cell = self.create_markdown_cell(block)
+                markdown_cell = self.create_markdown_cell(block, validate)
                 cells.append(markdown_cell)
 
             else:
@@ -357,41 +1887,687 @@ class MarkdownReader(NotebookReader):
 
         return cells
 
-    def to_notebook(self, s, **kwargs):
-        """Convert the markdown string s to an IPython notebook.
+    def to_notebook(self, s, outputs_file=None, **kwargs):
+        """Convert the markdown string s to an IPython notebook,
+        reading any outputs it refers to from the OutputsFile
+        outputs_file.
+
+        Large inputs are converted in parallel regions if jobs > 1.
+
+        If it takes longer than time_budget, either raises
+        ParseLimitError or, if on_limit is 'text', returns the whole
+        text as a markdown cell.
 
         Returns a notebook.
         """
-        all_blocks = self.parse_blocks(s)
-        if self.pre_code_block['content']:
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.time() + self.time_budget
+
+        try:
+            with time_limit(self.time_budget, self.time_budget_error()):
+                return self._to_notebook(s, outputs_file, deadline)
+        except self.ParseLimitError:
+            if self.on_limit != 'text':
+                raise
+            logging.warning("Parse limit exceeded, reading as plain text")
+            return self.blocks_to_notebook(self.iter_blocks(s, []),
+                                           outputs_file)
+
+    def _to_notebook(self, s, outputs_file, deadline):
+        jobs = self.parallel_jobs(s)
+        if jobs == 1:
+            return self.blocks_to_notebook(self.iter_blocks(s),
+                                           outputs_file, deadline)
+
+        with worker_pool(jobs, self, s, outputs_file) as pool:
+            code_matches = self.parse_code_matches(s, pool)
+            regions = self.split_regions(s, code_matches,
+                                         jobs * self.chunks_per_job)
+            cells = []
+            with gc_paused():
+                for region_cells in pool.imap(_region_cells, regions):
+                    self.check_deadline(deadline)
+                    cells.extend(region_cells)
+
+        nb = self.new_notebook(cells)
+        self.check_deadline(deadline)
+        return nb
+
+    def blocks_to_notebook(self, all_blocks, outputs_file=None,
+                           deadline=None):
+        """Convert blocks (as returned by parse_blocks) to a notebook.
+
+        Raises ParseLimitError if this is still going at deadline.
+        """
+        nb = self.new_notebook(
+            self.blocks_to_cells(all_blocks, outputs_file=outputs_file,
+                                 deadline=deadline))
+        self.check_deadline(deadline)
+        return nb
+
+    def blocks_to_cells(self, all_blocks, precode=True, outputs_file=None,
+                        deadline=None):
+        """Convert blocks to a list of cells, starting with the
+        precode if precode is True."""
+        pre_code_block = self.pre_code_block
+        if precode and pre_code_block['content']:
             # TODO: if first block is markdown, place after?
-            all_blocks.insert(0, self.pre_code_block)
+            all_blocks = itertools.chain([pre_code_block], all_blocks)
 
-        blocks = [self.process_code_block(block) for block in all_blocks]
+        blocks = (self.process_code_block(block) for block in all_blocks)
 
-        cells = self.create_cells(blocks)
+        return self.create_cells(blocks, outputs_file, deadline)
 
-        nb = nbbase.new_notebook(cells=cells)
+    def new_notebook(self, cells):
+        """Create a notebook from a list of cells."""
+        if self.validate is True:
+            nb = nbbase.new_notebook(cells=cells)
+        else:
+            # as new_notebook, without the schema validation
+            nb = nbbase.NotebookNode(nbformat=nbbase.nbformat,
+                                     nbformat_minor=nbbase.nbformat_minor,
+                                     metadata=nbbase.NotebookNode(),
+                                     cells=cells)
+            validate_notebook(nb, self.validate)
 
         return nb
 
-    def reads(self, s, **kwargs):
-        """Read string s to notebook. Returns a notebook."""
-        return self.to_notebook(s, **kwargs)
+    def reads(self, s, outputs_file=None, **kwargs):
+        """Read string s to notebook. Returns a notebook.
+
+        outputs_file - the file to read any outputs that the markdown
+                       refers to from (see OutputsFile)
+        """
+        if outputs_file:
+            outputs_file = OutputsFile(outputs_file)
+        return self.to_notebook(s, outputs_file=outputs_file, **kwargs)
+
+    def read(self, fp, **kwargs):
+        """Read a notebook from the file object fp. The outputs file
+        is by default the one beside fp (see OutputsFile.path)."""
+        name = getattr(fp, 'name', None)
+        if 'outputs_file' not in kwargs and \
+                isinstance(name, string_types) and not name.startswith('<'):
+            kwargs['outputs_file'] = OutputsFile.path(name)
+        return self.reads(fp.read(), **kwargs)
+
+
+class BlockIndex(object):
+    """Index of the blocks in a markdown document, by position in
+    the source, that can be updated incrementally as the document
+    is edited.
+
+    Usage:
+
+        index = BlockIndex(text)
+        # ... text[start:stop] is replaced to give new_text
+        first, last = index.update(new_text, (start, stop))
+
+    After an update only the blocks near the edit have been
+    reparsed; index.blocks[first:last] are the new ones.
+    """
+    fence_line = MarkdownReader.fence_line
+
+    def __init__(self, text, reader=None):
+        self.reader = reader or MarkdownReader()
+        self.parse(text)
+
+    def parse(self, text):
+        """Parse the whole of text."""
+        self.text = text
+        code_matches = self.reader.find_code_matches(text)
+        self.text_blocks, self.code_blocks \
+            = self.reader.make_blocks(text, code_matches)
+        self.blocks = self.reader.interleave_blocks(self.text_blocks,
+                                                    self.code_blocks)
+        return 0, len(self.blocks)
+
+    def update(self, text, edit_range):
+        """Update the index to the new text, where the characters
+        self.text[start:stop] have been replaced, with
+        edit_range = (start, stop).
+
+        The code block search is restarted a couple of blocks before
+        the edit and continues until it lines up with the old blocks
+        again. Edits that touch a fence line, or a document that
+        doesn't end in a newline, force a full parse: an unclosed
+        fence can reach arbitrarily far through the document.
+
+        Returns (first, last) such that self.blocks[first:last] are
+        the blocks that were reparsed.
+        """
+        old_text = self.text
+        start, stop = edit_range
+        delta = len(text) - len(old_text)
+        new_stop = stop + delta
+
+        old_region = self._line_region(old_text, start, stop)
+        new_region = self._line_region(text, start, new_stop)
+        if (not (old_text.endswith('\n') and text.endswith('\n')) or
+                self.fence_line.search(old_text, *old_region) or
+                self.fence_line.search(text, *new_region)):
+            return self.parse(text)
+
+        # keep the code blocks that end (including the line after them,
+        # which the indented regex looks at) well before the edit
+        head = 0
+        for block in self.code_blocks:
+            if self._line_end(old_text, block['end']) >= old_region[0]:
+                break
+            head += 1
+        head = max(head - 1, 0)
+        anchor = self.code_blocks[head - 1]['end'] if head else 0
+        anchor_line = self.text_blocks[head]['line']
+
+        # old code block ends after the edit, where the search could
+        # line up with the old one again
+        old_ends = {block['end']: i for i, block
+                    in enumerate(self.code_blocks[head:], head)
+                    if block['end'] + delta > new_stop}
+
+        code_matches = []
+        tail = len(self.code_blocks)
+        region_stop = len(text)
+        for match in self.reader.code_pattern.finditer(text, anchor):
+            code_matches.append(match)
+            old = match.end() - delta
+            if match.end() > new_stop and old in old_ends:
+                tail = old_ends[old] + 1
+                if tail < len(self.code_blocks):
+                    region_stop = self.code_blocks[tail]['start'] + delta
+                break
+
+        text_blocks, code_blocks = self.reader.make_blocks(
+            text, code_matches, start=anchor, stop=region_stop,
+            line=anchor_line)
+
+        # the blocks after the region are unchanged, apart from moving
+        line_delta = text.count('\n') - old_text.count('\n')
+        tail_blocks = self.code_blocks[tail:] + self.text_blocks[tail + 1:]
+        for block in tail_blocks:
+            block.text = text
+            block['start'] += delta
+            block['end'] += delta
+            block['line'] += line_delta
+            block['end_line'] += line_delta
+
+        old_blocks = self.blocks
+        self.text = text
+        self.code_blocks[head:tail] = code_blocks
+        self.text_blocks[head:tail + 1] = text_blocks
+        self.blocks = self.reader.interleave_blocks(self.text_blocks,
+                                                    self.code_blocks)
+
+        # the range of blocks that are new objects
+        first = 0
+        for old, new in zip(old_blocks, self.blocks):
+            if old is not new:
+                break
+            first += 1
+        last = len(self.blocks)
+        for old, new in zip(reversed(old_blocks[first:]),
+                            reversed(self.blocks[first:])):
+            if old is not new:
+                break
+            last -= 1
+
+        return first, last
+
+    def block_at(self, offset):
+        """Return the block that contains the source offset, or None
+        if the offset is in whitespace between blocks."""
+        starts = [block['start'] for block in self.blocks]
+        i = bisect.bisect_right(starts, offset) - 1
+        if i >= 0 and offset < self.blocks[i]['end']:
+            return self.blocks[i]
+
+    def to_notebook(self):
+        """Convert the indexed blocks to a notebook."""
+        return self.reader.blocks_to_notebook(self.blocks)
+
+    @staticmethod
+    def _line_end(text, offset):
+        """Offset of the end of the line containing offset."""
+        end = text.find('\n', offset)
+        return len(text) if end == -1 else end + 1
+
+    @classmethod
+    def _line_region(cls, text, start, stop):
+        """The region of text covering the lines from the one before
+        start to the one after stop."""
+        region_start = text.rfind('\n', 0, max(start - 1, 0))
+        region_start = text.rfind('\n', 0, max(region_start, 0)) + 1
+        region_stop = cls._line_end(text, stop)
+        region_stop = cls._line_end(text, region_stop)
+        return region_start, region_stop
+
+
+class SectionIndex(object):
+    """Outline of a markdown document as sections, each starting at
+    one of the top level headings (the highest level of ATX or setext
+    heading outside of the code blocks), so that a large document can
+    be worked on a section at a time.
+
+    Any text before the first heading is a section with title None.
+
+    Usage:
+
+        index = SectionIndex(text)
+        section = index.text(2)
+        # ... edit section
+        text = index.replace(2, section)
+    """
+    atx_heading = re.compile(r'^(?P<level>#{1,6})[ \t]+(?P<title>.*?)'
+                             r'[ \t#]*$', re.MULTILINE)
+    setext_heading = re.compile(r'^(?P<title>[^\n]*\S[^\n]*)\n'
+                                r'(?P<level>=+|-+)[ \t]*$', re.MULTILINE)
+
+    def __init__(self, text, reader=None, level=None):
+        """reader - the MarkdownReader to find code blocks with
+        level - the level of heading to split at, default the highest
+                in text
+        """
+        self.source = text
+        reader = reader or MarkdownReader()
+        code = [(match.start(), match.end())
+                for match in reader.parse_code_matches(text)]
+        code_starts = [start for start, _ in code]
+
+        def in_code(position):
+            i = bisect.bisect_right(code_starts, position) - 1
+            return i >= 0 and position < code[i][1]
+
+        headings = []
+        for match in self.atx_heading.finditer(text):
+            headings.append((match.start(), len(match.group('level')),
+                             match.group('title')))
+        for match in self.setext_heading.finditer(text):
+            level = 1 if match.group('level').startswith('=') else 2
+            headings.append((match.start(), level,
+                             match.group('title').strip()))
+        headings = sorted(heading for heading in headings
+                          if not in_code(heading[0]))
+
+        if level is None and headings:
+            level = min(heading[1] for heading in headings)
+        self.level = level
+
+        self.starts, self.titles = [], []
+        for start, heading_level, title in headings:
+            if heading_level == level:
+                self.starts.append(start)
+                self.titles.append(title)
+        if not self.starts or text[:self.starts[0]].strip():
+            self.starts.insert(0, 0)
+            self.titles.insert(0, None)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def span(self, i):
+        """The (start, stop) of section i in the source."""
+        stop = self.starts[i + 1] if i + 1 < len(self) else len(self.source)
+        return self.starts[i], stop
+
+    def text(self, i):
+        start, stop = self.span(i)
+        return self.source[start:stop]
+
+    def replace(self, i, text):
+        """The source with section i replaced by text."""
+        start, stop = self.span(i)
+        text = text.rstrip('\n') + '\n'
+        if stop < len(self.source):
+            # keep a blank line before the next heading
+            text += '\n'
+        return self.source[:start] + text + self.source[stop:]
+
+
+def first_heading(text):
+    """The title of the first ATX or setext heading in text, or
+    None."""
+    headings = [match for match in (SectionIndex.atx_heading.search(text),
+                                    SectionIndex.setext_heading.search(text))
+                if match]
+    if not headings:
+        return None
+    return min(headings, key=lambda match: match.start()) \
+        .group('title').strip()
+
+
+def _new_summary(format):
+    return {'format': format,
+            'title': None,
+            'cells': 0,
+            'code_cells': 0,
+            'markdown_cells': 0,
+            'languages': {},
+            'classes': {},
+            'outputs': 0,
+            'output_size': 0}
+
+
+def magic_language(source, default='python'):
+    """The language of a code cell's source: that of its cell magic
+    (e.g. %%R) if it is one of the languages, otherwise default."""
+    magic = re.match(r'%%(\w+)', source)
+    language = magic and magic.group(1).lower()
+    return language if language in languages else default
+
+
+def _count(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+
+def scan_markdown(text, reader=None):
+    """Summarise the markdown text (see scan), finding the blocks as
+    reader (default a MarkdownReader) would but without creating
+    cells or decoding outputs."""
+    reader = reader or MarkdownReader()
+    summary = _new_summary('markdown')
+    last = None
+    for block in reader.iter_blocks(text):
+        block = reader.process_code_block(block)
+        if block['type'] == reader.markdown:
+            summary['markdown_cells'] += 1
+            if summary['title'] is None:
+                summary['title'] = first_heading(block['content'])
+        elif block['IO'] == 'input':
+            summary['code_cells'] += 1
+            language = block['language']
+            if language == reader.python:
+                language = magic_language(block['content'])
+            _count(summary['languages'], language)
+            for cls in block['attributes'].classes:
+                _count(summary['classes'], cls)
+        elif last == reader.code:
+            # outputs of the code cell before, or a reference to them
+            summary['outputs'] += 1
+            summary['output_size'] += len(block['content'])
+        last = block['type']
+    summary['cells'] = summary['code_cells'] + summary['markdown_cells']
+    return summary
+
+
+def scan_notebook(fp, head=''):
+    """Summarise the notebook JSON read from the file object fp (see
+    scan), after head if given, skipping over the outputs without
+    decoding them."""
+    def policy(path):
+        if not path or path[-1] in ('cells', 'worksheets'):
+            return 'descend'
+        elif len(path) >= 2 and path[-2] in ('cells', 'worksheets'):
+            return 'descend'
+        elif len(path) >= 3 and path[-3] == 'cells' \
+                and path[-1] == 'outputs':
+            return 'descend'
+        elif len(path) >= 4 and path[-4] == 'cells' \
+                and path[-2] == 'outputs':
+            return 'skip'
+
+    stream = JSONStream(fp, buffer=head)
+    nb_dict = stream.load(policy)
+    output_sizes = {}
+    for path, size in stream.skipped:
+        output_sizes[path[:-2]] = output_sizes.get(path[:-2], 0) + size
+
+    metadata = nb_dict.get('metadata', {})
+    kernel_language = (metadata.get('kernelspec', {}).get('language')
+                       or metadata.get('language_info', {}).get('name')
+                       or 'python')
+    if 'worksheets' in nb_dict:
+        cells = [(('worksheets', i, 'cells', j), cell)
+                 for i, worksheet in enumerate(nb_dict['worksheets'])
+                 for j, cell in enumerate(worksheet.get('cells', []))]
+    else:
+        cells = [(('cells', j), cell)
+                 for j, cell in enumerate(nb_dict.get('cells', []))]
+
+    summary = _new_summary('notebook')
+    summary['title'] = metadata.get('title')
+    for path, cell in cells:
+        source = cell.get('source', '')
+        if not isinstance(source, string_types):
+            source = ''.join(source)
+        if cell.get('cell_type') == 'code':
+            summary['code_cells'] += 1
+            _count(summary['languages'],
+                   magic_language(source, kernel_language))
+            attributes = cell.get('metadata', {}).get('attributes', {})
+            for cls in attributes.get('classes', []):
+                _count(summary['classes'], cls)
+            if path in output_sizes:
+                summary['outputs'] += 1
+                summary['output_size'] += output_sizes[path]
+        elif cell.get('cell_type') in ('markdown', 'heading'):
+            summary['markdown_cells'] += 1
+            if summary['title'] is None:
+                if cell.get('cell_type') == 'heading':
+                    summary['title'] = source.strip()
+                else:
+                    summary['title'] = first_heading(source)
+    summary['cells'] = len(cells)
+    return summary
+
+
+def scan(source, informat=None, reader=None):
+    """Summarise a notebook, in markdown or JSON, without reading it
+    into a notebook. Much quicker than reading it for tools that only
+    need to know what is in a notebook, e.g. to index many of them.
+
+    source   - a filename or a file object
+    informat - 'markdown' or 'notebook', default from the file
+               extension, or from the content
+    reader   - the MarkdownReader that would read the markdown
+               (default MarkdownReader())
+
+    Returns a dict of
+
+        format         - 'markdown' or 'notebook'
+        title          - the notebook metadata title or the first
+                         heading, or None
+        cells          - number of cells (without any precode)
+        code_cells     - number of code cells
+        markdown_cells - number of markdown cells
+        languages      - number of code cells in each language
+        classes        - number of code cells with each attribute class
+        outputs        - number of code cells with outputs
+        output_size    - characters of output JSON in the document
+    """
+    if isinstance(source, string_types):
+        if informat is None:
+            _, extension = os.path.splitext(source)
+            informat = 'notebook' if extension == '.ipynb' else 'markdown'
+        with io.open(source, encoding='utf-8') as fp:
+            return scan(fp, informat, reader)
+
+    # the start of the input, read to tell the format from
+    head = ''
+    if informat is None:
+        while not head.strip():
+            chunk = source.read(2 ** 16)
+            head += chunk
+            if not chunk:
+                break
+        # notebooks are a JSON object
+        informat = 'notebook' if head.lstrip().startswith('{') \
+            else 'markdown'
+
+    if informat == 'notebook':
+        return scan_notebook(source, head)
+    return scan_markdown(head + source.read(), reader)
+
+
+def user_cache_dir(name):
+    """Directory notedown/name in the user's cache directory."""
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'notedown', name)
+
+
+@contextlib.contextmanager
+def atomic_file(filename, mode=None):
+    """Write to a binary file that replaces filename once the body
+    of the with statement completes, so that readers never see part
+    of it.
+
+    The file is only readable by the user unless mode is given.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                               prefix='.tmp')
+    try:
+        if mode is not None:
+            os.chmod(tmp, mode)
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        getattr(os, 'replace', os.rename)(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# the compression of files with these extensions
+compression_extensions = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# default compression levels, which favour speed
+compression_levels = {'gzip': 6, 'zstd': 3}
+
+
+def split_compression(filename):
+    """Split filename into the name of the uncompressed file and the
+    extension of its compression, e.g. ('doc.md', '.gz'), or '' if
+    it isn't compressed."""
+    name, extension = os.path.splitext(filename)
+    if extension in compression_extensions:
+        return name, extension
+    return filename, ''
+
+
+def open_compressed(filename, mode='rb', level=None):
+    """Open filename to read ('rb') or write ('wb') bytes, as a stream
+    that decompresses or compresses it if it has one of the
+    compression_extensions, with the compression level (default from
+    compression_levels). zstd needs the zstandard package."""
+    compression = compression_extensions.get(split_compression(filename)[1])
+    if level is None:
+        level = compression_levels.get(compression)
+    if compression == 'gzip':
+        return gzip.GzipFile(filename, mode, compresslevel=level)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading and writing .zst files needs the "
+                              "zstandard package")
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(
+                open(filename, 'rb'), closefd=True)
+        return zstandard.ZstdCompressor(level=level).stream_writer(
+            open(filename, 'wb'), closefd=True)
+    return open(filename, mode)
+
+
+def open_text(filename, mode='r', level=None):
+    """Open filename to read ('r') or write ('w') utf-8 text,
+    decompressing or compressing it as open_compressed."""
+    if not split_compression(filename)[1]:
+        return io.open(filename, mode, encoding='utf-8')
+    return io.TextIOWrapper(open_compressed(filename, mode + 'b', level),
+                            encoding='utf-8')
+
+
+def same_contents(filename, text, chunk_size=2 ** 16):
+    """Whether the file filename holds exactly text (as utf-8), after
+    decompressing it if it is compressed."""
+    data = cast_unicode(text).encode('utf-8')
+    try:
+        compressed = split_compression(filename)[1]
+        if not compressed and os.path.getsize(filename) != len(data):
+            return False
+        with open_compressed(filename, 'rb') as f:
+            # reads of a compressed file may return less than asked for
+            offset = 0
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return offset == len(data)
+                if chunk != data[offset:offset + len(chunk)]:
+                    return False
+                offset += len(chunk)
+    except (IOError, OSError, EOFError):
+        return False
+
+
+def default_template_cache():
+    """Directory to cache compiled templates in: $NOTEDOWN_TEMPLATE_CACHE
+    if it is set and not empty, otherwise None (no cache)."""
+    return os.environ.get('NOTEDOWN_TEMPLATE_CACHE') or None
+
+
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """Cache of compiled jinja templates on disk, shared between
+    processes.
+
+    Jinja keys entries by the name and path of the template, and checks
+    the template source and the python version before using one. The
+    filters that are passed the template context are decided when a
+    template is compiled, so the names of the entries also hold a stamp
+    of the versions of jinja2 and nbconvert and of this module.
+
+    Entries are written atomically and any that can't be read are
+    ignored, so that concurrent processes can share a cache.
+    """
+    def __init__(self, directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        stamp = u'|'.join(u'{}'.format(part) for part in
+                          (jinja2.__version__, nbconvert.__version__,
+                           os.path.getmtime(__file__)))
+        stamp = hashlib.sha1(stamp.encode('utf-8')).hexdigest()[:16]
+        super(TemplateBytecodeCache, self).__init__(
+            directory, '__notedown_' + stamp + '_%s.cache')
+
+    def load_bytecode(self, bucket):
+        try:
+            super(TemplateBytecodeCache, self).load_bytecode(bucket)
+        except Exception:
+            # e.g. a truncated file; recompile
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        try:
+            filename = os.path.join(self.directory,
+                                    self.pattern % bucket.key)
+            with atomic_file(filename) as f:
+                bucket.write_bytecode(f)
+        except (IOError, OSError) as e:
+            logging.debug("Couldn't cache template: %s", e)
 
 
 class MarkdownWriter(NotebookWriter):
-    """Write a notebook into markdown."""
+    """Write a notebook into markdown.
+
+    A writer keeps no state between calls, so one writer can be
+    shared by many threads.
+    """
     def __init__(self, template_file, strip_outputs=True,
-                 write_outputs=False, output_dir='./figures'):
+                 write_outputs=False, output_dir='./figures',
+                 template_cache=None):
         """template_file - location of jinja template to use for export
         strip_outputs - whether to remove output cells from the output
+        template_cache - directory to cache compiled templates in
+                         (see TemplateBytecodeCache), default None
+                         to not cache them
         """
         filters = [
             ('string2json', self.string2json),
             ('create_input_codeblock', self.create_input_codeblock),
-            ('create_output_codeblock', self.create_output_codeblock),
-            ('create_output_block', self.create_output_block),
+            ('create_output_codeblock', self._output_codeblock_filter),
+            ('create_output_block', self._output_block_filter),
             ('create_attributes', self.create_attributes),
             ('dequote', self.dequote),
             ('data2uri', self.data2uri)
@@ -414,6 +2590,13 @@ class MarkdownWriter(NotebookWriter):
 
         self.exporter.template_file = os.path.basename(template_file)
 
+        if template_cache:
+            try:
+                self.exporter.environment.bytecode_cache \
+                    = TemplateBytecodeCache(template_cache)
+            except OSError as e:
+                logging.debug("Not caching templates: %s", e)
+
         logging.debug("Creating MarkdownWriter")
         logging.debug(("MarkdownWriter: template_file = %s"
                        % template_file))
@@ -426,13 +2609,24 @@ class MarkdownWriter(NotebookWriter):
         self.write_outputs = write_outputs
         self.output_dir = output_dir
 
+        # load the template now rather than in the first of several
+        # threads to write with it
+        self.exporter.template
+
     def write_from_json(self, notebook_json):
         notebook = v4.reads_json(notebook_json)
         return self.write(notebook)
 
-    def writes(self, notebook):
-        body, resources = self.exporter.from_notebook_node(notebook)
-        self.resources = resources
+    def export(self, notebook, outputs_file=None):
+        """Write the notebook to markdown, as writes. Returns the
+        markdown and the resources of the export, which hold any
+        files extracted from the outputs ('outputs') and the outputs
+        that the markdown refers to by key ('file_outputs', None
+        unless outputs_file is given and outputs aren't stripped)."""
+        use_file = outputs_file and not self.strip_outputs
+        resources = {'file_outputs': {} if use_file else None}
+        body, resources = self.exporter.from_notebook_node(notebook,
+                                                           resources)
 
         if self.write_outputs:
             self.write_resources(resources)
@@ -440,7 +2634,34 @@ class MarkdownWriter(NotebookWriter):
         # remove any blank lines added at start and end by template
         text = re.sub(r'\A\s*\n|^\s*\Z', '', body)
 
-        return cast_unicode(text, 'utf-8')
+        return cast_unicode(text, 'utf-8'), resources
+
+    def writes(self, notebook, outputs_file=None):
+        """Write the notebook to a markdown string. If outputs_file is
+        given, the markdown refers to the outputs rather than holding
+        them (see OutputsFile). Nothing is written to outputs_file;
+        write does that."""
+        text, _ = self.export(notebook, outputs_file)
+        return text
+
+    def write(self, notebook, fp, outputs_file=None, merge_outputs=False):
+        """Write the notebook to the file object fp as markdown, and
+        its outputs to outputs_file if it is given (see
+        write_outputs_file)."""
+        text, resources = self.export(notebook, outputs_file)
+        self.write_outputs_file(outputs_file, resources, merge_outputs)
+        fp.write(text)
+
+    def write_outputs_file(self, outputs_file, resources, merge=False):
+        """Write the outputs that the markdown of an export refers to
+        (see export) to outputs_file, replacing those already there
+        unless merge. Nothing is written if the writer strips the
+        outputs, so stripping never loses the outputs in a file."""
+        file_outputs = resources.get('file_outputs')
+        if file_outputs is None:
+            return
+        if file_outputs or os.path.exists(outputs_file):
+            OutputsFile(outputs_file).write(file_outputs, merge=merge)
 
     def write_resources(self, resources):
         """Write the output data in resources returned by exporter
@@ -476,19 +2697,39 @@ class MarkdownWriter(NotebookWriter):
         attrs = self.create_attributes(cell, cell_type='input')
         return codeblock.format(attributes=attrs, fence='```', cell=cell)
 
-    def create_output_block(self, cell):
+    def create_output_block(self, cell, file_outputs=None):
         if self.strip_outputs:
             return ''
         else:
-            return self.create_output_codeblock(cell)
+            return self.create_output_codeblock(cell, file_outputs)
 
-    def create_output_codeblock(self, cell):
+    def create_output_codeblock(self, cell, file_outputs=None):
+        """The code block of the cell's outputs, or of a reference to
+        them if file_outputs, a dict of outputs to write to an outputs
+        file by key, is given."""
         codeblock = ('{fence}{{.json .output n={execution_count}}}\n'
                      '{contents}\n'
                      '{fence}')
+        outputs = cell.outputs
+        if file_outputs is not None and outputs:
+            key = OutputsFile.key(outputs)
+            file_outputs[key] = outputs
+            outputs = {'outputs': key}
         return codeblock.format(fence='```',
                                 execution_count=cell.execution_count,
-                                contents=self.string2json(cell.outputs))
+                                contents=self.string2json(outputs))
+
+    # the output filters find the outputs to write to a file in the
+    # resources of the export
+    @pass_context
+    def _output_block_filter(self, context, cell):
+        return self.create_output_block(
+            cell, context['resources'].get('file_outputs'))
+
+    @pass_context
+    def _output_codeblock_filter(self, context, cell):
+        return self.create_output_codeblock(
+            cell, context['resources'].get('file_outputs'))
 
     def create_attributes(self, cell, cell_type=None):
         """Turn the attribute dict into an attribute string
@@ -572,12 +2813,111 @@ class CodeMagician(object):
             return "%%{}\n".format(alias)
 
 
+def which(program):
+    """Full path of program on the PATH, or None."""
+    try:
+        from shutil import which
+    except ImportError:
+        from distutils.spawn import find_executable as which
+    return which(program)
+
+
+class KnitCache(object):
+    """Cache of knitted markdown in directory, evicting the least
+    recently used entries when there are more than max_size bytes of
+    them."""
+    def __init__(self, directory, max_size=2 ** 28):
+        self.directory = directory
+        self.max_size = max_size
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    @staticmethod
+    def key(*parts):
+        parts = u'\0'.join(u'{}'.format(part) for part in parts)
+        return hashlib.sha256(parts.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.md')
+
+    def get(self, key):
+        """The markdown cached for key, or None."""
+        try:
+            with open(self.path(key), 'rb') as f:
+                text = f.read().decode('utf-8')
+            # mark as recently used
+            os.utime(self.path(key), None)
+            return text
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, text):
+        with atomic_file(self.path(key)) as f:
+            f.write(text.encode('utf-8'))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.md'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            size -= entry_size
+
+    def load(self, name):
+        """A json record kept in the cache, or None."""
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, name, record):
+        with atomic_file(os.path.join(self.directory, name)) as f:
+            f.write(json.dumps(record).encode('utf-8'))
+
+
 class Knitr(object):
     class KnitrError(Exception):
         pass
 
-    def __init__(self):
-        # raise exception if R or knitr not installed
+    def __init__(self, cache_dir=None, max_cache_size=2 ** 28):
+        """cache_dir - directory to cache knitted markdown in, or None to
+                    always knit. Entries are keyed by the input, the
+                    options and the versions of R and knitr, so R isn't
+                    run at all if none of them have changed. Output
+                    that depends on anything else, e.g. data files
+                    read with eval=TRUE, won't be updated.
+        max_cache_size - bytes of knitted markdown to keep
+        """
+        self.checked = False
+        if cache_dir:
+            # R and knitr are checked on a cache miss
+            self.cache = KnitCache(cache_dir, max_cache_size)
+        else:
+            self.cache = None
+            self.check()
+
+    def check(self):
+        """Raise KnitrError if R or knitr isn't installed."""
+        if self.checked:
+            return
+
         cmd = ['Rscript', '-e', 'require(knitr)']
 
         try:
@@ -598,8 +2938,10 @@ class Knitr(object):
                        "$ {cmd}\n"
                        "{error}").format(cmd=' '.join(cmd), error=stderr)
             raise self.KnitrError(message)
+        self.checked = True
 
-    def knit(self, input_file, opts_chunk='eval=FALSE'):
+    def knit(self, input_file, opts_chunk='eval=FALSE',
+             opts_knit='progress=FALSE, verbose=FALSE'):
         """Use Knitr to convert the r-markdown input_file
         into markdown, returning a file object.
         """
@@ -607,14 +2949,78 @@ class Knitr(object):
         tmp_in = tempfile.NamedTemporaryFile(mode='w+')
         tmp_out = tempfile.NamedTemporaryFile(mode='w+')
 
-        tmp_in.file.write(input_file.read())
+        text = input_file.read()
+
+        if self.cache:
+            key = self.cache.key(text, opts_chunk, opts_knit,
+                                 *self.versions())
+            knitted = self.cache.get(key)
+            if knitted is not None:
+                logging.debug("Using cached knitr output %s", key)
+                tmp_out.file.write(knitted)
+                tmp_out.file.flush()
+                tmp_out.file.seek(0)
+                return tmp_out
+
+        self.check()
+
+        tmp_in.file.write(text)
         tmp_in.file.flush()
         tmp_in.file.seek(0)
 
-        self._knit(tmp_in.name, tmp_out.name, opts_chunk)
+        self._knit(tmp_in.name, tmp_out.name, opts_knit, opts_chunk)
         tmp_out.file.flush()
+
+        if self.cache:
+            with io.open(tmp_out.name, encoding='utf-8') as f:
+                self.cache.put(key, f.read())
         return tmp_out
 
+    def versions(self):
+        """The versions of R and knitr, as (R, knitr).
+
+        These are kept in the cache for the Rscript on the path and
+        found again if it or the knitr package is changed, so that
+        there is no need to start R to find them.
+        """
+        rscript = which('Rscript')
+        if rscript is None:
+            raise self.KnitrError("Rscript was not found on your path.")
+        rscript = os.path.realpath(rscript)
+
+        def mtime(path):
+            try:
+                return os.path.getmtime(path)
+            except (OSError, TypeError):
+                return None
+
+        record = (self.cache.load('versions.json') or {}).get(rscript)
+        if record and record['mtime'] == mtime(rscript) \
+                and record['knitr_mtime'] == mtime(record['knitr']):
+            return record['versions']
+
+        script = ('cat(R.version.string, '
+                  'as.character(packageVersion("knitr")), '
+                  'system.file("DESCRIPTION", package="knitr"), sep="\\n")')
+        p = subprocess.Popen([rscript, '-e', script],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        lines = stdout.decode('utf8').splitlines()
+        if p.returncode or len(lines) != 3:
+            message = ("Could not load knitr (needs manual installation).\n\n"
+                       "{error}").format(error=stderr.decode('utf8'))
+            raise self.KnitrError(message)
+
+        r_version, knitr_version, description = lines
+        versions = self.cache.load('versions.json') or {}
+        versions[rscript] = {'mtime': mtime(rscript),
+                             'knitr': description,
+                             'knitr_mtime': mtime(description),
+                             'versions': [r_version, knitr_version]}
+        self.cache.save('versions.json', versions)
+        return versions[rscript]['versions']
+
     @staticmethod
     def _knit(fin, fout,
               opts_knit='progress=FALSE, verbose=FALSE',
@@ -644,6 +3050,12 @@ class Knitr(object):
                              stderr=subprocess.PIPE)
         stdout, stderr = p.communicate()
 
+        if p.returncode:
+            message = ("knitr failed to convert {input}.\n\n"
+                       "{error}").format(input=fin,
+                                         error=stderr.decode('utf8'))
+            raise Knitr.KnitrError(message)
+
 
 def get_caption_comments(content):
     """Retrieve an id and a caption from a code cell.
@@ -677,3 +3089,81 @@ def get_caption_comments(content):
     # in pandoc-attributes
     caption = '"' + ' '.join(caption) + '"'
     return id, caption
+
+
+# the engine of a knitr chunk header, e.g. {r label, echo=FALSE}
+knitr_engine = re.compile(r'^\{[ \t]*([A-Za-z][\w.]*)(.*)\}[ \t]*$')
+knitr_option = re.compile(r'^([A-Za-z][\w.]*)[ \t]*=(.*)$', re.DOTALL)
+# a label without options, e.g. {r cars}
+knitr_label = re.compile(r'^[ \t]+[^\s.#,][^\s,]*[ \t]*$')
+
+
+def split_knitr_options(options):
+    """Split knitr chunk options at the commas that aren't in quotes
+    or brackets."""
+    parts, start, depth, quote = [], 0, 0, None
+    i = 0
+    while i < len(options):
+        c = options[i]
+        if quote:
+            if c == '\\':
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in '"\'`':
+            quote = c
+        elif c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(options[start:i])
+            start = i + 1
+        i += 1
+    parts.append(options[start:])
+    return [part.strip() for part in parts]
+
+
+def knitr_attributes(attributes):
+    """Parse a knitr chunk header, like
+
+        {r label, echo=FALSE, fig.cap="A plot"}
+
+    into PandocAttributes with the engine as the first class, the
+    label as the id and the chunk options as key-values, with their
+    values as written. The engine option overrides the engine.
+
+    Returns None if attributes isn't a knitr chunk header, so that
+    pandoc attributes like {.r #label} are read as before. A label
+    without options ({r label}) is a word that doesn't start with
+    '.' or '#'.
+    """
+    match = knitr_engine.match((attributes or '').strip())
+    if not match:
+        return None
+    engine, options = match.groups()
+    if options.strip() and not (options.lstrip().startswith(',')
+                                or '=' in options
+                                or knitr_label.match(options)):
+        return None
+
+    label = None
+    kvs = []
+    for option in split_knitr_options(options):
+        if not option:
+            continue
+        kv = knitr_option.match(option)
+        if kv:
+            key, value = kv.group(1), kv.group(2).strip()
+            if key == 'engine':
+                engine = MarkdownWriter.dequote(value)
+            elif key == 'label':
+                label = MarkdownWriter.dequote(value)
+            else:
+                kvs.append([key, value])
+        elif label is None and not kvs:
+            label = MarkdownWriter.dequote(option)
+        else:
+            return None
+
+    return PandocAttributes([label or '', [engine], kvs], 'pandoc')
@@ -0,0 +1,281 @@
+"""A long running conversion server, so that editors and build tools
+don't pay the interpreter and nbconvert startup for every conversion.
+
+    notedown serve --port 8765
+
+    curl --data-binary @input.md 'http://localhost:8765/convert?to=notebook'
+
+The document to convert is the body of a POST to /convert and the
+options, the same as the command line, are given in the query string:
+
+    from, to      - 'markdown' or 'notebook' (default markdown to notebook)
+    strip         - strip output cells
+    match         - kind of code blocks to convert (default 'all')
+    precode       - code to place at the start of the notebook (repeatable)
+    magic         - use code magic for non-python blocks (default true)
+    render        - render outputs, forcing markdown output
+    template      - template file to write markdown with
+
+The reply is the converted document.
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+
+from six.moves import BaseHTTPServer
+from six.moves import queue
+from six.moves import socketserver
+from six.moves.urllib.parse import parse_qs, urlsplit
+
+from .main import __version__, Converter
+from .notedown import cast_unicode
+
+
+def boolean(value):
+    """Parse a query string flag, where an empty value is true."""
+    if value.lower() in ('', '1', 'true', 'yes', 'on'):
+        return True
+    elif value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError("Not a boolean: {!r}".format(value))
+
+
+def parse_options(query):
+    """Convert options from a query string, as passed to
+    Converter.convert."""
+    params = parse_qs(query, keep_blank_values=True)
+    options = {}
+    for name, values in params.items():
+        value = values[-1]
+        if name in ('from', 'to'):
+            if value not in ('markdown', 'notebook'):
+                raise ValueError("Unknown format {!r}".format(value))
+            options[{'from': 'informat', 'to': 'outformat'}[name]] = value
+        elif name in ('strip', 'magic', 'render'):
+            options[{'strip': 'strip_outputs'}.get(name, name)] \
+                = boolean(value)
+        elif name in ('match', 'template'):
+            options[name] = value
+        elif name == 'precode':
+            options[name] = values
+        else:
+            raise ValueError("Unknown option {!r}".format(name))
+    return options
+
+
+class ConvertHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle conversion requests."""
+    protocol_version = 'HTTP/1.1'
+    server_version = 'notedown/' + __version__
+    # close idle connections so they don't hold on to a worker
+    timeout = 60
+
+    content_types = {'markdown': 'text/markdown; charset=utf-8',
+                     'notebook': 'application/x-ipynb+json; charset=utf-8'}
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/status':
+            return self.reply(404, 'Not found')
+        status = {'version': __version__, 'workers': self.server.workers}
+        self.reply(200, json.dumps(status), 'application/json')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/convert':
+            return self.reply(404, 'Not found')
+
+        length = self.headers.get('Content-Length')
+        if length is None:
+            return self.reply(411, 'Content-Length required')
+        try:
+            length = int(length)
+        except ValueError:
+            return self.reply(400, 'Bad Content-Length')
+        if length > self.server.max_request_size:
+            self.close_connection = True
+            return self.reply(413, 'Request larger than {} bytes'
+                                   .format(self.server.max_request_size))
+
+        body = self.rfile.read(length)
+        try:
+            content = body.decode('utf-8')
+            options = parse_options(url.query)
+        except ValueError as e:
+            return self.reply(400, u'{}'.format(e))
+
+        try:
+            output = self.server.converter().convert(content, **options)
+        except Exception as e:
+            logging.debug("Conversion failed", exc_info=True)
+            return self.reply(400, u'Unreadable document: {!r}'.format(e))
+
+        outformat = 'markdown' if options.get('render') \
+            else options.get('outformat', 'notebook')
+        self.reply(200, output, self.content_types[outformat])
+
+    def reply(self, code, text, content_type='text/plain; charset=utf-8'):
+        data = cast_unicode(text).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # client_address is empty on a unix socket
+        logging.info(format, *args)
+
+
+class WorkerPoolMixIn(object):
+    """Handle each request in one of a fixed pool of worker threads,
+    sharing a Converter."""
+    workers = 4
+    max_request_size = 16 * 2 ** 20
+    validate = True
+
+    def server_activate(self):
+        super(WorkerPoolMixIn, self).server_activate()
+        self.shared_converter = Converter(validate=self.validate)
+        # stop accepting connections when the workers are this far behind
+        self.requests = queue.Queue(maxsize=self.workers * 4)
+        self.threads = [threading.Thread(target=self.process_requests,
+                                         name='notedown-worker-%d' % i)
+                        for i in range(self.workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def converter(self):
+        return self.shared_converter
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super(WorkerPoolMixIn, self).server_close()
+        for thread in getattr(self, 'threads', []):
+            self.requests.put(None)
+        for thread in getattr(self, 'threads', []):
+            thread.join()
+
+
+class HTTPServer(WorkerPoolMixIn, BaseHTTPServer.HTTPServer):
+    """Conversion server listening on a TCP port."""
+
+
+class UnixHTTPServer(WorkerPoolMixIn, socketserver.UnixStreamServer):
+    """Conversion server listening on a unix socket."""
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            # a socket left by a server that wasn't closed
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super(UnixHTTPServer, self).server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(host='127.0.0.1', port=8765, socket_path=None, workers=4,
+                max_request_size=16 * 2 ** 20, validate=True):
+    """Create a conversion server on host and port, or on a unix socket
+    if socket_path is given. Call serve_forever to start serving."""
+    if socket_path:
+        server_class, address = UnixHTTPServer, socket_path
+    else:
+        server_class, address = HTTPServer, (host, port)
+
+    # class attributes, as they are needed while the server activates
+    server_class = type(server_class.__name__, (server_class,),
+                        {'workers': workers,
+                         'max_request_size': max_request_size,
+                         'validate': validate})
+    return server_class(address, ConvertHandler)
+
+
+def command_line_parser():
+    """Create parser for notedown serve."""
+    parser = argparse.ArgumentParser(
+        prog='notedown serve',
+        description="Serve conversions over HTTP, on localhost or on a "
+                    "unix socket.",
+        epilog="Example:  curl --data-binary @input.md "
+               "'http://localhost:8765/convert?to=notebook&strip'")
+    parser.add_argument('--host',
+                        default='127.0.0.1',
+                        help="address to listen on (default 127.0.0.1)")
+    parser.add_argument('--port',
+                        default=8765,
+                        type=int,
+                        help="port to listen on (default 8765)")
+    parser.add_argument('--socket',
+                        dest='socket_path',
+                        metavar='PATH',
+                        help="listen on a unix socket instead of a port")
+    parser.add_argument('--workers',
+                        default=4,
+                        type=int,
+                        help="number of requests to convert at once "
+                             "(default 4)")
+    parser.add_argument('--max-request-size',
+                        default=16 * 2 ** 20,
+                        type=int,
+                        metavar='BYTES',
+                        help="largest document to accept (default 16MiB)")
+    parser.add_argument('--no-validate',
+                        action='store_false',
+                        dest='validate',
+                        help=("don't validate notebooks against the "
+                              "notebook format schema"))
+    parser.add_argument('--debug',
+                        help=('show logging output'),
+                        action='store_true')
+    return parser
+
+
+def main(args):
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    # so that the server is closed, removing any socket file
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    server = make_server(host=args.host,
+                         port=args.port,
+                         socket_path=args.socket_path,
+                         workers=args.workers,
+                         max_request_size=args.max_request_size,
+                         validate=args.validate)
+    logging.info("Serving conversions on %s",
+                 args.socket_path or 'http://%s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def app(argv=None):
+    args = command_line_parser().parse_args(argv)
+    main(args)
@@ -1,8 +1,16 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import base64
+import io
+import json
 import os
+import shutil
+import sys
 import tempfile
+import threading
+import time
+import unittest
 
 import nose.tools as nt
 
@@ -278,10 +286,11 @@ def test_alt_lang():
     all_blocks = reader.parse_blocks(alt_lang)
 
     code_blocks = [b for b in all_blocks if b['type'] == reader.code]
-    magic_block = code_blocks[0]
-    reader.process_code_block(magic_block)
+    magic_block = reader.process_code_block(code_blocks[0])
 
     assert(magic_block['content'] == alt_lang_code)
+    # the parsed block is unchanged
+    assert(code_blocks[0]['content'] != alt_lang_code)
 
 
 def test_format_agnostic():
@@ -308,6 +317,61 @@ def test_attributes():
         assert attr == ref
 
 
+def test_block_positions():
+    """Blocks record where they are in the source."""
+    text = sample_markdown
+    for block in parse_cells(text):
+        assert(block['line'] == text.count('\n', 0, block['start']) + 1)
+        assert(block['content'].strip('\n')
+               in text[block['start']:block['end']])
+
+    index = notedown.BlockIndex(text)
+    offset = text.index('pip install notedown')
+    assert(index.block_at(offset)['content'] == 'pip install notedown')
+
+
+def test_incremental_update():
+    """Updating the block index after an edit gives the same blocks as
+    a full parse."""
+    def positions(blocks):
+        return [(b['start'], b['end'], b['line'], b['content'])
+                for b in blocks]
+
+    with open('example.md') as f:
+        text = f.read()
+
+    reader = notedown.MarkdownReader()
+    index = notedown.BlockIndex(text, reader)
+
+    edits = [(text.index('simple'), text.index('simple') + 6, 'easy\n\nReally'),
+             (0, 0, '# A new title\n\n'),
+             (text.index('We make'), text.index('We make'),
+              'Indented code:\n\n    indented = True\n\n')]
+    for start, stop, insert in edits:
+        new_text = index.text[:start] + insert + index.text[stop:]
+        first, last = index.update(new_text, (start, stop))
+        assert(positions(index.blocks)
+               == positions(reader.parse_blocks(new_text)))
+        assert(last - first < len(index.blocks))
+
+
+def test_block_mapping():
+    """Blocks can be used like the old block dictionaries."""
+    blocks = parse_cells(simple_backtick)
+    code = [b for b in blocks if b['type'] == 'code'][0]
+    assert(code['content'] == simple_code_cells[0])
+    assert(code['fence'] == '```')
+    assert('indent' in code and not code.get('indent'))
+    assert('language' not in code)
+    assert(dict(code)['attributes'] == '')
+
+    code['language'] = 'python'
+    code['custom'] = 1
+    copy = code.copy()
+    assert(copy == code and copy is not code)
+    assert(dict(copy)['custom'] == 1)
+
+
 def test_pre_process_text():
     """test the stripping of blank lines"""
     block = {}
@@ -381,6 +445,100 @@ def test_template_load_nonchild():
     os.remove(temp.name)
 
 
+def test_template_cache():
+    """Compiled templates are cached on disk if asked to be, and the
+    cache is ignored if it can't be read."""
+    cache = tempfile.mkdtemp()
+    template_file = 'notedown/templates/markdown.tpl'
+    notebook = notedown.MarkdownReader().reads(sample_markdown)
+    try:
+        writer = notedown.MarkdownWriter(template_file,
+                                         template_cache=cache)
+        markdown = writer.writes(notebook)
+        entries = [os.path.join(cache, name) for name in os.listdir(cache)]
+        assert(entries)
+
+        writer = notedown.MarkdownWriter(template_file,
+                                         template_cache=cache)
+        nt.assert_multi_line_equal(writer.writes(notebook), markdown)
+
+        for entry in entries:
+            with open(entry, 'wb') as f:
+                f.write(b'garbage')
+        writer = notedown.MarkdownWriter(template_file,
+                                         template_cache=cache)
+        nt.assert_multi_line_equal(writer.writes(notebook), markdown)
+
+        # only used when asked for
+        writer = notedown.MarkdownWriter(template_file)
+        assert(writer.exporter.environment.bytecode_cache is None)
+    finally:
+        shutil.rmtree(cache)
+
+
+def test_outputs_file():
+    """Outputs written to an outputs file are read back from it."""
+    v4 = nbformat.v4
+    outputs = [v4.new_output('display_data',
+                             data={'image/png': 'iVBORw0KGgo=\n',
+                                   'text/plain': '<figure>'}),
+               v4.new_output('stream', name='stdout', text='1\n')]
+    notebook = v4.new_notebook(cells=[
+        v4.new_markdown_cell('# outputs'),
+        v4.new_code_cell('plot()', execution_count=1, outputs=outputs[:1]),
+        v4.new_code_cell('print(1)', execution_count=2, outputs=outputs[1:]),
+        v4.new_code_cell('x = 1')])
+
+    writer = notedown.MarkdownWriter('notedown/templates/markdown.tpl',
+                                     strip_outputs=False)
+    reader = notedown.MarkdownReader()
+    root = tempfile.mkdtemp()
+    try:
+        outputs_file = os.path.join(root, 'doc.outputs.json')
+        markdown = writer.writes(notebook, outputs_file=outputs_file)
+        assert('iVBORw0KGgo' not in markdown)
+        # writes has no side effects
+        assert(not os.path.exists(outputs_file))
+        with io.open(os.path.join(root, 'doc.md'), 'w',
+                     encoding='utf-8') as f:
+            writer.write(notebook, f, outputs_file=outputs_file)
+        assert(os.path.exists(outputs_file))
+
+        inline = reader.reads(writer.writes(notebook))
+        nt.assert_equal(reader.reads(markdown, outputs_file=outputs_file),
+                        inline)
+
+        # read from the file beside the markdown
+        with open(os.path.join(root, 'doc.md'), 'w') as f:
+            f.write(markdown)
+        with open(os.path.join(root, 'doc.md')) as f:
+            nt.assert_equal(reader.read(f), inline)
+
+        # references follow cells that are moved
+        moved = inline.cells[2]['outputs']
+        swapped = markdown.split('\n\n')
+        swapped[1:5] = swapped[3:5] + swapped[1:3]
+        notebook = reader.reads('\n\n'.join(swapped),
+                                outputs_file=outputs_file)
+        nt.assert_equal(notebook.cells[1]['outputs'], moved)
+
+        # without the file the outputs are empty
+        notebook = reader.reads(markdown)
+        nt.assert_equal(notebook.cells[1]['outputs'], [])
+
+        # stripping doesn't touch the outputs in the file
+        with open(outputs_file) as f:
+            saved = f.read()
+        stripper = notedown.MarkdownWriter('notedown/templates/markdown.tpl')
+        with io.open(os.path.join(root, 'doc.md'), 'w',
+                     encoding='utf-8') as f:
+            stripper.write(inline, f, outputs_file=outputs_file)
+        with open(outputs_file) as f:
+            nt.assert_equal(f.read(), saved)
+    finally:
+        shutil.rmtree(root)
+
+
 def test_markdown_markdown():
     mr = notedown.MarkdownReader()
     mw = notedown.MarkdownWriter(notedown.markdown_template)
@@ -415,6 +573,386 @@ def test_R():
     nt.assert_multi_line_equal(nbjson, reference_nbjson)
 
 
+# worst case inputs for the code block regular expressions
+pathological_markdown = {
+    'unclosed fences': '```\nx\n' * 2000,
+    'mixed unclosed fences': '```\n~~~\n' * 2000,
+    'blank lines': '\n' * 20000 + 'text',
+    'whitespace lines': ' \n' * 20000,
+    'long fence': '`' * 50000 + '\n',
+    'fence whitespace': ('```' + ' ' * 2000 + '\n') * 500,
+    'indent without end': '\n' + '    x\n' * 20000,
+}
+
+
+fake_rscript = """#!{python}
+# records its calls and knits by copying
+import re, sys
+with open(sys.argv[0] + '.log', 'a') as log:
+    log.write(sys.argv[2] + '\\n')
+if sys.argv[2] == 'require(knitr)':
+    pass
+elif 'packageVersion' in sys.argv[2]:
+    print('R version 3.2.0\\n1.10\\n' + sys.argv[0])
+else:
+    fin, fout = re.search('knit\\("(.*)", output="(.*)"\\)',
+                          sys.argv[2]).groups()
+    with open(fin) as i, open(fout, 'w') as o:
+        text = i.read()
+        if 'error' in text:
+            sys.exit('Error in library(missing)')
+        o.write('knitted\\n' + text)
+"""
+
+
+def test_knit_cache():
+    """Knitted markdown is cached by input and options, without
+    running R again."""
+    bindir = tempfile.mkdtemp()
+    cache = tempfile.mkdtemp()
+    rscript = os.path.join(bindir, 'Rscript')
+    with open(rscript, 'w') as f:
+        f.write(fake_rscript.format(python=sys.executable))
+    os.chmod(rscript, 0o755)
+    path = os.environ['PATH']
+    os.environ['PATH'] = bindir + os.pathsep + path
+
+    def r_calls():
+        if not os.path.exists(rscript + '.log'):
+            return 0
+        with open(rscript + '.log') as f:
+            return len(f.read().splitlines())
+
+    try:
+        def knit(text, opts='eval=FALSE'):
+            return knitr.knit(io.StringIO(text), opts_chunk=opts).read()
+
+        knitr = notedown.Knitr(cache_dir=cache)
+        nt.assert_equal(r_calls(), 0)
+
+        # versions, require(knitr) and knit
+        nt.assert_equal(knit(u'# one\n'), u'knitted\n# one\n')
+        nt.assert_equal(r_calls(), 3)
+        nt.assert_equal(knit(u'# one\n'), u'knitted\n# one\n')
+        nt.assert_equal(r_calls(), 3)
+
+        # a new process doesn't need R either
+        knitr = notedown.Knitr(cache_dir=cache)
+        nt.assert_equal(knit(u'# one\n'), u'knitted\n# one\n')
+        nt.assert_equal(r_calls(), 3)
+
+        knit(u'# one\n', 'eval=TRUE')
+        knit(u'# two\n')
+        nt.assert_equal(r_calls(), 6)
+
+        # failures aren't cached
+        nt.assert_raises(notedown.Knitr.KnitrError, knit, u'# error\n')
+        nt.assert_raises(notedown.Knitr.KnitrError, knit, u'# error\n')
+        nt.assert_equal(r_calls(), 8)
+
+        knitr = notedown.Knitr(cache_dir=cache, max_cache_size=20)
+        knit(u'# three\n')
+        nt.assert_equal(len([name for name in os.listdir(cache)
+                             if name.endswith('.md')]), 1)
+
+        os.environ['PATH'] = cache
+        knitr = notedown.Knitr(cache_dir=cache)
+        nt.assert_raises(notedown.Knitr.KnitrError, knit, u'# four\n')
+    finally:
+        os.environ['PATH'] = path
+        shutil.rmtree(bindir)
+        shutil.rmtree(cache)
+
+
+def test_knitr_chunks():
+    """R markdown chunk headers are read without knitr."""
+    attr = notedown.knitr_attributes(
+        '{r setup, echo=FALSE, fig.cap="One, two", fig.dim=c(4, 3)}')
+    nt.assert_equal(attr.id, 'setup')
+    nt.assert_equal(attr.classes, ['r'])
+    nt.assert_equal(list(attr.kvs.items()),
+                    [('echo', 'FALSE'), ('fig.cap', '"One, two"'),
+                     ('fig.dim', 'c(4, 3)')])
+    nt.assert_equal(notedown.knitr_attributes('{r engine="python"}').classes,
+                    ['python'])
+    nt.assert_equal(notedown.knitr_attributes('{r, label="a"}').id, 'a')
+    attr = notedown.knitr_attributes('{r cars}')
+    nt.assert_equal((attr.id, attr.classes), ('cars', ['r']))
+    nt.assert_equal(notedown.knitr_attributes('{r, cars}').id, 'cars')
+    # pandoc attributes
+    nt.assert_equal(notedown.knitr_attributes('{.r #setup}'), None)
+    nt.assert_equal(notedown.knitr_attributes('{r .input}'), None)
+    nt.assert_equal(notedown.knitr_attributes('{r #setup}'), None)
+
+    # the same cells as knitting with eval=FALSE
+    reader = notedown.MarkdownReader(precode=r"%load_ext rpy2.ipython",
+                                     magic=True)
+    with open('r-examples/r-example.Rmd') as rmd:
+        notebook = reader.read(rmd)
+    with open('r-examples/r-example.ipynb') as f:
+        reference_notebook = nbformat.read(f, as_version=4)
+    notedown.main.strip(notebook)
+    notedown.main.strip(reference_notebook)
+    nt.assert_equal(notebook.cells, reference_notebook.cells)
+
+    markdown = '```{r plot, fig.width=7}\nplot(x)\n```\n'
+    cell = notedown.MarkdownReader().reads(markdown).cells[0]
+    nt.assert_equal(cell.source, '%%R\nplot(x)')
+    nt.assert_equal(cell.metadata.attributes,
+                    {'id': 'plot', 'classes': [], 'fig.width': '7'})
+
+    markdown = '```{r cars}\nsummary(cars)\n```\n'
+    cell = notedown.MarkdownReader().reads(markdown).cells[0]
+    nt.assert_equal(cell.source, '%%R\nsummary(cars)')
+    nt.assert_equal(cell.metadata.attributes,
+                    {'id': 'cars', 'classes': []})
+
+
+def test_scan():
+    """scan summarises markdown and notebooks as they would be
+    read."""
+    notebook = nbformat.read('example.ipynb', as_version=4)
+    code_cells = [cell for cell in notebook.cells if cell.cell_type == 'code']
+    code_cells[0].outputs = [nbformat.v4.new_output('stream', text='x' * 100)]
+    code_cells[1].source = '%%R\nx <- 1'
+
+    notebook_json = nbformat.writes(notebook)
+    writer = notedown.MarkdownWriter(notedown.markdown_template,
+                                     strip_outputs=False)
+    markdown = writer.writes(notebook)
+    markdown_notebook = notedown.MarkdownReader().reads(markdown)
+
+    for text, nb in ((notebook_json, notebook),
+                     (markdown, markdown_notebook)):
+        summary = notedown.scan(io.StringIO(text))
+        nt.assert_equal(summary['title'], 'Notedown example')
+        nt.assert_equal(summary['cells'], len(nb.cells))
+        nt.assert_equal(summary['code_cells'],
+                        len([c for c in nb.cells if c.cell_type == 'code']))
+        nt.assert_equal(summary['outputs'], 1)
+        assert(summary['output_size'] > 100)
+        nt.assert_equal(summary['languages']['r'], 1)
+        nt.assert_equal(sum(summary['languages'].values()),
+                        summary['code_cells'])
+
+    nt.assert_equal(notedown.scan(io.StringIO(notebook_json))['format'],
+                    'notebook')
+    nt.assert_equal(notedown.scan('r-examples/r-example.Rmd')['format'],
+                    'markdown')
+
+
+def test_strip_markdown():
+    """strip_markdown gives the markdown that reading, stripping and
+    writing gives."""
+    notebook = nbformat.read('r-examples/r-example.ipynb', as_version=4)
+    writer = notedown.MarkdownWriter(notedown.markdown_template,
+                                     strip_outputs=False)
+    with_outputs = writer.writes(notebook)
+    assert('.output' in with_outputs)
+
+    stripped_writer = notedown.MarkdownWriter(notedown.markdown_template)
+    for text in (with_outputs, open('example.md').read()):
+        for reader in (notedown.MarkdownReader(),
+                       notedown.MarkdownReader(match='fenced', magic=False),
+                       notedown.MarkdownReader(precode='import os')):
+            notebook = reader.reads(text)
+            notedown.strip(notebook)
+            nt.assert_equal(notedown.strip_markdown(text, reader),
+                            stripped_writer.writes(notebook))
+
+    # the outputs aren't read
+    text = 'x\n\n```python\n1\n```\n\n```{.json .output n=1}\n[\n```\n'
+    nt.assert_equal(notedown.strip_markdown(text), 'x\n\n```python\n1\n```\n')
+
+
+def test_stats():
+    """notebook_stats measures the outputs and images of each cell."""
+    notebook = nbformat.read('r-examples/r-example.ipynb', as_version=4)
+    report = notedown.notebook_stats(notebook, filename='r-example')
+    nt.assert_equal(report['filename'], 'r-example')
+    nt.assert_equal(report['totals']['cells'], len(notebook.cells))
+
+    cell = max(report['cells'], key=lambda c: c['image_bytes'])
+    png = [output.data['image/png']
+           for output in notebook.cells[cell['index']].outputs
+           if 'image/png' in output.get('data', {})]
+    nt.assert_equal(cell['image_bytes'],
+                    sum(len(base64.b64decode(p)) for p in png))
+    nt.assert_equal(cell['mime_sizes']['image/png'], sum(map(len, png)))
+    assert(cell['render_cost'] > cell['parse_cost'] > 0)
+    nt.assert_equal(report['totals']['image_bytes'],
+                    sum(c['image_bytes'] for c in report['cells']))
+
+    summary = notedown.stats_summary(report, n=3)
+    nt.assert_equal(len(summary.splitlines()), 8)
+    assert('image/png' in summary.splitlines()[1])
+
+
+def test_shared_reader_writer():
+    """One reader and writer can be used by many threads at once."""
+    import threading
+
+    directory = tempfile.mkdtemp()
+    try:
+        reader = notedown.MarkdownReader()
+        writer = notedown.MarkdownWriter(notedown.markdown_template,
+                                         strip_outputs=False)
+        documents = []
+        for i in range(8):
+            notebook = nbformat.v4.new_notebook(cells=[
+                nbformat.v4.new_markdown_cell('# Document {}'.format(i)),
+                nbformat.v4.new_code_cell('x = {}'.format(i), outputs=[
+                    nbformat.v4.new_output('stream', text='{}\n'.format(i))
+                ])])
+            # every other document keeps its outputs in a file
+            outputs_file = os.path.join(directory, '{}.json'.format(i)) \
+                if i % 2 else None
+            f = io.StringIO()
+            writer.write(notebook, f, outputs_file=outputs_file)
+            markdown = f.getvalue()
+            documents.append((notebook, outputs_file, markdown))
+
+        errors = []
+
+        def convert(notebook, outputs_file, markdown):
+            try:
+                for _ in range(5):
+                    nt.assert_equal(
+                        writer.writes(notebook, outputs_file=outputs_file),
+                        markdown)
+                    read = reader.reads(markdown, outputs_file=outputs_file)
+                    nt.assert_equal(read.cells[1].outputs,
+                                    notebook.cells[1].outputs)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=convert, args=document)
+                   for document in documents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        nt.assert_equal(errors, [])
+
+        text, resources = writer.export(documents[1][0],
+                                        outputs_file=documents[1][1])
+        nt.assert_equal(list(resources['file_outputs'].values()),
+                        [documents[1][0].cells[1].outputs])
+        assert(not hasattr(writer, 'resources'))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_compression():
+    """Compressed files are read and written as streams."""
+    try:
+        import zstandard
+        extensions = ('', '.gz', '.zst')
+    except ImportError:
+        extensions = ('', '.gz')
+    text = u'# Title\n\n\u00e9' * 10000
+    directory = tempfile.mkdtemp()
+    try:
+        for extension in extensions:
+            filename = os.path.join(directory, 'doc.md' + extension)
+            nt.assert_equal(notedown.split_compression(filename),
+                            (filename[:-len(extension) or None], extension))
+            nt.assert_equal(notedown.main.ftdetect(filename, compressed=True),
+                            'markdown')
+            with notedown.open_text(filename, 'w', level=1) as f:
+                f.write(text)
+            with notedown.open_text(filename) as f:
+                nt.assert_equal(f.read(), text)
+            assert(notedown.same_contents(filename, text))
+            assert(not notedown.same_contents(filename, text + u'x'))
+            assert(not notedown.same_contents(filename, text[:-1]))
+        nt.assert_equal(notedown.main.ftdetect('doc.ipynb.gz'), None)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_parse_limits_pathological():
+    """Worst case inputs either parse or hit the time budget,
+    promptly."""
+    for on_limit in ('raise', 'text'):
+        reader = notedown.MarkdownReader(time_budget=0.5, on_limit=on_limit)
+        for name, text in pathological_markdown.items():
+            start = time.time()
+            try:
+                reader.parse_blocks(text)
+            except reader.ParseLimitError:
+                assert(on_limit == 'raise')
+            elapsed = time.time() - start
+            assert elapsed < 2, "{} took {:.1f}s".format(name, elapsed)
+
+
+def test_time_budget_cells():
+    """The time budget covers creating the cells, in any thread."""
+    text = '```\n' * 20000
+    for on_limit in ('raise', 'text'):
+        reader = notedown.MarkdownReader(time_budget=0.5, on_limit=on_limit)
+        results = []
+
+        def read():
+            start = time.time()
+            try:
+                results.append(len(reader.reads(text).cells))
+            except reader.ParseLimitError:
+                results.append(None)
+            results.append(time.time() - start)
+
+        read()
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+
+        expected = None if on_limit == 'raise' else 1
+        nt.assert_equal(results[::2], [expected, expected])
+        assert max(results[1::2]) < 2, results
+
+
+def test_parse_limits():
+    reader = notedown.MarkdownReader(max_size=100)
+    nt.assert_raises(reader.ParseLimitError,
+                     reader.reads, sample_markdown)
+
+    reader = notedown.MarkdownReader(max_blocks=1)
+    nt.assert_raises(reader.ParseLimitError,
+                     reader.reads, sample_markdown)
+
+    reader = notedown.MarkdownReader(max_blocks=1, on_limit='text')
+    nb = reader.reads(sample_markdown)
+    assert(len(nb.cells) == 1)
+    assert(nb.cells[0].source == sample_markdown.strip())
+
+
+def test_read_stripped():
+    """Streaming strip gives the same notebook as read and strip."""
+    with open('example.ipynb') as f:
+        notebook = nbformat.read(f, as_version=4)
+
+    awkward = u'quote " backslash \\ brackets ]} unicode \u00e9\n'
+    for cell in notebook.cells:
+        if cell.cell_type == 'code':
+            cell.execution_count = 1
+            cell.outputs = [nbformat.v4.new_output('stream', text=awkward)]
+    text = nbformat.writes(notebook)
+
+    notedown.strip(notebook)
+    stripped = notedown.read_stripped(io.StringIO(text))
+    nt.assert_multi_line_equal(nbformat.writes(stripped),
+                               nbformat.writes(notebook))
+
+
+def test_json_stream():
+    """JSONStream reads across chunk boundaries."""
+    with open('example.ipynb') as f:
+        text = f.read()
+    for chunk_size in (1, 5, 4096):
+        stream = notedown.JSONStream(io.StringIO(text), chunk_size)
+        assert(stream.load() == json.loads(text))
+
+
 def test_match_fenced():
     mr = notedown.MarkdownReader(match='fenced')
     nb = mr.to_notebook(sample_markdown)
@@ -432,6 +970,625 @@ def test_match_arbitrary():
     assert(nb.cells[3]['cell_type'] == 'code')
 
 
+def test_delta_checkpoints():
+    """Markdown checkpoints only store the chunks that changed and
+    restore the file exactly."""
+    try:
+        from notedown.contentsmanager import NotedownContentsManager
+    except ImportError:
+        raise unittest.SkipTest('needs the jupyter notebook')
+
+    root = tempfile.mkdtemp()
+    try:
+        cm = NotedownContentsManager(root_dir=root)
+        path = os.path.join(root, 'doc.md')
+        with open(path, 'w') as f:
+            f.write(sample_markdown)
+
+        cm.create_checkpoint('doc.md')
+        objects = os.path.join(root, '.ipynb_checkpoints', 'objects')
+        n_objects = sum(len(files) for _, _, files in os.walk(objects))
+
+        edited = sample_markdown.replace('pip install notedown',
+                                         'pip install -U notedown')
+        with open(path, 'w') as f:
+            f.write(edited)
+        cm.create_checkpoint('doc.md')
+        # the edited code block replaces the old one in the store
+        assert(sum(len(files) for _, _, files in os.walk(objects))
+               == n_objects)
+
+        with open(path, 'w') as f:
+            f.write('overwritten')
+        cm.restore_checkpoint('checkpoint', 'doc.md')
+        with open(path) as f:
+            assert(f.read() == edited)
+
+        cm.delete_checkpoint('checkpoint', 'doc.md')
+        assert(cm.list_checkpoints('doc.md') == [])
+        assert(sum(len(files) for _, _, files in os.walk(objects)) == 0)
+
+        # the chunks move with the checkpoint
+        os.mkdir(os.path.join(root, 'sub'))
+        cm.create_checkpoint('doc.md')
+        cm.rename('doc.md', 'sub/doc.md')
+        assert(sum(len(files) for _, _, files in os.walk(objects)) == 0)
+        with open(os.path.join(root, 'sub', 'doc.md'), 'w') as f:
+            f.write('overwritten')
+        cm.restore_checkpoint('checkpoint', 'sub/doc.md')
+        with open(os.path.join(root, 'sub', 'doc.md')) as f:
+            assert(f.read() == edited)
+
+        # files that aren't utf-8 are kept as they are
+        latin1 = u'# caf\xe9\n\n```\nx\n```\n'.encode('latin-1')
+        with open(path, 'wb') as f:
+            f.write(latin1)
+        cm.create_checkpoint('doc.md')
+        with open(path, 'w') as f:
+            f.write('overwritten')
+        cm.restore_checkpoint('checkpoint', 'doc.md')
+        with open(path, 'rb') as f:
+            assert(f.read() == latin1)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_parallel_parse():
+    """Parsing in parallel gives the same result as in one process."""
+    with open('example.md') as f:
+        example = f.read()
+    # output blocks, empty blocks and a fence that is never closed
+    text = '\n'.join([example,
+                      '```python\n```\n',
+                      '```\nprint(1)\n```\n',
+                      '```{.json .output n=1}\n[]\n```\n',
+                      '```\nunclosed\n\n    indented\n']) * 20
+
+    for options in ({}, {'match': 'fenced', 'precode': 'import os'}):
+        reader = notedown.MarkdownReader(**options)
+        parallel = notedown.MarkdownReader(jobs=2, **options)
+        parallel.parallel_size = 0
+
+        code_matches = reader.find_code_matches(text)
+        n = len(code_matches)
+        for chunks_per_job in (1, 5, n):
+            parallel.chunks_per_job = chunks_per_job
+            nt.assert_equal([dict(b) for b in parallel.parse_blocks(text)],
+                            [dict(b) for b in reader.parse_blocks(text)])
+            nt.assert_equal(parallel.reads(text), reader.reads(text))
+
+
+def test_timing_report():
+    """Timing recorded in cell metadata is reported slowest first."""
+    notebook = notedown.MarkdownReader().reads(sample_markdown)
+    code_cells = [c for c in notebook.cells if c.cell_type == 'code']
+    for wall_time, cell in zip((0.5, 2.0), code_cells):
+        cell.metadata['timing'] = {'start': '2016-03-01T12:00:00Z',
+                                   'end': '2016-03-01T12:00:02Z',
+                                   'wall_time': wall_time}
+
+    report = notedown.timing_report(notebook, input_file='sample.md')
+    nt.assert_equal(report['input_file'], 'sample.md')
+    nt.assert_equal(report['total_wall_time'], 2.5)
+    nt.assert_equal([c['index'] for c in report['cells']], [1, 3])
+    nt.assert_equal(report['cells'][1]['summary'], 'pip install notedown')
+    json.dumps(report)
+
+    summary = notedown.timing_summary(notebook, n=1).splitlines()
+    nt.assert_equal(len(summary), 2)
+    assert('pip install notedown' in summary[1])
+
+    rss = notedown.peak_rss(os.getpid())
+    assert(rss is None or rss > 0)
+
+
+def test_cell_selector():
+    """Cells are selected to run by class, language and index."""
+    markdown = '\n\n'.join(['text',
+                             '```python\nsetup = 1\n```',
+                             '```{.python .slow}\nslow()\n```',
+                             '```bash\necho hi\n```',
+                             '```{.python .setup .slow}\nmore_setup()\n```\n'])
+    notebook = notedown.MarkdownReader().reads(markdown)
+    nt.assert_equal(len(notebook.cells), 5)
+
+    def selected(**kwargs):
+        select = notedown.CellSelector(**kwargs)
+        return [i for i, cell in enumerate(notebook.cells)
+                if select(cell, i)]
+
+    nt.assert_equal(selected(), [1, 2, 3, 4])
+    nt.assert_equal(selected(exclude=['slow']), [1, 3])
+    nt.assert_equal(selected(include=['bash']), [3])
+    nt.assert_equal(selected(include=['setup'], cells='1'), [1, 4])
+    nt.assert_equal(selected(include=['setup'], exclude=['slow']), [])
+    nt.assert_equal(selected(cells=':2,3:'), [1, 3, 4])
+    nt.assert_equal(notedown.CellSelector.parse_ranges('3:10,12,20:'),
+                    [(3, 10), (12, 13), (20, None)])
+
+
+def test_resume_run():
+    """A run that dies can be resumed from its progress, running
+    again only the cells chosen to rebuild the kernel state."""
+    from nbconvert.preprocessors.execute import CellExecutionError
+
+    directory = tempfile.mkdtemp()
+    counter = os.path.join(directory, 'counter')
+    progress = notedown.ExecutionProgress(
+        os.path.join(directory, 'progress'))
+    markdown = '\n\n'.join([
+        '```{{.python .setup}}\nwith open({!r}, "a") as f:\n'
+        '    f.write("setup ")\nx = 1\n```'.format(counter),
+        '```{{.python .slow}}\nwith open({!r}, "a") as f:\n'
+        '    f.write("slow ")\nprint(x)\n```'.format(counter),
+        '```python\nraise ValueError\n```\n'])
+    try:
+        notebook = notedown.MarkdownReader().reads(markdown)
+        nt.assert_raises(CellExecutionError, notedown.run, notebook,
+                         progress=progress)
+        nt.assert_equal(sorted(progress.load(notebook)), [0, 1])
+
+        notebook = notedown.MarkdownReader().reads(markdown)
+        notebook.cells[2].source = 'print(x + 1)'
+        notedown.run(notebook, progress=progress, resume=True,
+                     replay=notedown.CellSelector(include=['setup']))
+        with open(counter) as f:
+            nt.assert_equal(f.read(), 'setup slow setup ')
+        nt.assert_equal(notebook.cells[1].outputs[0].text, '1\n')
+        nt.assert_equal(notebook.cells[2].outputs[0].text, '2\n')
+        assert(not os.path.exists(progress.filename))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_run_select():
+    """Only the selected cells are run, the others keep their
+    outputs."""
+    markdown = '```python\nprint(1)\n```\n\n```python\nprint(2)\n```\n'
+    notebook = notedown.MarkdownReader().reads(markdown)
+    kept = [nbformat.v4.new_output('stream', name='stdout', text='kept\n')]
+    notebook.cells[0].outputs = kept
+    notedown.run(notebook, select=lambda cell, index: index == 1)
+    nt.assert_equal(notebook.cells[0].outputs, kept)
+    nt.assert_equal(notebook.cells[1].outputs[0].text, '2\n')
+    nt.assert_equal(notebook.metadata.language_info.name, 'python')
+
+
+def test_validate():
+    """Skipping or deferring validation gives the same notebook."""
+    reference = notedown.MarkdownReader().reads(sample_markdown)
+    for validate in (False, 'lazy'):
+        reader = notedown.MarkdownReader(validate=validate)
+        nt.assert_equal(reader.reads(sample_markdown), reference)
+
+        notebook_format = notedown.NotebookFormat(validate=validate)
+        json_notebook = notebook_format.writes(reference)
+        nt.assert_equal(json_notebook, nbformat.writes(reference))
+        nt.assert_equal(notebook_format.reads(json_notebook), reference)
+
+    invalid = nbformat.from_dict(reference)
+    invalid.cells[0].cell_type = 'nonsense'
+    nt.assert_raises(nbformat.ValidationError,
+                     notedown.validate_notebook, invalid)
+    assert(notedown.validate_notebook(invalid, False) is None)
+    # lazy validation validates a snapshot in the background
+    thread = notedown.validate_notebook(invalid, 'lazy')
+    invalid.cells[0].cell_type = 'markdown'
+    thread.join()
+
+
+def test_contents_manager_validate():
+    """The contents manager reads and saves markdown notebooks
+    whatever the validation setting."""
+    try:
+        from notedown.contentsmanager import NotedownContentsManager
+    except ImportError:
+        raise unittest.SkipTest('needs the jupyter notebook')
+
+    root = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(root, 'doc.md'), 'w') as f:
+            f.write(sample_markdown)
+
+        models = []
+        for validate in (True, False, 'lazy'):
+            cm = NotedownContentsManager(root_dir=root, validate=validate)
+            model = cm.get('doc.md')
+            assert('message' not in model)
+            models.append(model['content'])
+            cm.save(model, 'copy.md')
+            with open(os.path.join(root, 'copy.md')) as f:
+                # as converting through json
+                json_notebook = nbformat.writes(model['content'])
+                nt.assert_multi_line_equal(
+                    f.read(),
+                    notedown.main.convert(json_notebook,
+                                          informat='notebook',
+                                          outformat='markdown'))
+        nt.assert_equal(models[1], models[0])
+        nt.assert_equal(models[2], models[0])
+    finally:
+        shutil.rmtree(root)
+
+
+def test_batch_convert():
+    """Batch requests are converted in order, with per-request options
+    and errors."""
+    requests = [json.dumps({'id': 1, 'content': sample_markdown}),
+                '',
+                json.dumps({'id': 'two', 'content': sample_markdown,
+                            'to': 'markdown', 'strip': True}),
+                'not json',
+                json.dumps({'id': 3, 'content': sample_markdown,
+                            'colour': 'blue'})]
+    converter = notedown.main.Converter()
+    results = [json.loads(result) for result in
+               notedown.main.batch_convert(requests, converter,
+                                           match='fenced', magic=False)]
+
+    nt.assert_equal([result['id'] for result in results],
+                    [1, 'two', None, 3])
+    nt.assert_equal(results[0]['output'],
+                    notedown.main.convert(sample_markdown,
+                                          informat='markdown',
+                                          outformat='notebook'))
+    nt.assert_equal(results[1]['output'],
+                    notedown.main.convert(sample_markdown,
+                                          informat='markdown',
+                                          outformat='markdown',
+                                          strip_outputs=True))
+    assert('error' in results[2] and 'output' not in results[2])
+    assert('colour' in results[3]['error'])
+
+
+def test_aio():
+    """The asyncio API converts as convert does, with at most
+    max_pending conversions at once."""
+    if sys.version_info < (3, 6):
+        raise unittest.SkipTest('needs python 3.6')
+    import asyncio
+    from notedown import aio
+
+    expected = notedown.main.convert(sample_markdown, 'markdown', 'notebook')
+    running = []
+
+    def convert(*args, **kwargs):
+        running.append(1)
+        assert(len(running) == 1)
+        time.sleep(0.01)
+        running.pop()
+        return notedown.main.convert(*args, **kwargs)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        runner = aio.BlockingRunner(max_pending=1)
+        outputs = loop.run_until_complete(asyncio.gather(*[
+            runner(convert, sample_markdown, 'markdown', 'notebook')
+            for _ in range(4)]))
+        nt.assert_equal(outputs, [expected] * 4)
+
+        output = loop.run_until_complete(
+            aio.aconvert(sample_markdown, 'markdown', 'notebook'))
+        nt.assert_equal(output, expected)
+
+        stream = asyncio.StreamReader()
+        stream.feed_data(sample_markdown.encode('utf-8'))
+        stream.feed_eof()
+        cells = aio.aiter_cells(stream)
+        for cell in nbformat.reads(expected, 4).cells:
+            nt.assert_equal(loop.run_until_complete(cells.__anext__()), cell)
+        nt.assert_raises(StopAsyncIteration,
+                         loop.run_until_complete, cells.__anext__())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+    # the same runner can be used from another loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        outputs = loop.run_until_complete(asyncio.gather(*[
+            runner(convert, sample_markdown, 'markdown', 'notebook')
+            for _ in range(2)]))
+        nt.assert_equal(outputs, [expected] * 2)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def test_arun():
+    """arun executes a notebook as run does."""
+    if sys.version_info < (3, 6):
+        raise unittest.SkipTest('needs python 3.6')
+    import asyncio
+    from nbconvert.preprocessors.execute import CellExecutionError
+    from notedown import aio
+
+    markdown = '```python\nx = 1\nprint(x)\n```\n\n```python\nx + 1\n```\n'
+    expected = notedown.MarkdownReader().reads(markdown)
+    notedown.run(expected)
+    notebook = notedown.MarkdownReader().reads(markdown)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(aio.arun(notebook, kernel_name='python3'))
+        nt.assert_equal(notebook.metadata.language_info,
+                        expected.metadata.language_info)
+        for cell, expected_cell in zip(notebook.cells, expected.cells):
+            nt.assert_equal(cell.outputs, expected_cell.outputs)
+
+        notebook.cells[1].source = 'raise ValueError'
+        nt.assert_raises(CellExecutionError, loop.run_until_complete,
+                         aio.arun(notebook, kernel_name='python3'))
+    finally:
+        loop.close()
+
+
+def test_server():
+    """The server converts documents as the command line does."""
+    import threading
+    from six.moves.urllib.request import urlopen
+    from six.moves.urllib.error import HTTPError
+    from notedown.server import make_server
+
+    server = make_server(port=0, workers=2, max_request_size=10000)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = 'http://%s:%d' % server.server_address
+    try:
+        body = sample_markdown.encode('utf-8')
+        options = '&match=fenced&magic=0'
+        reply = urlopen(url + '/convert?to=notebook' + options, body)
+        nt.assert_equal(reply.read().decode('utf-8'),
+                        notedown.main.convert(sample_markdown,
+                                              informat='markdown',
+                                              outformat='notebook'))
+        reply = urlopen(url + '/convert?to=markdown&strip' + options, body)
+        nt.assert_equal(reply.read().decode('utf-8'),
+                        notedown.main.convert(sample_markdown,
+                                              informat='markdown',
+                                              outformat='markdown',
+                                              strip_outputs=True))
+
+        for query, data, code in (('to=html', body, 400),
+                                  ('to=markdown', b'x' * 20000, 413)):
+            try:
+                urlopen(url + '/convert?' + query, data)
+            except HTTPError as e:
+                nt.assert_equal(e.code, code)
+            else:
+                raise AssertionError('expected an error')
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+sectioned_markdown = u"""intro
+
+# First
+
+```python
+x = 1
+```
+
+Second
+======
+
+```python
+# not a heading
+```
+
+## Sub
+
+# Third
+
+end
+"""
+
+
+def test_section_index():
+    """Documents split at top level headings outside of code."""
+    index = notedown.SectionIndex(sectioned_markdown)
+    nt.assert_equal(index.titles, [None, 'First', 'Second', 'Third'])
+    nt.assert_equal(index.level, 1)
+    nt.assert_equal(u''.join(index.text(i) for i in range(len(index))),
+                    sectioned_markdown)
+    assert(index.text(2).startswith('Second\n===='))
+    assert('## Sub' in index.text(2))
+
+    text = index.replace(1, u'# First\n\nchanged\n')
+    nt.assert_equal(text, sectioned_markdown.replace(
+        u'```python\nx = 1\n```\n', u'changed\n'))
+
+
+def test_contents_manager_sections():
+    """Large markdown notebooks are opened and saved a section at a
+    time."""
+    try:
+        from notedown.contentsmanager import NotedownContentsManager
+    except ImportError:
+        raise unittest.SkipTest('needs the jupyter notebook')
+    from tornado import web
+
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, 'doc.md')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(sectioned_markdown)
+        cm = NotedownContentsManager(root_dir=root, section_size=10)
+
+        model = cm.get('doc.md')
+        nt.assert_equal(model['content'].metadata['notedown'],
+                        {'section': 1, 'sections': 4})
+        nt.assert_equal(model['content'].cells[1].source, 'intro')
+        assert('[Third](doc.md@4)' in model['content'].cells[0].source)
+
+        assert(cm.file_exists('doc.md@2'))
+        model = cm.get('doc.md@2')
+        nt.assert_equal(model['path'], 'doc.md@2')
+        cells = model['content'].cells
+        nt.assert_equal([cell.source for cell in cells[1:]],
+                        ['# First', 'x = 1'])
+
+        cells[2].source = 'x = 2'
+        cm.save(model, 'doc.md@2')
+        with io.open(path, encoding='utf-8') as f:
+            text = f.read()
+        assert('x = 2' in text and 'x = 1' not in text)
+        nt.assert_equal(notedown.SectionIndex(text).titles,
+                        [None, 'First', 'Second', 'Third'])
+        assert('Sections of' not in text)
+
+        # adding a top level heading would change the sections
+        cells.append(nbformat.v4.new_markdown_cell('# Fourth'))
+        nt.assert_raises(web.HTTPError, cm.save, model, 'doc.md@2')
+        nt.assert_raises(web.HTTPError, cm.get, 'doc.md@5')
+
+        # checkpoints of a section are deltas of the whole file
+        with io.open(path, encoding='utf-8') as f:
+            saved = f.read()
+        checkpoint = cm.create_checkpoint('doc.md@2')
+        nt.assert_equal(cm.list_checkpoints('doc.md@2'),
+                        cm.list_checkpoints('doc.md'))
+        checkpoint_path = cm.checkpoints.checkpoint_path(checkpoint['id'],
+                                                         'doc.md@2')
+        with open(checkpoint_path) as f:
+            nt.assert_equal(json.load(f)['format'], 'notedown-delta')
+        model = cm.get('doc.md@2')
+        model['content'].cells[2].source = 'x = 3'
+        cm.save(model, 'doc.md@2')
+        cm.restore_checkpoint(checkpoint['id'], 'doc.md@2')
+        with io.open(path, encoding='utf-8') as f:
+            nt.assert_equal(f.read(), saved)
+
+        # sections can't be changed as files
+        nt.assert_raises(web.HTTPError, cm.delete, 'doc.md@2')
+        nt.assert_raises(web.HTTPError, cm.rename, 'doc.md@2', 'other.md')
+        nt.assert_raises(web.HTTPError, cm.new, path='doc.md@2')
+        nt.assert_raises(web.HTTPError, cm.save,
+                         {'type': 'file', 'format': 'text', 'content': 'x'},
+                         'doc.md@2')
+        with io.open(path, encoding='utf-8') as f:
+            nt.assert_equal(f.read(), saved)
+
+        # small notebooks are opened whole
+        cm.section_size = 10 ** 6
+        nt.assert_equal(len(cm.get('doc.md')['content'].cells), 5)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_unchanged_saves():
+    """Notebooks saved again unchanged aren't rendered again."""
+    try:
+        from notedown.contentsmanager import NotedownContentsManager
+    except ImportError:
+        raise unittest.SkipTest('needs the jupyter notebook')
+
+    root = tempfile.mkdtemp()
+    try:
+        cm = NotedownContentsManager(root_dir=root)
+        os_path = os.path.join(root, 'doc.md')
+        notebooks = [nbformat.v4.new_notebook(cells=[
+            nbformat.v4.new_code_cell('x = {}'.format(i))])
+            for i in range(2)]
+
+        rendered = []
+        render = cm._render_notebook
+
+        def counting_render(os_path, nb):
+            rendered.append(nb.cells[0].source)
+            return render(os_path, nb)
+
+        cm._render_notebook = counting_render
+        cm._save_notebook(os_path, nbformat.from_dict(notebooks[0]))
+        cm._save_notebook(os_path, nbformat.from_dict(notebooks[0]))
+        nt.assert_equal(len(rendered), 1)
+
+        # unless the file changed
+        with open(os_path, 'a') as f:
+            f.write('edited\n')
+        cm._save_notebook(os_path, nbformat.from_dict(notebooks[0]))
+        nt.assert_equal(len(rendered), 2)
+
+        # or the notebook did
+        cm._save_notebook(os_path, nbformat.from_dict(notebooks[1]))
+        nt.assert_equal(len(rendered), 3)
+        with open(os_path) as f:
+            assert('x = 1' in f.read())
+    finally:
+        shutil.rmtree(root)
+
+
+def test_contents_manager_outputs_file():
+    """The contents manager writes the outputs file when it saves, and
+    a stripping contents manager leaves it alone."""
+    try:
+        from notedown.contentsmanager import (
+            NotedownContentsManager, NotedownContentsManagerStripped)
+    except ImportError:
+        raise unittest.SkipTest('needs the jupyter notebook')
+
+    root = tempfile.mkdtemp()
+    try:
+        v4 = nbformat.v4
+        nb = v4.new_notebook(cells=[v4.new_code_cell(
+            'print(1)', execution_count=1,
+            outputs=[v4.new_output('stream', name='stdout', text='1\n')])])
+        os_path = os.path.join(root, 'doc.md')
+        outputs_file = notedown.OutputsFile.path(os_path)
+
+        cm = NotedownContentsManager(root_dir=root, outputs_file=True)
+        cm._save_notebook(os_path, nb)
+        with open(outputs_file) as f:
+            saved = f.read()
+        assert('1\\n' in saved)
+        nt.assert_equal(cm._read_notebook(os_path).cells[0].outputs,
+                        nb.cells[0].outputs)
+
+        cm = NotedownContentsManagerStripped(root_dir=root, outputs_file=True)
+        cm._save_notebook(os_path, nb)
+        with open(outputs_file) as f:
+            nt.assert_equal(f.read(), saved)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_skip_unchanged():
+    """Outputs that haven't changed aren't rewritten."""
+    try:
+        from notedown.contentsmanager import NotedownContentsManager
+    except ImportError:
+        raise unittest.SkipTest('needs the jupyter notebook')
+
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, 'doc.md')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(u'text \u2713\n')
+        assert(notedown.same_contents(path, u'text \u2713\n'))
+        assert(not notedown.same_contents(path, u'text \u2717\n'))
+        assert(not notedown.same_contents(path, u'text'))
+        assert(not notedown.same_contents(path + 'x', u''))
+
+        with open(path, 'w') as f:
+            f.write(sample_markdown)
+        cm = NotedownContentsManager(root_dir=root)
+        for name in ('doc.md', 'doc.ipynb'):
+            model = cm.get('doc.md')
+            cm.save(model, name)
+            os.utime(os.path.join(root, name), (0, 0))
+            cm.save(model, name)
+            nt.assert_equal(os.path.getmtime(os.path.join(root, name)), 0)
+            model['content'].cells.pop()
+            cm.save(model, name)
+            assert(os.path.getmtime(os.path.join(root, name)) > 0)
+    finally:
+        shutil.rmtree(root)
+
+
 class TestCommandLine(object):
     @property
     def default_args(self):
@@ -451,6 +1608,71 @@ class TestCommandLine(object):
         args.input_file = 'example.ipynb'
         self.run(args)
 
+    def test_skip_unchanged(self):
+        output = tempfile.NamedTemporaryFile(suffix='.ipynb', delete=False)
+        output.close()
+        try:
+            args = self.default_args
+            args.input_file = 'example.md'
+            args.output = output.name
+            args.skip_unchanged = True
+            self.run(args)
+            os.utime(output.name, (0, 0))
+            self.run(args)
+            nt.assert_equal(os.path.getmtime(output.name), 0)
+            args.skip_unchanged = False
+            self.run(args)
+            assert(os.path.getmtime(output.name) > 0)
+        finally:
+            os.remove(output.name)
+
+    def test_compressed(self):
+        directory = tempfile.mkdtemp()
+        try:
+            input_file = os.path.join(directory, 'example.md.gz')
+            with open('example.md', 'rb') as f:
+                with notedown.open_compressed(input_file, 'wb') as op:
+                    op.write(f.read())
+            args = self.default_args
+            args.input_file = input_file
+            args.output = None
+            args.outformat = 'notebook'
+            self.run(args)
+
+            output = os.path.join(directory, 'example.ipynb.gz')
+            with notedown.open_text(output) as f:
+                notebook = nbformat.read(f, as_version=4)
+            with open('example.md') as f:
+                nt.assert_equal(notebook, notedown.MarkdownReader().read(f))
+
+            os.utime(output, (0, 0))
+            self.run(args)
+            nt.assert_equal(os.path.getmtime(output), 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stats(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('example.md', 'r-examples/r-example.ipynb'):
+                shutil.copy(name, directory)
+            report = os.path.join(directory, 'stats.json')
+            args = self.default_args
+            args.input_file = directory
+            args.stats_report = report
+            args.jobs = 2
+            self.run(args)
+
+            with open(report) as f:
+                reports = json.load(f)
+            nt.assert_equal([r['filename'] for r in reports],
+                            [os.path.join(directory, 'r-example.ipynb'),
+                             os.path.join(directory, 'example.md')])
+            nt.assert_equal([r['format'] for r in reports],
+                            ['notebook', 'markdown'])
+        finally:
+            shutil.rmtree(directory)
+
     def test_markdown_to_notebook(self):
         args = self.default_args
         args.input_file = 'example.md'
@@ -465,6 +1687,31 @@ class TestCommandLine(object):
         args.outformat = 'markdown'
         self.run(args)
 
+    def test_strip_markdown(self):
+        directory = tempfile.mkdtemp()
+        try:
+            notebook = nbformat.read('r-examples/r-example.ipynb',
+                                     as_version=4)
+            writer = notedown.MarkdownWriter(notedown.markdown_template,
+                                             strip_outputs=False)
+            input_file = os.path.join(directory, 'r-example.md')
+            with io.open(input_file, 'w', encoding='utf-8') as f:
+                f.write(writer.writes(notebook))
+            args = self.default_args
+            args.input_file = input_file
+            args.output = os.path.join(directory, 'stripped.md')
+            args.strip_outputs = True
+            self.run(args)
+
+            with open(input_file) as f:
+                notebook = notedown.MarkdownReader().read(f)
+            notedown.strip(notebook)
+            writer = notedown.MarkdownWriter(notedown.markdown_template)
+            with open(args.output) as f:
+                nt.assert_equal(f.read(), writer.writes(notebook))
+        finally:
+            shutil.rmtree(directory)
+
     def test_notebook_to_markdown(self):
         args = self.default_args
         args.input_file = 'example.ipynb'